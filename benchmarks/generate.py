@@ -0,0 +1,178 @@
+"""
+Generators of synthetic input for the benchmarks, so they don't need a MESA
+installation or a MESA run.
+
+- fortran_module_lines: a Fortran module with a chosen number of routines,
+  lines, interface blocks, 'contains' blocks and 'select case' blocks
+- write_mesa_tree: a directory laid out like MESA (module/private/*.f90
+  etc.) filled with synthetic modules, for write_mesa_routines
+- trace_lines: MESA terminal output with start/finsh lines from a random
+  call tree of a chosen depth, with early returns and other output mixed in
+
+Everything is made with random.Random(seed), so a given set of arguments
+always gives the same files.
+"""
+import os
+import random
+
+
+def fortran_module_lines(name, n_routines=100, n_lines=20, n_interfaces=2,
+                         contains_every=5, select_every=3):
+    """
+    Input:
+    - name: name of the module
+    - n_routines: number of subroutines and functions in the module
+    - n_lines: number of executable lines in each routine
+    - n_interfaces: number of interface blocks at the top of the module
+    - contains_every: every contains_every'th routine has an internal
+                      subroutine after a 'contains' line (0 for none)
+    - select_every: every select_every'th routine has a 'select case'
+                    block at the start of its body (0 for none)
+
+    Returns: generator over the lines of the module
+    """
+    yield 'module {}\n'.format(name)
+    yield '   implicit none\n'
+    for k in range(n_interfaces):
+        yield '   interface\n'
+        yield '      subroutine {}_external_{}(x)\n'.format(name, k)
+        yield '         real, intent(inout) :: x\n'
+        yield '      end subroutine {}_external_{}\n'.format(name, k)
+        yield '   end interface\n'
+    yield 'contains\n'
+
+    for k in range(n_routines):
+        is_function = k % 4 == 3
+        routine = '{}_{}_{}'.format(name, 'func' if is_function else 'sub', k)
+        if is_function:
+            yield '   integer function {}(x, n)\n'.format(routine)
+        else:
+            yield '   subroutine {}(x, n)\n'.format(routine)
+        yield '      real, intent(inout) :: x\n'
+        yield '      integer, intent(in) :: n\n'
+        yield '      integer :: i\n'
+        yield '      ! work out something from x\n'
+        if select_every and k % select_every == 0:
+            yield '      select case (n)\n'
+            yield '      case (1)\n'
+            yield '         x = x + 1\n'
+            yield '      case default\n'
+            yield '         x = x - 1\n'
+            yield '      end select\n'
+        for j in range(n_lines):
+            if j % 5 == 4:
+                yield '      do i = 1, n\n'
+                yield '         x = x + real(i) * {}.0\n'.format(j)
+                yield '      end do\n'
+            else:
+                yield '      x = x * 0.5 + {}.0  ! line {}\n'.format(j, j)
+        if is_function:
+            yield '      {} = int(x)\n'.format(routine)
+        if contains_every and k % contains_every == 0:
+            yield '   contains\n'
+            yield '      subroutine {}_inner(y)\n'.format(routine)
+            yield '         real, intent(inout) :: y\n'
+            yield '         y = y + 1\n'
+            yield '      end subroutine {}_inner\n'.format(routine)
+        if is_function:
+            yield '   end function {}\n'.format(routine)
+        else:
+            yield '   end subroutine {}\n'.format(routine)
+        yield '\n'
+    yield 'end module {}\n'.format(name)
+
+
+def write_mesa_tree(mesa_dir, n_files=20, modules=('star', 'net', 'eos'),
+                    **kwargs):
+    """
+    Input:
+    - mesa_dir: directory to write the synthetic MESA installation to
+    - n_files: number of .f90 files, spread over modules
+    - modules: names of the MESA modules, each given a private directory
+    - kwargs: passed on to fortran_module_lines
+
+    Returns: list of the .f90 files written
+
+    Purpose: makes a directory that write_mesa_routines can work on, with
+    the files that all_mesa_f_files expects to find.
+    """
+    filenames = []
+    for k in range(n_files):
+        module = modules[k % len(modules)]
+        directory = os.path.join(mesa_dir, module, 'private')
+        os.makedirs(directory, exist_ok=True)
+        filename = os.path.join(directory, 'bench_{}.f90'.format(k))
+        with open(filename, 'w') as f:
+            f.writelines(fortran_module_lines('bench_{}'.format(k),
+                                              **kwargs))
+        filenames.append(filename)
+
+    os.makedirs(os.path.join(mesa_dir, 'include'), exist_ok=True)
+    os.makedirs(os.path.join(mesa_dir, 'star', 'job'), exist_ok=True)
+    with open(os.path.join(mesa_dir, 'include',
+                           'standard_run_star_extras.inc'), 'w') as f:
+        f.writelines(fortran_module_lines('extras', n_routines=5))
+    with open(os.path.join(mesa_dir, 'star', 'job', 'run_star.f'), 'w') as f:
+        f.writelines(fortran_module_lines('run_star', n_routines=2))
+    return filenames
+
+
+def trace_lines(n_lines, n_routines=200, n_files=20, max_depth=12,
+                p_return=0.02, p_other=0.01, seed=0):
+    """
+    Input:
+    - n_lines: approximate number of lines to make
+    - n_routines: number of distinct routines, spread over n_files files
+    - max_depth: deepest call depth
+    - p_return: chance that a routine leaves through an early return, so
+                its finsh line is missing
+    - p_other: chance of a line of other MESA output between trace lines
+    - seed: seed for the random numbers
+
+    Returns: generator over the lines of a MESA terminal output, as
+    written by write(*,*) statements inserted by write_mesa_routines
+
+    Purpose: a random walk through a call tree. A few routines are called
+    much more often than the rest, as in a real run, so i_ignore has
+    something to remove. As in MESA, no routine calls itself, so a routine
+    only starts again while it is open after an early return.
+    """
+    rng = random.Random(seed)
+    names = ['{} bench_{} -- bench_{}.f90'.format(
+        'integer function' if k % 4 == 3 else 'subroutine', k, k % n_files)
+        for k in range(n_routines)]
+    # routine k is picked with weight 1 / (k + 1)
+    weights = [1 / (k + 1) for k in range(n_routines)]
+    stack = []
+    open_names = set()  # routines in stack
+    n = 0
+    while n < n_lines:
+        if rng.random() < p_other:
+            yield ' other output {}\n'.format(rng.random())
+            n += 1
+        if stack and (len(stack) >= max_depth or rng.random() < 0.5):
+            name = stack.pop()
+            open_names.discard(name)
+            if rng.random() >= p_return:
+                yield ' finsh -- {} \n'.format(name)
+                n += 1
+        else:
+            # recursive routines aren't instrumented, so a routine which is
+            # still open isn't called again
+            name = rng.choices(names, weights)[0]
+            while name in open_names:
+                name = rng.choices(names, weights)[0]
+            open_names.add(name)
+            stack.append(name)
+            yield ' start -- {} \n'.format(name)
+            n += 1
+    while stack:
+        yield ' finsh -- {} \n'.format(stack.pop())
+
+
+def write_trace(filename, n_lines, **kwargs):
+    """
+    writes trace_lines(n_lines, **kwargs) to filename
+    """
+    with open(filename, 'w') as f:
+        f.writelines(trace_lines(n_lines, **kwargs))
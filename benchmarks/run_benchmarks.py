@@ -0,0 +1,210 @@
+"""
+Benchmarks of print_fortran_routines on synthetic input (see generate.py).
+
+Times modify_fortran_file, write_mesa_routines, modify_mesa_terminal_output
+and write_trace_store over a range of input sizes, and measures the peak
+memory allocated in Python (with tracemalloc, in a separate run from the
+timing). Each step up in size multiplies the input by the same factor,
+so the growth of the time from one size to the next gives the scaling
+exponent: about 1 for a linear method, 2 for a quadratic one. Any
+benchmark whose exponent is above --max-exponent is reported as a scaling
+regression and the script exits with status 1.
+
+Usage: python benchmarks/run_benchmarks.py [--quick] [--factor 4]
+           [--steps 3] [--repeat 3] [--max-exponent 1.4] [--only name]
+"""
+import argparse
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import print_fortran_routines as pfr  # noqa: E402
+from generate import (fortran_module_lines, write_mesa_tree,  # noqa: E402
+                      write_trace)
+
+min_seconds = 0.05  # times shorter than this are too noisy to compare
+
+
+def modify_fortran_file_case(tmp, size):
+    """
+    one Fortran file with size * 400 routines
+    """
+    input_file = os.path.join(tmp, 'module.f90')
+    output_file = os.path.join(tmp, 'module_print.f90')
+    with open(input_file, 'w') as f:
+        f.writelines(fortran_module_lines('bench', n_routines=size * 400))
+
+    def run():
+        pfr.modify_fortran_file(input_file, output_file)
+    return run
+
+
+def write_mesa_routines_case(tmp, size):
+    """
+    size * 40 MESA files instrumented from scratch, with no cache
+    """
+    mesa_dir = os.path.join(tmp, 'mesa')
+    files = write_mesa_tree(mesa_dir, n_files=size * 40, n_routines=20)
+
+    def run():
+        mesa_dir_print = os.path.join(tmp, 'mesa_print')
+        shutil.rmtree(mesa_dir_print, ignore_errors=True)
+        shutil.copytree(mesa_dir, mesa_dir_print)
+        pfr.write_mesa_routines(mesa_dir, mesa_dir_print, files=files,
+                                cache=False)
+    return run
+
+
+def write_mesa_routines_cached_case(tmp, size):
+    """
+    size * 200 MESA files which are already instrumented, so every file
+    is a cache hit
+    """
+    mesa_dir = os.path.join(tmp, 'mesa')
+    mesa_dir_print = os.path.join(tmp, 'mesa_print')
+    files = write_mesa_tree(mesa_dir, n_files=size * 200, n_routines=5)
+    shutil.copytree(mesa_dir, mesa_dir_print)
+    pfr.write_mesa_routines(mesa_dir, mesa_dir_print, files=files)
+
+    def run():
+        pfr.write_mesa_routines(mesa_dir, mesa_dir_print, files=files)
+    return run
+
+
+def terminal_output_case(tmp, size, **kwargs):
+    """
+    MESA terminal output of size * 50000 lines, with
+    modify_mesa_terminal_output called with kwargs
+    """
+    input_file = os.path.join(tmp, 'output.txt')
+    output_file = os.path.join(tmp, 'routines.txt')
+    write_trace(input_file, size * 50000)
+
+    def run():
+        pfr.modify_mesa_terminal_output(input_file, output_file, **kwargs)
+    return run
+
+
+def aggregate_case(tmp, size):
+    """
+    as terminal_output_case, written as a call tree
+    """
+    return terminal_output_case(tmp, size, aggregate=True)
+
+
+def files_case(tmp, size):
+    """
+    as terminal_output_case, keeping only the routines from two files
+    """
+    return terminal_output_case(tmp, size, i_ignore=None,
+                                files=['bench_1.f90', 'bench_2.f90'])
+
+
+def trace_store_case(tmp, size):
+    """
+    as terminal_output_case, written to a trace store
+    """
+    input_file = os.path.join(tmp, 'output.txt')
+    write_trace(input_file, size * 50000)
+
+    def run():
+        pfr.write_trace_store(input_file, os.path.join(tmp, 'output.pfr'),
+                              rebuild=True)
+    return run
+
+
+# name -> function(tmp, size) which makes the input and returns the function
+# to time
+benchmarks = {
+    'modify_fortran_file': modify_fortran_file_case,
+    'write_mesa_routines': write_mesa_routines_case,
+    'write_mesa_routines (cached)': write_mesa_routines_cached_case,
+    'modify_mesa_terminal_output': terminal_output_case,
+    'modify_mesa_terminal_output (aggregate)': aggregate_case,
+    'modify_mesa_terminal_output (files)': files_case,
+    'write_trace_store': trace_store_case,
+}
+
+
+def measure(case, size, repeat):
+    """
+    Returns: (best time in seconds out of repeat runs, peak memory in MB)
+    of the function made by case for input size
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        run = case(tmp, size)
+        times = []
+        for k in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(times), peak / 1e6
+
+
+def exponent(size1, time1, size2, time2):
+    """
+    returns the power of the size that the time grows with between two
+    sizes, or None if the times are too short to tell
+    """
+    if time1 < min_seconds:
+        return None
+    return math.log(time2 / time1) / math.log(size2 / size1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='smallest sizes only, e.g. to check it runs')
+    parser.add_argument('--factor', type=int, default=4,
+                        help='growth in size from one step to the next')
+    parser.add_argument('--steps', type=int, default=3,
+                        help='number of sizes')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs timed at each size, the best is kept')
+    parser.add_argument('--max-exponent', type=float, default=1.4,
+                        help='largest scaling exponent allowed')
+    parser.add_argument('--only', action='append', default=[],
+                        help='run benchmarks with this in their name')
+    args = parser.parse_args(argv)
+
+    steps = 2 if args.quick else args.steps
+    sizes = [args.factor ** k for k in range(steps)]
+    regressions = []
+    print('{:<42} {:>6} {:>10} {:>10} {:>9}'.format(
+        'benchmark', 'size', 'time (s)', 'peak (MB)', 'exponent'))
+    for name, case in benchmarks.items():
+        if args.only and not any(x in name for x in args.only):
+            continue
+        previous = None
+        for size in sizes:
+            seconds, peak = measure(case, size, args.repeat)
+            power = None
+            if previous is not None:
+                power = exponent(previous[0], previous[1], size, seconds)
+            print('{:<42} {:>6} {:>10.4f} {:>10.2f} {:>9}'.format(
+                name, size, seconds, peak,
+                '' if power is None else '{:.2f}'.format(power)))
+            sys.stdout.flush()
+            if power is not None and power > args.max_exponent:
+                regressions.append((name, size, power))
+            previous = (size, seconds)
+
+    for name, size, power in regressions:
+        print('scaling regression: {} grows as size^{:.2f} at size {}'.format(
+            name, power, size))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
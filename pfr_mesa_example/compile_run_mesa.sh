@@ -1,6 +1,9 @@
 #!/bin/bash
 
 # Runs test MESA file
+# Usage: compile_run_mesa.sh MESA_DIR [--modules [MODULE ...]]
+# Without --modules all of MESA is installed. With --modules only the given
+# MESA modules (e.g. star net eos) are recompiled, and none if there are none
 
 if [ "$#" -lt 1 ]; then
   echo 'Provide MESA directory (the one containing modified Fortran files)'
@@ -9,6 +12,11 @@ fi
 
 cwd=$PWD
 export MESA_DIR=$1
+shift
+if [ "$1" == "--modules" ]; then
+    only_modules=1
+    shift
+fi
 cd $MESA_DIR
 if [ ! -f skip_test ]; then
     touch skip_test
@@ -16,7 +24,19 @@ fi
 
 # Compiling MESA
 echo "---------- Compiling MESA ----------"
-./install
+if [ -n "$only_modules" ]; then
+    for module in "$@"; do
+        # include files are compiled with the work directory
+        if [ -d "$MESA_DIR/$module" ] && [ "$module" != "work" ]; then
+            (cd $MESA_DIR/$module && ./mk && ./export)
+        fi
+    done
+    if [ "$#" -eq 0 ]; then
+        echo "No MESA modules changed"
+    fi
+else
+    ./install
+fi
 wait
 echo "---------- Compiled MESA -----------"
 echo
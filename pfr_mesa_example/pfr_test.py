@@ -29,32 +29,37 @@ mesa_dir_print = '/Users/eoin/mesa-r12778_print'
 
 # ----------------------------------------------------- #
 # 1. Modifies Fortran files in mesa_dir_print
-pfr.write_mesa_routines(mesa_dir, mesa_dir_print, files='star')
+summary = pfr.write_mesa_routines(mesa_dir, mesa_dir_print, files='star')
 
 # ----------------------------------------------------- #
 
 # 2. Compiles and runs MESA and the stellar evolution model
-subprocess.run(["bash", "compile_run_mesa.sh", mesa_dir_print])
+#    Only the MESA modules with changed files are recompiled
+subprocess.run(["bash", "compile_run_mesa.sh", mesa_dir_print,
+                "--modules"] + summary['modules'])
 
 # ----------------------------------------------------- #
 
-# 3. Improve the layout of the output files - doing this 4 different ways just
-#    to indicate different possibilites
+# 3. Improve the layout of the output files - doing this 3 different ways just
+#    to indicate different possibilites. The output file is only read once
+#    for all of them.
 
 inputf = os.path.abspath('output.txt')  # output file from MESA run.
 
 files_v1 = ['run_star.f', 'evolve.f90', 'standard_run_star_extras.inc']
 outputf1 = os.path.abspath('routines_short.txt')
-pfr.modify_mesa_terminal_output(inputf, outputf1, files=files_v1)
 
 files_v2 = ['net.f90', 'run_star.f', 'standard_run_star_extras.f',
             'micro.f90', 'overshoot.f90', 'evolve.f90',
             'standard_run_star_extras.inc', 'solve_hydro.f90',
             'star_newton.f90', 'struct_burn_mix.f90', 'timestep.f90']
 outputf2 = os.path.abspath('routines_medium.txt')
-pfr.modify_mesa_terminal_output(inputf, outputf2, files=files_v2)
 
 outputf4 = os.path.abspath('routines_long.txt')
-pfr.modify_mesa_terminal_output(inputf, outputf4, i_ignore=10)
+
+pfr.modify_mesa_terminal_views(inputf, [
+    {'output_file': outputf1, 'files': files_v1},
+    {'output_file': outputf2, 'files': files_v2},
+    {'output_file': outputf4, 'i_ignore': 10}])
 
 # ----------------------------------------------------- #
@@ -1,12 +1,57 @@
 import glob
-from collections import Counter
+import os
+import sys
+import tempfile
+import time
 from pathlib import Path
-import subprocess
 import filecmp
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from .cache import (cache_key, load_manifest, save_manifest, is_cached,
+                    add_to_cache, copy_original)
+from .follow import (follow_trace_blocks, input_ready, new_live_state,
+                     live_nest_events)
+from .fortran_index import (index_fortran_lines, contains_line,
+                            merge_insertions)
+from .compact import (routine_id, get_call_texts, load_symbols, file_id,
+                      save_symbols, save_trace_module, compact_trace_reader)
+from .parallel import (parallel_count_trace_lines, parallel_nest_trace,
+                       parallel_nest_trace_events)
+from .stats import (new_stats, add_stage_time, timed_stage, timed_iter,
+                    add_counts)
+from .store import (build_trace_store, load_store_meta, open_trace_store,
+                    find_routines, routine_calls, call_name, call_subtree,
+                    call_ancestors, calls_in_range, routine_counts,
+                    diverging_calls, store_trace_lines)
+from .threads import (get_thread_write_texts, thread_trace_lines,
+                      spool_thread_lines, thread_activity_lines)
+from .throttle import check_throttle, throttle_texts
+from .timing import (profile_time_trace, profile_report_lines,
+                     collapsed_stack_lines)
+from .trace import (trace_reader, nest_trace, nest_trace_lines,
+                    nest_trace_events, aggregate_trace_events,
+                    call_tree_lines, count_trace_lines, save_trace_counts,
+                    load_trace_counts, spool_trace_ids, keep_trace_ids,
+                    view_trace_lines, nest_kept_events, tabbed_trace_lines,
+                    add_trace_event, trace_source_stamp)
+
+__version__ = '0.0.1'
+
+# what can be inserted at the start and end of each routine
+insert_formats = ('write', 'id', 'time')
+
+# settings of each view in modify_mesa_terminal_views
+view_options = ('output_file', 'i_ignore', 'files', 'aggregate')
+
+# i_ignore used when it isn't given, unless the output is a call tree
+default_i_ignore = 2
 
 
 def modify_fortran_file(input_file, output_file=None, ignore_functions=[],
-                        write=True):
+                        write=True, insert_format='write', file_id=0,
+                        symbols=None, throttle=None, threads=False,
+                        stats=None):
     """
     Input:
     - input_file: .f or .f90 filename which you want to modify
@@ -15,174 +60,156 @@ def modify_fortran_file(input_file, output_file=None, ignore_functions=[],
     - write: if True, write to output_file. if False, return list of strings
              to write to file. This is so I can use it for modifying multiple
              files and checking if files are modified already
+    - insert_format: 'write' inserts write(*,*) statements with the routine
+                     & file names. 'id' inserts call pfr_trace(id) with an
+                     integer routine ID instead (see compact.py), and
+                     'time' inserts call pfr_trace_time(id), which also
+                     records the time (see timing.py)
+    - file_id: ID of the file, used to make the routine IDs if
+               insert_format is 'id' or 'time'
+    - symbols: optional list, to which [routine ID, routine, line] is
+               appended for each routine given a routine ID
+    - throttle: None to trace every call. Otherwise ('first', n),
+                ('every', n) or ('sample', rate), which also inserts a
+                save counter into each routine so that only its first n
+                calls, every nth call or a fraction rate of its calls are
+                traced when MESA runs (see throttle.py)
+    - threads: if True, the inserted statements also record which OpenMP
+               thread each routine runs on, and can be called from
+               several threads at once (see threads.py). They call
+               routines in pfr_trace.f90, which must be compiled with MESA.
+    - stats: optional dictionary, which is filled in with 'stages', the
+             time in seconds spent to 'read', 'parse', 'insert' and 'write'
+             the file, 'lines' and 'bytes_read' of input_file, and
+             'routines', the number of routines 'instrumented' and passed
+             over because they were 'ignored', 'in_interface', had 'no_end'
+             line found, were 'already_instrumented' or had the same first
+             line as one which couldn't be modified ('duplicate')
 
     Returns: None
 
     Purpose: takes in f.90 filename, writes write(*,*) statements at the
     start and end of every function & subroutine and saves output file.
+    The file is indexed in a single pass and all of the write(*,*)
+    statements are inserted at the end in one go.
     """
 
-    # types of function / subroutines to consider
-    function_types = ('subroutine', 'integer function', 'logical function')
-
     # function names to ignore (will not insert write(*,*) statements in these)
     # this can be modified as desired, e.g. if there are subroutines that
     # you don't want to analyse
     # ignore_functions = [] by default
 
-    # write(*,*) statements will be inserted after any lines beginning with
-    # these at start of functions/subroutines
-    fortran_types = ("real", "type", "use", "comment", "integer", "logical",
-                     "!", " ", "include", "9", "character", "implicit",
-                     "interface", "procedure", "optional", "double", "save",
-                     "equivalence", "select case", "complex", "data", "*", ">",
-                     "import", "class", "parameter")
+    # the types of function / subroutines to consider and the lines which
+    # are skipped before inserting write(*,*) statements are function_types
+    # and fortran_types in fortran_index.py
 
     def read_initial_file(filename):
         """
-        reads file and returns original, the lines without spaces &
-        the name of file
+        reads file and returns original & the name of file
         """
         inputFile = open(filename, "r+")
         original_file = inputFile.readlines()
         inputFile.close()
 
         f_short = filename.split('/')[-1]  # gets short filename
-        f_nospaces = [l.strip() for l in original_file]  # remove white spaces
 
-        return original_file, f_nospaces, f_short
+        return original_file, f_short
 
-    def get_lastline(line, is_subroutine):
-        """
-        given first line, returns last line of fortran function/subroutines
+    def get_write_texts(first_line, f_short):
         """
-        if is_subroutine:
-            rname = line.split('(', 1)[0].split('!')[0].rstrip()
-            return 'end ' + rname
-        else:
-            f_endname = line.split(' function')[-1].split('!')[0]
-            f_endname = 'end function' + f_endname.split('(', 1)[0].rstrip()
-            return f_endname
-
-    def get_subroutine_data(f_nospaces, f_short):
+        returns first and last write(*,*) statements for routine with
+        first line e.g.'subroutine do_something(x, y)'
         """
-        returns contents of first, last lines of subroutines and
-        first and last write(*,*) statements
-        first & last lines of subroutines e.g.'subroutine do_something(x, y)'
-        """
-        first_lines = [l for l in f_nospaces if l.startswith(function_types)]
-        is_subroutine = [True if 'subroutine' in l else False
-                         for l in first_lines]
-        last_lines = [get_lastline(l, sub)
-                      for l, sub in zip(first_lines, is_subroutine)]
-
         # contents of write(*,*) statements to insert into fortran code
-        routines = [l.split('(', 1)[0] for l in first_lines]
-        start_texts = [' '.join(['      write(*,*)', "'", "start --", r, "--",
-                       f_short, "'\n"]) for r in routines]
-        finish_texts = [' '.join(['      write(*,*)', "'", "finsh --", r, "--",
-                        f_short, "'\n"]) for r in routines]
-
-        return [first_lines, last_lines, start_texts, finish_texts]
-
-    def correct_startline(file_contents, start_index, end_index):
-        """
-        returns correct index to insert starting_text, skipping any lines
-        beginning with anything in fortran_types
+        routine = first_line.split('(', 1)[0]
+        if threads:
+            return get_thread_write_texts(routine, f_short)
+        start_text = ' '.join(['      write(*,*)', "'", "start --", routine,
+                               "--", f_short, "'\n"])
+        finish_text = ' '.join(['      write(*,*)', "'", "finsh --", routine,
+                                "--", f_short, "'\n"])
+        return start_text, finish_text
+
+    def get_insertions(index, f_short):
         """
-        routine = file_contents[start_index:end_index + 1]
-        line_indices = list(range(start_index, end_index+1))
-
-        # Skip if beginning with fortran_types, blank or contain ''&' in
-        # previous line (True => skip line)
-        type = [l.lower().startswith(fortran_types) for l in routine]
-        ends_and = [True] + ['&' in l or '!' in l for l in routine][:-1]
-        is_blank = [True if y == '' else False for y in routine]
-        incase = [True if any(x.startswith('select case') for x in routine[:i])
-                  and any(x.startswith('end select') for x in routine[i:])
-                  else False for i, val in enumerate(routine)]
-        is_header = [True if any((a, b, c, d)) else False
-                     for a, b, c, d in zip(type, ends_and, is_blank, incase)]
-
-        return next((j for j, header in zip(line_indices, is_header)
-                     if not header), line_indices[-1])
-
-    def write_one_subroutine(modified_file, nospaces, a, b, stext, etext):
+        returns dictionary of line index -> list of write(*,*) statements
+        to insert before that line
+
+        Routines with the same first line are handled in order. Ones that
+        already contain their write(*,*) statements are passed over, and
+        once one of them can't be modified none of the later ones are.
+        A start write(*,*) goes before any statements already inserted at
+        the same line and a finish write(*,*) goes after them.
         """
-        returns modified_file with write(*,*) added for single subroutine
-        a, b = first & last lines of subroutine
-        """
-
-        nospaces = [l.strip().lower() for l in modified_file]
-        istart = nospaces.index(a.lower())
-
-        if b.lower() not in nospaces[istart:] and 'subroutine' in b:
-            b = 'end subroutine'
-
-        try:
-            iend = istart + nospaces[istart:].index(b.lower())
-            rout_contents = nospaces[istart:iend+1]
-
-            while stext.strip() in rout_contents:
-                istart = iend + 1 + nospaces[iend + 1:].index(a.lower())
-                iend = istart + nospaces[istart:].index(b.lower())
-                rout_contents = nospaces[istart:iend+1]
-        except ValueError:
-            return modified_file
-
-        # get index for start write(*,*) statement
-        istart = correct_startline(nospaces, istart, iend)
-
-        # if it is an ignore function, dont' insert write(*,*) statements
-        if any(x in stext for x in ignore_functions):
-            return modified_file
-
-        # if in an interface section, don't insert write statements
-        no_comments = [x.split('!')[0].strip().lower() for x in nospaces]
-        try:
-            jint = no_comments[:istart][::-1].index('interface')
-            if 'end interface' not in no_comments[istart - jint:istart][::-1]:
-                return modified_file
-        except ValueError:
-            pass
-
-        try:
-            jint = no_comments[:istart][::-1].index('abstract interface')
-            if 'end interface' not in no_comments[istart - jint:istart][::-1]:
-                return modified_file
-        except ValueError:
-            pass
-
-        # insert write(*,*) at start of routine
-        modified_file.insert(istart, stext)
-
-        # inserts write(*,*) at end of routine but before 'contains' if exists
-        if 'contains' in rout_contents:
-            icontain = rout_contents.index('contains') + 1
-            modified_file.insert(nospaces.index(a.lower()) + icontain, etext)
-        else:
-            modified_file.insert(iend + 1, etext)
-
-        return modified_file
-
-    def modify_original_file(original, f_nospaces, f_short):
+        insertions = {}
+        skipped = set()  # first lines of routines that can't be modified
+
+        for position, routine in enumerate(index['routines'], 1):
+            key = routine['first_line'].lower()
+            if key in skipped:
+                routine_counts['duplicate'] += 1
+                continue
+            stext, etext = get_write_texts(routine['first_line'], f_short)
+            ignored = any(x in stext for x in ignore_functions)
+            if insert_format != 'write':
+                rid = routine_id(file_id, position)
+                stext, etext = get_call_texts(rid, insert_format, threads)
+
+            # no last line found for routine
+            if routine['end'] is None:
+                skipped.add(key)
+                routine_counts['no_end'] += 1
+                continue
+
+            # already has write(*,*) statements
+            if contains_line(index, stext, routine['start'], routine['end']):
+                routine_counts['already_instrumented'] += 1
+                continue
+
+            # if it is an ignore function, dont' insert write(*,*) statements
+            # if in an interface section, don't insert write statements
+            if ignored or routine['in_interface']:
+                skipped.add(key)
+                routine_counts['ignored' if ignored else 'in_interface'] += 1
+                continue
+            routine_counts['instrumented'] += 1
+            if insert_format != 'write' and symbols is not None:
+                symbols.append([rid, routine['first_line'].split('(', 1)[0],
+                                routine['start'] + 1])
+
+            dtext, stext, etext = throttle_texts(stext, etext, throttle,
+                                                 position, threads)
+
+            # insert write(*,*) at start of routine, but not before the end
+            # of its declarations, and any throttle declaration at the end
+            # of them (before the write(*,*) if they are at the same line)
+            istart = max(routine['header_end'], routine['spec_end'])
+            insertions.setdefault(istart, []).insert(0, stext)
+            if dtext:
+                declarations = insertions.setdefault(routine['spec_end'], [])
+                declarations.insert(0, dtext)
+
+            # inserts write(*,*) at end of routine but before 'contains'
+            # (or straight after it, if the start write(*,*) is after it)
+            icontain = routine['contains']
+            if icontain is not None and istart > icontain:
+                insertions.setdefault(icontain + 1, []).insert(0, etext)
+            elif icontain is not None:
+                insertions.setdefault(icontain, []).append(etext)
+            else:
+                insertions.setdefault(routine['end'], []).append(etext)
+
+        return insertions
+
+    def modify_original_file(original, f_short):
         """
         returns modified original_file
         """
-        subdata = get_subroutine_data(f_nospaces, f_short)
-        first_lines, last_lines, stexts, etexts = subdata
-
-        routines = [l.split('(', 1)[0] for l in first_lines]
-        modified_file = original.copy()
-
-        nospaces = [l.strip().lower() for l in modified_file]
-
-        # a and b are indices of start and end of routine
-        for a, b, stext, etext in zip(first_lines, last_lines, stexts, etexts):
-            modified_file = write_one_subroutine(modified_file, nospaces,
-                                                 a, b, stext, etext)
-
-        return modified_file
+        with timed_stage(stats, 'parse'):
+            index = index_fortran_lines(original)
+        with timed_stage(stats, 'insert'):
+            insertions = get_insertions(index, f_short)
+            return merge_insertions(original, insertions)
 
     def write_to_file(output_file, modified_original):
         """
@@ -192,109 +219,508 @@ def modify_fortran_file(input_file, output_file=None, ignore_functions=[],
         outFile.writelines(modified_original)
         outFile.close()
 
+    if insert_format not in insert_formats:
+        raise ValueError('insert_format must be one of {}'.format(
+            insert_formats))
+    check_throttle(throttle)
+    routine_counts = {'instrumented': 0, 'ignored': 0, 'in_interface': 0,
+                      'no_end': 0, 'already_instrumented': 0,
+                      'duplicate': 0}
+    if stats is not None:
+        stats.setdefault('stages', {})
+
     # runs all the functions
-    original_file, f_nospaces, f_short = read_initial_file(input_file)
-    mod_original = modify_original_file(original_file, f_nospaces, f_short)
+    with timed_stage(stats, 'read'):
+        original_file, f_short = read_initial_file(input_file)
+    mod_original = modify_original_file(original_file, f_short)
+    if stats is not None:
+        stats['lines'] = len(original_file)
+        stats['bytes_read'] = os.path.getsize(input_file)
+        stats['routines'] = routine_counts
     if write:
-        write_to_file(output_file, mod_original)
+        with timed_stage(stats, 'write'):
+            write_to_file(output_file, mod_original)
     else:
         return mod_original
 
 
-def modify_mesa_terminal_output(input_file, output_file, i_ignore=2,
-                                files=[]):
+def modify_mesa_terminal_output(input_file, output_file, i_ignore='auto',
+                                files=[], counts_file=None,
+                                symbols_file=None, aggregate=False,
+                                workers=1, stats=False):
     """
     Input:
-    - input_file: output text file from mesa run with write(*,*) statements
-    - output_file: modified version of the output file to write to
+    - input_file: output text file from mesa run with write(*,*) statements.
+      Can also be an open file object, or '-' to read from stdin
+    - output_file: modified version of the output file to write to. Can
+      also be an open file object, or '-' to write to stdout
     - i_ignore: integer all routines which occur more than this many times
       will be ignored in the output_file. This is to remove routines which
       occur hundreds of times are uninteresting and just minor check routines.
+      If None, no routines are ignored. 'auto' (default) is 2, or None with
+      aggregate.
     - files: if files is not empty, only routines/functions come from files in
       this list will be included in output_file.
-
-    Returns: None
+    - counts_file: optional json file to save the number of times each
+      routine occurs in input_file. If it already holds the counts for the
+      current input_file they are loaded instead of re-counted, so
+      re-running with different i_ignore or files is quicker.
+    - symbols_file: if given, input_file is a binary trace from a run
+      instrumented with insert_format='id' (e.g. pfr_trace.bin), and this
+      is the symbol table used to decode it (pfr_symbols.json, or the
+      mesa_dir_print directory containing it)
+    - aggregate: if True, output_file is a call tree instead of one line per
+      call. All the calls with the same call path are merged into one line
+      with the number of calls, so routines which are called many times
+      are summarised rather than having to be ignored with i_ignore, which
+      keeps every routine unless it is given.
+    - workers: number of processes used to read the log. 1 (default) reads
+      it in this process, None uses one process per CPU. With more than
+      one, a log on disk is memory-mapped and split into chunks which are
+      processed in parallel (see parallel.py). The output is the same.
+    - stats: if True, returns statistics of the run (see stats.py). Can
+      also be a function, which is called with (stage, seconds) as each
+      stage finishes.
+
+    Returns: None, or if stats is given a dictionary with
+    - 'stages': seconds spent to 'count' the lines, pair up and 'nest'
+      them, 'aggregate' them into a call tree and 'write' the output
+    - 'lines': number of start/finsh lines 'read' from the log (None if
+      not known), 'kept' after i_ignore and files, 'filtered' out and
+      'written' to output_file
+    - 'bytes_read': size of input_file, None if it isn't a file on disk
+    - 'bytes_written': size of the output
 
     Purpose: takes in mesa terminal output from the write(*,*) statements
     and modifies and tabs in to make it legible and easy to understand.
+    The log is streamed rather than read into memory, so it can be much
+    larger than the available RAM. Output is written as it is produced.
+    """
+    def get_counts(read_lines):
+        # number of times each routine occurs, from counts_file if possible
+        with timed_stage(run_stats, 'count', hook):
+            return load_or_count(read_lines)
+
+    def load_or_count(read_lines):
+        trace_counts = None
+        if i_ignore is None:
+            return None  # not needed
+        if counts_file:
+            trace_counts = load_trace_counts(counts_file, input_file)
+        if trace_counts is not None:
+            return trace_counts
+        if in_parallel:
+            trace_counts = parallel_count_trace_lines(input_file, workers)
+        else:
+            trace_counts = count_trace_lines(read_lines())
+        if counts_file:
+            save_trace_counts(trace_counts, counts_file, input_file)
+        return trace_counts
+
+    def counted_reader(read_lines):
+        # records the number of lines in each pass over the log
+        def read():
+            n = 0
+            for line in read_lines():
+                n += 1
+                yield line
+            line_counts['read'] = n
+        return read
+
+    def counted_events(events):
+        # records the number of lines kept
+        line_counts['kept'] = 0
+        for event in events:
+            line_counts['kept'] += 1
+            yield event
+
+    def counted_output(lines):
+        # records the number of lines and bytes written
+        line_counts['written'] = 0
+        run_stats['bytes_written'] = 0
+        for text in lines:
+            line_counts['written'] += text.count('\n')
+            run_stats['bytes_written'] += len(text)
+            yield text
+
+    def aggregate_timed(events):
+        # time to build the call tree, not counting the time to nest lines
+        start = time.perf_counter()
+        root = aggregate_trace_events(timed_iter(events, run_stats, 'nest',
+                                                 hook))
+        if run_stats is not None:
+            add_stage_time(run_stats, 'aggregate',
+                           time.perf_counter() - start -
+                           run_stats['stages']['nest'], hook)
+        return root
+
+    i_ignore = resolve_i_ignore(i_ignore, aggregate)
+    run_stats, hook = new_stats(stats)
+    line_counts = {'read': None, 'kept': None, 'filtered': None,
+                   'written': None}
+
+    # chunks of the log can only be read in parallel from a file on disk
+    in_parallel = (workers != 1 and symbols_file is None and
+                   isinstance(input_file, (str, os.PathLike)) and
+                   input_file != '-')
+
+    # read file & modify lines & write to file, one line at a time
+    if symbols_file is None:
+        read_lines = trace_reader(input_file)
+    else:
+        read_lines = compact_trace_reader(input_file, symbols_file)
+    trace_counts = get_counts(read_lines)
+    if run_stats is not None and trace_counts is not None:
+        line_counts['read'] = sum(trace_counts['counts'].values())
+    elif run_stats is not None:
+        read_lines = counted_reader(read_lines)
+
+    if aggregate and in_parallel:
+        events = parallel_nest_trace_events(
+            input_file, i_ignore=i_ignore, files=files,
+            trace_counts=trace_counts, workers=workers)
+    elif aggregate:
+        events = nest_trace_events(read_lines, i_ignore=i_ignore,
+                                   files=files, trace_counts=trace_counts)
+    elif in_parallel:
+        modified = parallel_nest_trace(input_file, i_ignore=i_ignore,
+                                       files=files, trace_counts=trace_counts,
+                                       workers=workers)
+    else:
+        modified = nest_trace(read_lines, i_ignore=i_ignore, files=files,
+                              trace_counts=trace_counts)
+    if aggregate and run_stats is not None:
+        modified = call_tree_lines(aggregate_timed(counted_events(events)))
+    elif aggregate:
+        modified = call_tree_lines(aggregate_trace_events(events))
+    elif run_stats is not None:
+        modified = timed_iter(modified, run_stats, 'nest', hook)
+
+    if run_stats is None:
+        write_output_lines(output_file, modified)
+        return None
+
+    # time to write the output, not counting the time to make it
+    start = time.perf_counter()
+    write_output_lines(output_file, counted_output(modified))
+    nest_time = 0.0 if aggregate else run_stats['stages']['nest']
+    add_stage_time(run_stats, 'write', time.perf_counter() - start -
+                   nest_time, hook)
+    if not aggregate:
+        line_counts['kept'] = line_counts['written']
+    if line_counts['read'] is not None:
+        line_counts['filtered'] = line_counts['read'] - line_counts['kept']
+    run_stats['lines'] = line_counts
+    run_stats['bytes_read'] = trace_source_size(input_file)
+    return run_stats
+
+
+def modify_mesa_terminal_views(input_file, views, symbols_file=None):
     """
-    separator = '\t\t'  # how much to tab in by
+    Input:
+    - input_file: output text file from mesa run, as for
+      modify_mesa_terminal_output
+    - views: list of dictionaries, one for each output to write, with
+      - 'output_file': as for modify_mesa_terminal_output
+      - 'i_ignore', 'files', 'aggregate': optional, as for
+        modify_mesa_terminal_output ('auto', [] and False by default)
+    - symbols_file: as for modify_mesa_terminal_output
 
-    def read_initial_file(filename):
-        inputFile = open(filename, "r+")
-        original_file = inputFile.readlines()
-        inputFile.close()
-        return original_file
+    Returns: None
 
-    def get_finish_index(mstrip, i, finish_name):
-        # gets index that function finishes at
-        if mstrip[i][:5] == 'start' and finish_name in mstrip[i:]:
-            return i + mstrip[i:].index(finish_name)
+    Purpose: writes several views of the same log, e.g. with different
+    files and i_ignore, from a single read of it. The log is read, stripped
+    and counted once, and kept as a temporary file of 4 byte IDs, one per
+    distinct line (see spool_trace_ids). Each view then works out once
+    which IDs it keeps and reads the IDs back, so extra views cost much
+    less than reading the log again. Each output is the same as from
+    modify_mesa_terminal_output with the same settings.
+    """
+    for view in views:
+        unknown = set(view) - set(view_options)
+        if unknown:
+            raise ValueError('unknown view settings {}, must be in {}'.format(
+                sorted(unknown), view_options))
+        if 'output_file' not in view:
+            raise ValueError('every view needs an output_file')
+
+    if symbols_file is None:
+        read_lines = trace_reader(input_file)
+    else:
+        read_lines = compact_trace_reader(input_file, symbols_file)
+
+    with tempfile.TemporaryFile() as spool:
+        distinct, counts = spool_trace_ids(read_lines(), spool)
+        for view in views:
+            aggregate = view.get('aggregate', False)
+            keep = keep_trace_ids(distinct, counts, resolve_i_ignore(
+                view.get('i_ignore', 'auto'), aggregate),
+                view.get('files', []))
+            events = nest_kept_events(view_trace_lines(spool, distinct,
+                                                       keep))
+            if aggregate:
+                modified = call_tree_lines(aggregate_trace_events(events))
+            else:
+                modified = tabbed_trace_lines(events)
+            write_output_lines(view['output_file'], modified)
+
+
+def modify_mesa_thread_output(input_file, output_file, i_ignore='auto',
+                              files=[], symbols_file=None, aggregate=False,
+                              activity_file=None):
+    """
+    Input:
+    - input_file: output text file from a mesa run instrumented with
+      threads=True, as for modify_mesa_terminal_output. With symbols_file,
+      pfr_thread.bin from a run with insert_format='id' and threads=True.
+    - output_file: as for modify_mesa_terminal_output. Each thread's output
+      is written in turn after a line '== thread 0 ==' (and so on). If it
+      is a filename containing '{thread}', each thread is written to its
+      own file instead, e.g. 'routines_{thread}.txt'.
+    - i_ignore, files, aggregate: as for modify_mesa_terminal_output, with
+      the number of times a routine occurs counted separately on each
+      thread
+    - symbols_file: as for modify_mesa_terminal_output
+    - activity_file: optional file to write a table of the number of calls
+      of each routine on each thread to, or '-' for stdout
+
+    Returns: dictionary of routine, e.g. 'subroutine foo -- foo.f90' ->
+    dictionary of thread -> number of calls
+
+    Purpose: takes in the output of a run using several OpenMP threads
+    and nests each thread's routines with its own call stack, so routines
+    running at the same time on other threads aren't nested inside each
+    other. The log is read once and split into a temporary file for each
+    thread (see threads.py), which then goes through the same steps as
+    with modify_mesa_terminal_output.
+    """
+    def thread_lines(spool):
+        events = nest_trace_events(trace_reader(spool), i_ignore=i_ignore,
+                                   files=files)
+        if aggregate:
+            return call_tree_lines(aggregate_trace_events(events))
+        return tabbed_trace_lines(events)
+
+    def all_thread_lines(spools):
+        for thread in sorted(spools):
+            yield '== thread {} ==\n'.format(thread)
+            yield from thread_lines(spools[thread])
+
+    i_ignore = resolve_i_ignore(i_ignore, aggregate)
+    spools, activity = spool_thread_lines(thread_trace_lines(input_file,
+                                                             symbols_file))
+    try:
+        if isinstance(output_file, str) and '{thread}' in output_file:
+            for thread in sorted(spools):
+                write_output_lines(output_file.format(thread=thread),
+                                   thread_lines(spools[thread]))
         else:
-            return -9
-
-    def remove_ignore(modified):
-        ignore_functions = dict(Counter(modified))
-        return [l for l in modified if ignore_functions[l] < i_ignore]
-
-    def modify_original_file(original_file):
-        '''
-        Modifies original file
-        '''
-        modified = original_file.copy()
-
-        # which functions to choose / ignore
-        modified = [l.strip() for l in modified]
-        starting = ('start', 'finsh')  # consider only lines beginning with
-        modified = [x for x in modified if x.startswith(starting)]
-        modified = [m.strip() for m in modified]
-        modified = remove_ignore(modified)
-        if files:
-            modified = [x for x in modified
-                        if x.endswith(tuple(files))]
-
-        # to look for finished pairs
-        finish_names = ['finsh' + x[5:] if x[:5] == 'start' else False
-                        for x in modified]
-
-        # gap until finish for each start function
-        indexlist = [get_finish_index(modified, i, x) for i, x in
-                     enumerate(finish_names)]
-        # indices for start and end of tabbed regions
-        start_indxs = [i for i, val in enumerate(indexlist) if val != -9]
-        end_indxs = [x for x in indexlist if x != -9]
-
-        # does all the tabbing
-        tab_amounts = [0] * len(indexlist)
-        for i, val in enumerate(indexlist):
-            if val != -9:
-                tab_amounts[i] = sum(x > val for x in indexlist[:i])
-        # tabs in statements without matching start/finish
-        for i, val in reversed(list(enumerate(indexlist))):
-            if val == -9:
-                try:
-                    tab_amounts[i] = tab_amounts[i+1]
-                except IndexError:
-                    tab_amounts[i] = 0
-
-        # make sure finish statements are tabbed the same as start statements
-        for start, end in zip(start_indxs, end_indxs):
-            tab_amounts[end] = tab_amounts[start]
-
-        modified = [n*separator + m for n, m in zip(tab_amounts, modified)]
-        modified = [x + '\n' for x in modified]
-        return modified
-
-    def write_to_file(output_file, modified):
-        # write modified_original to file
-        outFile = open(output_file, 'w')
-        outFile.writelines(modified_original)
-        outFile.close()
+            write_output_lines(output_file, all_thread_lines(spools))
+    finally:
+        for spool in spools.values():
+            spool.close()
+    if activity_file is not None:
+        write_output_lines(activity_file, thread_activity_lines(activity))
+    return activity
+
+
+def follow_mesa_terminal_output(input_file, output_file, i_ignore=None,
+                                files=[], aggregate=False, interval=10,
+                                poll_interval=0.5, idle_timeout=None):
+    """
+    Input:
+    - input_file: output text file of a mesa run which is still going (e.g.
+      from ./rn >& output.txt), or '-' to read from stdin, e.g. a pipe from
+      ./rn 2>&1, so that the raw output never has to be saved
+    - output_file: file to write the tabbed output to, or '-' for stdout
+    - i_ignore: if not None, only the first i_ignore - 1 calls of each
+      routine are shown, as the number of calls in the whole run isn't
+      known yet. None by default, so with aggregate the call tree counts
+      every call.
+    - files: as for modify_mesa_terminal_output
+    - aggregate: if True, output_file is the call tree so far (as for
+      modify_mesa_terminal_output), re-written every interval seconds and
+      at the end. With '-', each call tree is written to stdout after a
+      blank line.
+    - interval: seconds between call trees with aggregate. Otherwise the
+      output is written as soon as there is nothing more to read, and at
+      least every interval seconds.
+    - poll_interval: seconds to wait before looking for more of the file
+    - idle_timeout: stop once input_file hasn't grown for this many
+      seconds. If None, carry on until interrupted (e.g. with Ctrl-C). A
+      pipe is read until it is closed.
 
-    # read file & modify list & write to file
-    original_file = read_initial_file(input_file)
-    modified_original = modify_original_file(original_file)
-    write_to_file(output_file, modified_original)
+    Returns: None
+
+    Purpose: tabs in the start/finsh lines as MESA writes them, so long
+    runs can be watched and the log doesn't have to be kept. Memory use
+    depends on the number of open routines and distinct routines (and the
+    distinct call paths with aggregate), not on the length of the run.
+    Lines which don't pair up can be tabbed in differently from
+    modify_mesa_terminal_output, see follow.py.
+    """
+    def write_tree():
+        lines = call_tree_lines(root)
+        if output_file == '-':
+            sys.stdout.write('\n')
+            sys.stdout.writelines(lines)
+            sys.stdout.flush()
+            return
+        # so the call tree can be read at any time while it is re-written
+        with open(output_file + '.tmp', 'w') as f:
+            f.writelines(lines)
+        os.replace(output_file + '.tmp', output_file)
+
+    state = new_live_state()
+    root = [0, {}]
+    path = [root]  # nodes of the routines open at each depth
+    out = None
+    if not aggregate:
+        out = sys.stdout if output_file == '-' else open(output_file, 'w')
+    last_write = time.monotonic()
+    try:
+        for lines in follow_trace_blocks(input_file, poll_interval,
+                                         idle_timeout):
+            if lines is None:
+                # a new run, so no routines are open
+                state = new_live_state()
+                del path[1:]
+                continue
+            events = live_nest_events(state, lines, i_ignore, files)
+            if aggregate:
+                for n, line in events:
+                    add_trace_event(path, n, line)
+            else:
+                out.writelines(tabbed_trace_lines(events))
+
+            now = time.monotonic()
+            due = now - last_write >= interval
+            idle = not lines or (input_file == '-' and
+                                 not input_ready(input_file))
+            if aggregate and due:
+                write_tree()
+                last_write = now
+            elif not aggregate and (idle or due):
+                out.flush()
+                last_write = now
+    finally:
+        if aggregate:
+            write_tree()
+        elif out is sys.stdout:
+            out.flush()
+        else:
+            out.close()
+
+
+def resolve_i_ignore(i_ignore, aggregate):
+    """
+    returns i_ignore to use for i_ignore='auto': default_i_ignore, or None
+    (every routine is kept) for a call tree with aggregate, which
+    summarises the routines called many times rather than dropping them
+    """
+    if i_ignore == 'auto':
+        return None if aggregate else default_i_ignore
+    return i_ignore
+
+
+def trace_source_size(input_file):
+    """
+    returns size in bytes of input_file, or None if it is not a file on disk
+    """
+    if not isinstance(input_file, (str, os.PathLike)) or input_file == '-':
+        return None
+    return os.path.getsize(input_file)
+
+
+def write_output_lines(output_file, lines):
+    """
+    writes lines to output_file as they are produced. output_file can be a
+    filename, an open file object, or '-' for stdout
+    """
+    if output_file == '-':
+        sys.stdout.writelines(lines)
+    elif isinstance(output_file, (str, os.PathLike)):
+        with open(output_file, 'w') as outFile:
+            outFile.writelines(lines)
+    else:
+        output_file.writelines(lines)
+
+
+def profile_mesa_trace(input_file, symbols_file, output_file=None,
+                       collapsed_file=None, sort='exclusive'):
+    """
+    Input:
+    - input_file: trace from a mesa run instrumented with
+      insert_format='time' (pfr_time.bin, or pfr_time_thread.bin with
+      threads=True). Can also be an open binary file object, or '-' to
+      read from stdin
+    - symbols_file: symbol table written by write_mesa_routines
+      (pfr_symbols.json), or the mesa_dir_print directory containing it
+    - output_file: optional file to write a table of the number of calls,
+      inclusive and exclusive time of each routine to, followed by a table
+      for each thread if there is more than one. Can also be an open file
+      object, or '-' to write to stdout
+    - collapsed_file: optional file to write the time spent in each call
+      stack to, in the collapsed format read by flame graph tools
+    - sort: column the table is sorted by: 'exclusive', 'inclusive',
+      'calls' or 'unmatched'
+
+    Returns: profile dictionary from profile_time_trace, with 'routines',
+    'threads', 'stacks' and 'total' time
+
+    Purpose: uses the timestamps recorded on entry and exit of every
+    routine to find where the time goes, e.g. the hot routines in
+    star/private during a timestep, without an external profiler.
+    """
+    profile = profile_time_trace(input_file, symbols_file)
+    if output_file is not None:
+        write_output_lines(output_file, profile_report_lines(profile, sort))
+    if collapsed_file is not None:
+        write_output_lines(collapsed_file, collapsed_stack_lines(profile))
+    return profile
+
+
+def write_trace_store(input_file, store_dir, symbols_file=None,
+                      rebuild=False):
+    """
+    Input:
+    - input_file: output text file from mesa run, as for
+      modify_mesa_terminal_output
+    - store_dir: directory to write the store to (e.g. output.pfr next to
+      output.txt), made if needed
+    - symbols_file: as for modify_mesa_terminal_output
+    - rebuild: if False, a store in store_dir which was made from the
+      current input_file (same size and modification time) is used as it
+      is rather than being written again
+
+    Returns: store dictionary from open_trace_store, to pass to the queries
+    in store.py
+
+    Purpose: turns the log into columns of integers with one row per call
+    (routine, depth, parent, end of its subtree, and positions of its start
+    and finish lines), along with an index of the calls to each routine.
+    Questions about the run, e.g. what ran under the fifth call of
+    do_evolve_step_part1, which calls were running between two lines of
+    the log, or where two runs took different paths, are then answered
+    from the columns without reading the log again. The log is read twice
+    and streamed, and the store can be re-opened later with
+    open_trace_store, which memory-maps it and doesn't depend on the
+    length of the run.
+    """
+    source = trace_source_stamp(input_file)
+    if symbols_file is not None:
+        source = None  # the symbol table could have changed too
+    meta = load_store_meta(store_dir)
+    if (not rebuild and meta is not None and source is not None
+            and meta['source'] == source):
+        return open_trace_store(store_dir)
+
+    if symbols_file is None:
+        read_lines = trace_reader(input_file)
+    else:
+        read_lines = compact_trace_reader(input_file, symbols_file)
+    build_trace_store(read_lines, store_dir, source)
+    return open_trace_store(store_dir)
 
 
 def all_mesa_f_files(mesa_dir):
@@ -359,8 +785,53 @@ def basic_mesa_f_files(mesa_dir):
     return basic_files
 
 
+def try_modify_fortran_file(input_file, file_id=0, ignore_functions=[],
+                            insert_format='write', throttle=None,
+                            threads=False, stats=False):
+    """
+    Returns: (modified lines, symbols, None, file stats), or (None, None,
+    error message, None) if modify_fortran_file fails for input_file.
+    symbols is the list of [routine ID, routine, line] for insert_format
+    'id' or 'time'. file stats are the stats from modify_fortran_file if
+    stats is True, otherwise None.
+
+    Purpose: lets write_mesa_routines carry on with the other files when
+    one file can't be read or modified. Defined at module level so it can
+    be sent to worker processes.
+    """
+    symbols = []
+    file_stats = {} if stats else None
+    try:
+        return modify_fortran_file(input_file,
+                                   ignore_functions=ignore_functions,
+                                   write=False, insert_format=insert_format,
+                                   file_id=file_id, symbols=symbols,
+                                   throttle=throttle, threads=threads,
+                                   stats=file_stats), \
+            symbols, None, file_stats
+    except Exception as e:
+        return None, None, '{}: {}'.format(type(e).__name__, e), None
+
+
+def mesa_modules(filenames, mesa_dir):
+    """
+    Returns sorted list of the MESA modules (e.g. 'eos', 'net', 'star')
+    which filenames within mesa_dir belong to, i.e. the libraries which
+    need to be recompiled when they change. Files in mesa_dir/include are
+    compiled as part of the work directory, so these give 'work'.
+    """
+    modules = set()
+    for x in filenames:
+        module = x.split(mesa_dir)[-1].strip('/').split('/')[0]
+        modules.add('work' if module == 'include' else module)
+    return sorted(modules)
+
+
 def write_mesa_routines(mesa_dir, mesa_dir_print, files='main', reset=True,
-                        ignore_functions=['subroutine check']):
+                        ignore_functions=['subroutine check'], workers=1,
+                        cache=True, cache_size=5000, dry_run=False,
+                        previous_files=None, insert_format='write',
+                        throttle=None, threads=False, stats=False):
     '''
     Input:
     - mesa_dir: directory of current installation of MESA
@@ -376,6 +847,66 @@ def write_mesa_routines(mesa_dir, mesa_dir_print, files='main', reset=True,
                         ignored when going through file. Suggested example
                         ['subroutine check'] for MESA as these subroutines are
                         probably not the ones you are looking for.
+    - workers: number of processes used to modify the files. 1 (default)
+               modifies them one after another in this process, None uses
+               one process per CPU. Files are always written by this
+               process, in the same order as files.
+    - reset: if True, files in mesa_dir_print which were instrumented by
+             earlier runs but aren't in files are copied back from
+             mesa_dir. Only the files recorded as instrumented in the
+             manifest (.pfr_cache.json in mesa_dir_print) are looked at.
+             If there is no record yet, or reset='full', every MESA file
+             is compared with the original instead.
+    - cache: if True, files whose source, settings and output haven't
+             changed since the last run are skipped without being parsed
+             or compared, using the manifest in mesa_dir_print.
+    - cache_size: maximum number of files in the manifest. The least
+                  recently used ones are dropped when there are more.
+    - dry_run: if True, work out which files would change but don't write
+               or reset anything (see also plan_mesa_routines)
+    - previous_files: the files instrumented last time, in the same form
+                      as files. These are the ones reset if they aren't in
+                      files. If None, the record in the manifest is used.
+    - insert_format: 'write' (default) inserts write(*,*) statements.
+                     'id' inserts call pfr_trace(id) with integer routine
+                     IDs instead, and writes the symbol table
+                     pfr_symbols.json and the Fortran trace module
+                     pfr_trace.f90 to mesa_dir_print (see compact.py).
+                     'time' is the same but also records the time spent
+                     in each routine, for profile_mesa_trace.
+    - throttle: None (default) traces every call of every routine.
+                ('first', n), ('every', n) or ('sample', rate) only traces
+                the first n calls, every nth call or a fraction rate of
+                the calls of each routine, counted in the instrumented
+                code itself, so frequently called routines cost almost
+                nothing at runtime and long runs can be traced (see
+                throttle.py).
+    - threads: if True, every event also records the OpenMP thread it
+               was on, so runs with OMP_NUM_THREADS > 1 can be traced
+               (see threads.py). The Fortran trace module pfr_trace.f90 is
+               written to mesa_dir_print for every insert_format, and
+               must be compiled with MESA.
+    - stats: if True, the summary also has 'stats' of the run (see
+             stats.py). Can also be a function, which is called with
+             (stage, seconds) as each stage finishes.
+
+    Returns: dictionary with lists of the output files which were
+    'changed' (re-written), 'unchanged' and 'reset', 'errors', a
+    dictionary of input file -> error message for files which couldn't be
+    modified, 'cache', the number of cache 'hits', 'misses' and 'evicted'
+    entries, and 'modules', the MESA modules which need to be recompiled
+    (see mesa_modules). With dry_run, 'changed' and 'reset' are the files
+    which would change. An error in one file doesn't stop the others being
+    modified. With stats, 'stats' has
+    - 'stages': seconds spent to 'discover' the files, check the 'cache',
+      'modify' them (in the worker processes if there are any), 'write'
+      them, 'reset' other files and 'save' the manifest and symbol table
+    - 'files': dictionary of input file -> stats from modify_fortran_file,
+      for the files which were modified
+    - 'routines': number of routines instrumented or passed over, added up
+      over all of the files (see modify_fortran_file)
+    - 'bytes_read': size of the files modified and of the outputs compared
+      with them, 'bytes_written': size of the files written and reset
 
     This script applies modify_fortran_file to files in
     a MESA directory. This insert write statements to .f and .f90 files in
@@ -389,45 +920,260 @@ def write_mesa_routines(mesa_dir, mesa_dir_print, files='main', reset=True,
     with different combinations of files_to_modify.
     Also if reset = True, files that contain write(*,*) statements but
     are not in files_to_modify are reset to their original state (i.e.
-    overwritten with the default file)
+    overwritten with the default file). Files are copied within python
+    rather than by calling cp for each one.
     '''
 
+    if insert_format not in insert_formats:
+        raise ValueError('insert_format must be one of {}'.format(
+            insert_formats))
+    check_throttle(throttle)
+    summary = {'changed': [], 'unchanged': [], 'reset': [], 'errors': {},
+               'cache': {'hits': 0, 'misses': 0, 'evicted': 0}}
+    run_stats, hook = new_stats(stats)
+    if run_stats is not None:
+        run_stats.update({'files': {}, 'routines': {}, 'bytes_read': 0,
+                          'bytes_written': 0})
+        summary['stats'] = run_stats
+
+    def modified_files(input_filenames, file_ids):
+        """
+        returns iterator over (modified lines, symbols, error, file stats)
+        for each input file, in the same order as input_filenames
+        """
+        modify = partial(try_modify_fortran_file,
+                         ignore_functions=ignore_functions,
+                         insert_format=insert_format,
+                         throttle=throttle, threads=threads,
+                         stats=run_stats is not None)
+        if workers == 1 or len(input_filenames) < 2:
+            yield from map(modify, input_filenames, file_ids)
+            return
+
+        # a few chunks per process so that slow files even out
+        n_workers = workers or os.cpu_count() or 1
+        chunksize = max(1, len(input_filenames) // (4 * n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            yield from executor.map(modify, input_filenames, file_ids,
+                                    chunksize=chunksize)
+
     def modify_specific(files_to_modify):
         """
         Modifies list of files as described in docs above.
         """
-        input_filenames = files_to_modify
+        input_filenames = list(files_to_modify)
         output_filenames = [mesa_dir_print + x.split(mesa_dir)[-1]
                             for x in input_filenames]
-        all_files = all_mesa_f_files(mesa_dir)
-        all_files_print = [mesa_dir_print + x.split(mesa_dir)[-1]
-                           for x in all_files]
 
-        for i, o in zip(input_filenames, output_filenames):
-            with open(o, "r+") as f:
-                original_file = f.readlines()
-                modified_original = modify_fortran_file(
-                                    i,
-                                    ignore_functions=ignore_functions,
-                                    write=False)
+        # files which are already up to date according to the cache
+        with timed_stage(run_stats, 'cache', hook):
+            manifest, keys, file_ids, to_modify = check_cache(
+                input_filenames, output_filenames)
+
+        results = modified_files([i for i, o in to_modify],
+                                 [file_ids[o] for i, o in to_modify])
+        results = timed_iter(results, run_stats, 'modify', hook)
+        start = time.perf_counter()
+        for (modified_original, routines, error, file_stats), (i, o) in zip(
+                results, to_modify):
+            if error is not None:
+                summary['errors'][i] = error
+                continue
+            if symbols is not None:
+                symbols['files'][o.split(mesa_dir_print)[-1]]['routines'] = \
+                    routines
+            if file_stats is not None:
+                run_stats['files'][i] = file_stats
+                add_counts(run_stats['routines'], file_stats['routines'])
+                run_stats['bytes_read'] += file_stats['bytes_read']
+            try:
+                with open(o, "r+") as f:
+                    original_file = f.readlines()
                 if not original_file == modified_original:
-                    outFile = open(o, 'w')
-                    outFile.writelines(modified_original)
-                    outFile.close()
-
-        if reset:
-            for i, o in zip(all_files, all_files_print):
-                if o not in output_filenames and not filecmp.cmp(i, o):
-                    subprocess.call(['cp', i, o])
-
-    # Maps between files keyword and function to get them
-    file_key = {'all': all_mesa_f_files,
-                'lib': lib_mesa_f_files,
-                'star': star_mesa_f_files,
-                'basic': basic_mesa_f_files}
-    try:
-        fortran_files = file_key[files](mesa_dir)
-    except KeyError:
-        fortran_files = files
+                    if not dry_run:
+                        outFile = open(o, 'w')
+                        outFile.writelines(modified_original)
+                        outFile.close()
+                    summary['changed'].append(o)
+                else:
+                    summary['unchanged'].append(o)
+            except OSError as e:
+                summary['errors'][i] = '{}: {}'.format(type(e).__name__, e)
+                continue
+            if run_stats is not None:
+                run_stats['bytes_read'] += sum(map(len, original_file))
+                if o in summary['changed'] and not dry_run:
+                    run_stats['bytes_written'] += os.path.getsize(o)
+            if cache:
+                add_to_cache(manifest, o.split(mesa_dir_print)[-1], keys[o],
+                             o)
+            else:
+                manifest['entries'].pop(o.split(mesa_dir_print)[-1], None)
+        if run_stats is not None:
+            # time to compare & write the files, not counting modifying them
+            add_stage_time(run_stats, 'write', time.perf_counter() - start -
+                           run_stats['stages']['modify'], hook)
+
+        # reset files left instrumented by earlier runs
+        with timed_stage(run_stats, 'reset', hook):
+            instrumented = reset_specific(output_filenames, manifest)
+
+        summary['modules'] = mesa_modules(summary['changed'] +
+                                          summary['reset'], mesa_dir_print)
+        if dry_run:
+            return
+
+        # remember which files are instrumented for the next reset
+        with timed_stage(run_stats, 'save', hook):
+            if instrumented is not None:
+                names = [o.split(mesa_dir_print)[-1]
+                         for o in output_filenames]
+                manifest['instrumented'] = sorted(set(instrumented + names))
+            summary['cache']['evicted'] = save_manifest(
+                mesa_dir_print, manifest, max_entries=cache_size)
+            if symbols is not None:
+                save_symbols(mesa_dir_print, symbols)
+            elif threads:
+                save_trace_module(mesa_dir_print)
+
+    def check_cache(input_filenames, output_filenames):
+        """
+        Returns: (manifest, dictionary of output file -> cache key,
+        dictionary of output file -> file ID, list of (input file, output
+        file) which aren't already up to date)
+        """
+        manifest = load_manifest(mesa_dir_print)
+        keys = {}
+        file_ids = {}
+        to_modify = []
+        for i, o in zip(input_filenames, output_filenames):
+            name = o.split(mesa_dir_print)[-1]
+            # the file ID, throttle and threads are part of the inserted
+            # text, so also of the key
+            file_ids[o] = 0
+            key_format = insert_format
+            if symbols is not None:
+                file_ids[o] = file_id(symbols, name)
+                key_format = '{}:{}'.format(insert_format, file_ids[o])
+            if throttle is not None:
+                key_format = '{}:{}:{}'.format(key_format, *throttle)
+            if threads:
+                key_format += ':threads'
+            if cache:
+                keys[o] = cache_key(i, __version__, ignore_functions,
+                                    key_format)
+                if is_cached(manifest, name, keys[o], o) and \
+                        (symbols is None or
+                         'routines' in symbols['files'][name]):
+                    summary['unchanged'].append(o)
+                    summary['cache']['hits'] += 1
+                    continue
+                summary['cache']['misses'] += 1
+            to_modify.append((i, o))
+        return manifest, keys, file_ids, to_modify
+
+    def reset_specific(output_filenames, manifest):
+        """
+        Resets the files left instrumented by earlier runs which aren't in
+        output_filenames, as described in docs above. Returns the files
+        which are still instrumented, or None if not known.
+        """
+        instrumented = manifest.get('instrumented')
+        if previous_files is not None:
+            instrumented = [x.split(mesa_dir)[-1]
+                            for x in get_files(previous_files)]
+        modified_outputs = set(output_filenames)
+        if reset == 'full' or (reset and instrumented is None):
+            instrumented = reset_files(all_mesa_f_files(mesa_dir),
+                                       modified_outputs, manifest)
+        elif reset:
+            instrumented = reset_files([mesa_dir + x for x in instrumented],
+                                       modified_outputs, manifest)
+        return instrumented
+
+    def reset_files(input_filenames, modified_outputs, manifest):
+        """
+        Copies original MESA files over the files in mesa_dir_print which
+        are not in modified_outputs, unless they are already the same (so
+        their timestamps don't change and they aren't recompiled). Returns
+        the files which couldn't be reset.
+        """
+        failed = []
+        for i in input_filenames:
+            name = i.split(mesa_dir)[-1]
+            o = mesa_dir_print + name
+            if o in modified_outputs:
+                continue
+            try:
+                if filecmp.cmp(i, o):
+                    continue
+                if not dry_run:
+                    copy_original(i, o)
+                    if run_stats is not None:
+                        run_stats['bytes_written'] += os.path.getsize(o)
+            except OSError as e:
+                summary['errors'][i] = '{}: {}'.format(type(e).__name__, e)
+                failed.append(name)
+                continue
+            summary['reset'].append(o)
+            manifest['entries'].pop(name, None)
+            if symbols is not None and name in symbols['files']:
+                # the file keeps its ID, but has no routines any more
+                symbols['files'][name].pop('routines', None)
+        return failed
+
+    def get_files(files):
+        """
+        Returns list of files from files keyword or list
+        """
+        # Maps between files keyword and function to get them
+        file_key = {'all': all_mesa_f_files,
+                    'lib': lib_mesa_f_files,
+                    'star': star_mesa_f_files,
+                    'basic': basic_mesa_f_files}
+        try:
+            return file_key[files](mesa_dir)
+        except (KeyError, TypeError):
+            return files
+
+    # IDs of the routines given a call pfr_trace, for insert_format 'id' or
+    # 'time'
+    symbols = None
+    if insert_format != 'write':
+        symbols = load_symbols(mesa_dir_print)
+
     # Calls modify_fortran_file for each file
-    modify_specific(fortran_files)
+    with timed_stage(run_stats, 'discover', hook):
+        files_to_modify = get_files(files)
+    modify_specific(files_to_modify)
+    return summary
+
+
+def plan_mesa_routines(mesa_dir, mesa_dir_print, files='main',
+                       previous_files=None, reset=True,
+                       ignore_functions=['subroutine check'], workers=1,
+                       insert_format='write', throttle=None,
+                       threads=False):
+    '''
+    Input: as for write_mesa_routines
+    - files: the new selection of files to instrument
+    - previous_files: the selection that mesa_dir_print was instrumented
+                      with last time. If None, the record kept by
+                      write_mesa_routines in mesa_dir_print is used.
+
+    Returns: dictionary from write_mesa_routines, where 'changed' and
+    'reset' are the exact files in mesa_dir_print which
+    write_mesa_routines would change, and 'modules' are the MESA modules
+    which would need to be recompiled.
+
+    Purpose: plans a change of instrumentation without touching the disk,
+    so only the affected MESA libraries need to be rebuilt, e.g.
+    plan['modules'] can be passed on to compile_run_mesa.sh.
+    '''
+    return write_mesa_routines(mesa_dir, mesa_dir_print, files=files,
+                               reset=reset,
+                               ignore_functions=ignore_functions,
+                               workers=workers, dry_run=True,
+                               previous_files=previous_files,
+                               insert_format=insert_format,
+                               throttle=throttle, threads=threads)
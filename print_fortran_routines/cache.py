@@ -0,0 +1,142 @@
+"""
+Cache of which files in a MESA print directory are already instrumented.
+
+The manifest is a small json file in mesa_dir_print. For every output file
+it records a key made from the hash of the source file, the package
+version, the instrumenter version, ignore_functions and the insertion
+format, along with the size and modification time of the output file when
+it was last written or checked.
+If the key and the output file are both unchanged the file is already up
+to date, so write_mesa_routines can skip parsing and comparing it.
+
+The manifest also keeps a list of the output files which were left
+instrumented, so resetting the print directory only has to look at those
+rather than comparing every file in MESA.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+FICLONE = 0x40049409  # linux ioctl to make a copy-on-write clone of a file
+
+manifest_name = '.pfr_cache.json'
+
+# version of the text inserted into files and where it goes. Bump it
+# whenever either changes, so files instrumented before are redone.
+instrument_version = 3
+
+
+def cache_key(input_file, version, ignore_functions, insert_format):
+    """
+    returns hash of the contents of input_file together with the settings
+    which change how it is instrumented, or None if it can't be read
+    """
+    key = hashlib.sha256()
+    try:
+        with open(input_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                key.update(chunk)
+    except OSError:
+        return None
+    settings = [version, instrument_version, sorted(ignore_functions),
+                insert_format]
+    key.update(json.dumps(settings).encode())
+    return key.hexdigest()
+
+
+def output_stamp(output_file):
+    """
+    returns [size, modification time] of output_file, or None if it
+    doesn't exist
+    """
+    try:
+        stat = os.stat(output_file)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_manifest(mesa_dir_print):
+    """
+    returns the manifest saved in mesa_dir_print, or an empty one. An
+    empty manifest has no 'instrumented' list, as it isn't known which
+    files in mesa_dir_print are instrumented.
+    """
+    empty = {'version': 1, 'run': 0, 'entries': {}}
+    try:
+        with open(os.path.join(mesa_dir_print, manifest_name), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return empty
+    if manifest.get('version') != 1:
+        return empty
+    manifest['run'] += 1
+    return manifest
+
+
+def save_manifest(mesa_dir_print, manifest, max_entries=5000):
+    """
+    writes manifest to mesa_dir_print, first evicting the least recently
+    used entries if there are more than max_entries
+
+    Returns: number of entries evicted
+    """
+    entries = manifest['entries']
+    n_evict = max(0, len(entries) - max_entries)
+    if n_evict:
+        oldest = sorted(entries, key=lambda name: entries[name]['used'])
+        for name in oldest[:n_evict]:
+            del entries[name]
+
+    filename = os.path.join(mesa_dir_print, manifest_name)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(filename + '.tmp', filename)
+    return n_evict
+
+
+def is_cached(manifest, name, key, output_file):
+    """
+    returns True if output_file (called name in the manifest) was last
+    made from a source file & settings with this key and hasn't changed
+    since
+    """
+    entry = manifest['entries'].get(name)
+    if key is None or entry is None or entry['key'] != key:
+        return False
+    if entry['stamp'] != output_stamp(output_file):
+        return False
+    entry['used'] = manifest['run']
+    return True
+
+
+def add_to_cache(manifest, name, key, output_file):
+    """
+    records that output_file (called name in the manifest) is up to date
+    with the source file & settings with this key
+    """
+    stamp = output_stamp(output_file)
+    if key is None or stamp is None:
+        manifest['entries'].pop(name, None)
+        return
+    manifest['entries'][name] = {'key': key, 'stamp': stamp,
+                                 'used': manifest['run']}
+
+
+def copy_original(input_file, output_file):
+    """
+    copies input_file over output_file within this process. A copy-on-write
+    clone (reflink) is tried first, which is instant on filesystems such as
+    btrfs or xfs, then a normal copy. Hard links aren't used as
+    instrumented files are re-written in place, which would also change
+    the original MESA file.
+    """
+    try:
+        import fcntl
+        with open(input_file, 'rb') as fin, open(output_file, 'wb') as fout:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(input_file, output_file)
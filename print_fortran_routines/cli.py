@@ -0,0 +1,72 @@
+"""
+Command line entry points, installed by setup.py:
+
+- pfr-follow: follow_mesa_terminal_output, e.g.
+  ./rn 2>&1 | pfr-follow -o routines.txt --files evolve.f90 run_star.f
+"""
+import argparse
+import os
+import sys
+
+from . import follow_mesa_terminal_output
+
+
+def follow_main(argv=None):
+    """
+    runs pfr-follow with the command line arguments argv (sys.argv if
+    None), and returns the exit status. Exits with status 1 if the reader
+    of stdout goes away.
+    """
+    parser = argparse.ArgumentParser(
+        prog='pfr-follow',
+        description='Tabs in the start/finsh lines written by a MESA run '
+                    'instrumented with print_fortran_routines, while it is '
+                    'running.')
+    parser.add_argument('input_file', nargs='?', default='-',
+                        help="terminal output of the run, e.g. output.txt "
+                             "from ./rn >& output.txt, or '-' (default) to "
+                             "read stdin, e.g. ./rn 2>&1 | pfr-follow")
+    parser.add_argument('-o', '--output', default='-',
+                        help="file to write to, '-' (default) for stdout")
+    parser.add_argument('--files', nargs='+', default=[],
+                        help='only show routines from these files')
+    parser.add_argument('--i-ignore', type=int, default=None,
+                        help='only show the first I_IGNORE - 1 calls of '
+                             'each routine (default: show every call, also '
+                             'with --aggregate)')
+    parser.add_argument('--aggregate', action='store_true',
+                        help='write the call tree so far instead, with the '
+                             'number of calls of each call path')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='seconds between call trees with --aggregate, '
+                             'and most seconds between writes (default 10)')
+    parser.add_argument('--poll', type=float, default=0.5,
+                        help='seconds to wait before looking for more of '
+                             'the file (default 0.5)')
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='stop once the file hasn\'t grown for this '
+                             'many seconds (default: carry on until '
+                             'interrupted)')
+    args = parser.parse_args(argv)
+
+    try:
+        follow_mesa_terminal_output(args.input_file, args.output,
+                                    i_ignore=args.i_ignore, files=args.files,
+                                    aggregate=args.aggregate,
+                                    interval=args.interval,
+                                    poll_interval=args.poll,
+                                    idle_timeout=args.idle_timeout)
+    except KeyboardInterrupt:
+        pass  # the usual way to stop following a file
+    except BrokenPipeError:
+        # e.g. piped into head, which has stopped reading. Python flushes
+        # stdout again on exit, so point it at devnull to stop that
+        # raising as well
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(follow_main())
@@ -0,0 +1,443 @@
+"""
+Compact trace format, where each routine writes only an integer ID.
+
+With insert_format='id', write_mesa_routines inserts 'call pfr_trace(id)' at
+the start of every routine and 'call pfr_trace(-id)' at its end, rather
+than a write(*,*) statement with the routine and file names. pfr_trace is
+in a generated Fortran file (pfr_trace.f90 in mesa_dir_print), which
+buffers the IDs and writes them to a binary file as 4 byte integers.
+
+The IDs are listed in a symbol table (pfr_symbols.json in mesa_dir_print)
+with the routine, file and line they belong to. Every instrumented file
+keeps the same file ID from one run to the next, and routine IDs are
+file ID * max_routines + position of the routine in the file, so the IDs
+in a file only depend on the file itself and the cache stays valid.
+compact_trace_reader uses the table to turn the IDs back into the usual
+start/finsh lines.
+
+insert_format='time' uses the same IDs and symbol table, but calls
+pfr_trace_time, which also records the time (see timing.py).
+"""
+import json
+import os
+import sys
+import tempfile
+from array import array
+
+symbols_name = 'pfr_symbols.json'
+trace_module_name = 'pfr_trace.f90'
+max_routines = 10000  # routine IDs per file
+chunk_size = 1 << 16  # bytes of IDs read at a time
+
+trace_module = """\
+! Generated by print_fortran_routines for insert_format='id' and 'time'.
+!
+! Instrumented routines call pfr_trace(id) (or pfr_trace_time(id)) when
+! they start and pfr_trace(-id) when they finish. pfr_trace buffers the IDs
+! and writes them to pfr_trace.bin (or $PFR_TRACE_FILE) as 4 byte
+! integers. pfr_trace_time also records the system_clock count, and writes
+! pairs of 8 byte integers (ID, count) to pfr_time.bin (or $PFR_TIME_FILE),
+! after a first pair (0, count rate). The buffers are written when they
+! are full and when the program exits (including through stop), or on
+! call pfr_trace_flush() / pfr_trace_time_flush(). The routines are
+! external so instrumented files don't need a use statement; compile this
+! file with the work directory, e.g. add pfr_trace.o to the objects in
+! make/makefile.
+!
+! With threads=True the routines ending in _thread are called instead.
+! They are safe to call from OpenMP threads and record omp_get_thread_num()
+! (0 if compiled without OpenMP) with every event. pfr_trace_thread writes
+! pairs of 4 byte integers (thread, ID) to pfr_thread.bin (or
+! $PFR_THREAD_FILE) and pfr_trace_time_thread writes 8 byte integers
+! (thread, ID, count) to pfr_time_thread.bin (or $PFR_TIME_THREAD_FILE),
+! after a first pair (1, count rate). pfr_write_thread writes its text
+! followed by ' -- thread ' and the thread number to the terminal.
+
+module pfr_trace_buffer
+   use iso_c_binding, only: c_int, c_funptr, c_funloc
+   use iso_fortran_env, only: int32, int64
+   implicit none
+   integer, parameter :: pfr_buffer_size = 65536
+   integer(int32) :: pfr_buffer(pfr_buffer_size)
+   integer(int64) :: pfr_times(2, pfr_buffer_size)
+   integer(int32) :: pfr_thread_buffer(2, pfr_buffer_size)
+   integer(int64) :: pfr_thread_times(3, pfr_buffer_size)
+   integer :: pfr_n = 0, pfr_unit, pfr_time_n = 0, pfr_time_unit
+   integer :: pfr_thread_n = 0, pfr_thread_unit
+   integer :: pfr_thread_time_n = 0, pfr_thread_time_unit
+   logical :: pfr_opened = .false., pfr_time_opened = .false.
+   logical :: pfr_thread_opened = .false., pfr_thread_time_opened = .false.
+
+   interface
+      integer(c_int) function atexit(f) bind(c, name='atexit')
+         import :: c_int, c_funptr
+         type(c_funptr), value :: f
+      end function atexit
+   end interface
+
+contains
+
+   subroutine pfr_open_file(variable, default, unit)
+      character(len=*), intent(in) :: variable, default
+      integer, intent(out) :: unit
+      character(len=4096) :: filename
+      integer :: length, status
+      call get_environment_variable(variable, filename, length, status)
+      if (status /= 0 .or. length == 0) filename = default
+      open(newunit=unit, file=trim(filename), access='stream', &
+           form='unformatted', status='replace', action='write')
+   end subroutine pfr_open_file
+
+   subroutine pfr_trace_open()
+      integer :: status
+      call pfr_open_file('PFR_TRACE_FILE', 'pfr_trace.bin', pfr_unit)
+      pfr_opened = .true.
+      status = atexit(c_funloc(pfr_trace_exit))
+   end subroutine pfr_trace_open
+
+   subroutine pfr_time_open()
+      integer(int64) :: rate
+      integer :: status
+      call pfr_open_file('PFR_TIME_FILE', 'pfr_time.bin', pfr_time_unit)
+      pfr_time_opened = .true.
+      call system_clock(count_rate=rate)
+      write(pfr_time_unit) 0_int64, rate
+      status = atexit(c_funloc(pfr_time_exit))
+   end subroutine pfr_time_open
+
+   subroutine pfr_thread_open()
+      integer :: status
+      call pfr_open_file('PFR_THREAD_FILE', 'pfr_thread.bin', &
+                         pfr_thread_unit)
+      pfr_thread_opened = .true.
+      status = atexit(c_funloc(pfr_thread_exit))
+   end subroutine pfr_thread_open
+
+   subroutine pfr_thread_time_open()
+      integer(int64) :: rate
+      integer :: status
+      call pfr_open_file('PFR_TIME_THREAD_FILE', 'pfr_time_thread.bin', &
+                         pfr_thread_time_unit)
+      pfr_thread_time_opened = .true.
+      call system_clock(count_rate=rate)
+      write(pfr_thread_time_unit) 1_int64, rate
+      status = atexit(c_funloc(pfr_thread_time_exit))
+   end subroutine pfr_thread_time_open
+
+   ! the buffers of the _thread routines are only used inside a critical
+   ! section, which these are called from
+   subroutine pfr_thread_write()
+      if (.not. pfr_thread_opened) call pfr_thread_open()
+      if (pfr_thread_n > 0) &
+         write(pfr_thread_unit) pfr_thread_buffer(:, 1:pfr_thread_n)
+      flush(pfr_thread_unit)
+      pfr_thread_n = 0
+   end subroutine pfr_thread_write
+
+   subroutine pfr_thread_time_write()
+      if (.not. pfr_thread_time_opened) call pfr_thread_time_open()
+      if (pfr_thread_time_n > 0) write(pfr_thread_time_unit) &
+         pfr_thread_times(:, 1:pfr_thread_time_n)
+      flush(pfr_thread_time_unit)
+      pfr_thread_time_n = 0
+   end subroutine pfr_thread_time_write
+
+   subroutine pfr_trace_exit() bind(c)
+      call pfr_trace_flush()
+   end subroutine pfr_trace_exit
+
+   subroutine pfr_time_exit() bind(c)
+      call pfr_trace_time_flush()
+   end subroutine pfr_time_exit
+
+   subroutine pfr_thread_exit() bind(c)
+      call pfr_trace_thread_flush()
+   end subroutine pfr_thread_exit
+
+   subroutine pfr_thread_time_exit() bind(c)
+      call pfr_trace_time_thread_flush()
+   end subroutine pfr_thread_time_exit
+
+end module pfr_trace_buffer
+
+
+subroutine pfr_trace(id)
+   use pfr_trace_buffer
+   implicit none
+   integer, intent(in) :: id
+   if (.not. pfr_opened) call pfr_trace_open()
+   pfr_n = pfr_n + 1
+   pfr_buffer(pfr_n) = id
+   if (pfr_n == pfr_buffer_size) call pfr_trace_flush()
+end subroutine pfr_trace
+
+
+subroutine pfr_trace_flush()
+   use pfr_trace_buffer
+   implicit none
+   if (.not. pfr_opened) call pfr_trace_open()
+   if (pfr_n > 0) write(pfr_unit) pfr_buffer(1:pfr_n)
+   flush(pfr_unit)
+   pfr_n = 0
+end subroutine pfr_trace_flush
+
+
+subroutine pfr_trace_time(id)
+   use pfr_trace_buffer
+   implicit none
+   integer, intent(in) :: id
+   integer(int64) :: count
+   if (.not. pfr_time_opened) call pfr_time_open()
+   call system_clock(count)
+   pfr_time_n = pfr_time_n + 1
+   pfr_times(1, pfr_time_n) = id
+   pfr_times(2, pfr_time_n) = count
+   if (pfr_time_n == pfr_buffer_size) call pfr_trace_time_flush()
+end subroutine pfr_trace_time
+
+
+subroutine pfr_trace_time_flush()
+   use pfr_trace_buffer
+   implicit none
+   if (.not. pfr_time_opened) call pfr_time_open()
+   if (pfr_time_n > 0) write(pfr_time_unit) pfr_times(:, 1:pfr_time_n)
+   flush(pfr_time_unit)
+   pfr_time_n = 0
+end subroutine pfr_trace_time_flush
+
+
+subroutine pfr_trace_thread(id)
+   use pfr_trace_buffer
+   !$ use omp_lib, only: omp_get_thread_num
+   implicit none
+   integer, intent(in) :: id
+   integer :: thread
+   thread = 0
+   !$ thread = omp_get_thread_num()
+   !$omp critical (pfr_trace_thread_lock)
+   if (.not. pfr_thread_opened) call pfr_thread_open()
+   pfr_thread_n = pfr_thread_n + 1
+   pfr_thread_buffer(1, pfr_thread_n) = thread
+   pfr_thread_buffer(2, pfr_thread_n) = id
+   if (pfr_thread_n == pfr_buffer_size) call pfr_thread_write()
+   !$omp end critical (pfr_trace_thread_lock)
+end subroutine pfr_trace_thread
+
+
+subroutine pfr_trace_thread_flush()
+   use pfr_trace_buffer
+   implicit none
+   !$omp critical (pfr_trace_thread_lock)
+   call pfr_thread_write()
+   !$omp end critical (pfr_trace_thread_lock)
+end subroutine pfr_trace_thread_flush
+
+
+subroutine pfr_trace_time_thread(id)
+   use pfr_trace_buffer
+   !$ use omp_lib, only: omp_get_thread_num
+   implicit none
+   integer, intent(in) :: id
+   integer(int64) :: count
+   integer :: thread
+   thread = 0
+   !$ thread = omp_get_thread_num()
+   !$omp critical (pfr_trace_time_thread_lock)
+   if (.not. pfr_thread_time_opened) call pfr_thread_time_open()
+   call system_clock(count)
+   pfr_thread_time_n = pfr_thread_time_n + 1
+   pfr_thread_times(1, pfr_thread_time_n) = thread
+   pfr_thread_times(2, pfr_thread_time_n) = id
+   pfr_thread_times(3, pfr_thread_time_n) = count
+   if (pfr_thread_time_n == pfr_buffer_size) call pfr_thread_time_write()
+   !$omp end critical (pfr_trace_time_thread_lock)
+end subroutine pfr_trace_time_thread
+
+
+subroutine pfr_trace_time_thread_flush()
+   use pfr_trace_buffer
+   implicit none
+   !$omp critical (pfr_trace_time_thread_lock)
+   call pfr_thread_time_write()
+   !$omp end critical (pfr_trace_time_thread_lock)
+end subroutine pfr_trace_time_thread_flush
+
+
+subroutine pfr_write_thread(text)
+   !$ use omp_lib, only: omp_get_thread_num
+   implicit none
+   character(len=*), intent(in) :: text
+   integer :: thread
+   thread = 0
+   !$ thread = omp_get_thread_num()
+   !$omp critical (pfr_write_thread_lock)
+   write(*, '(3a, i0)') ' ', text, ' -- thread ', thread
+   !$omp end critical (pfr_write_thread_lock)
+end subroutine pfr_write_thread
+"""
+
+
+def routine_id(file_id, position):
+    """
+    returns ID of the routine at position (from 1) in the file with file_id
+    """
+    if position >= max_routines:
+        raise ValueError('more than {} routines in one file'.format(
+            max_routines - 1))
+    return file_id * max_routines + position
+
+
+def get_call_texts(rid, insert_format='id', threads=False):
+    """
+    returns first and last call pfr_trace statements for routine with ID
+    rid, or call pfr_trace_time statements if insert_format == 'time'. With
+    threads, the _thread versions are called instead.
+    """
+    name = 'pfr_trace_time' if insert_format == 'time' else 'pfr_trace'
+    if threads:
+        name += '_thread'
+    return ('      call {}({})\n'.format(name, rid),
+            '      call {}(-{})\n'.format(name, rid))
+
+
+def load_symbols(mesa_dir_print):
+    """
+    returns the symbol table saved in mesa_dir_print, or an empty one. The
+    table has 'files': dictionary of file name within mesa_dir_print ->
+    {'id': file ID, 'routines': list of [routine ID, routine, line]}.
+    """
+    empty = {'version': 1, 'files': {}}
+    try:
+        with open(os.path.join(mesa_dir_print, symbols_name), 'r') as f:
+            symbols = json.load(f)
+    except (OSError, ValueError):
+        return empty
+    if symbols.get('version') != 1:
+        return empty
+    return symbols
+
+
+def file_id(symbols, name):
+    """
+    returns ID of file name in the symbol table, giving it a new ID (which
+    is never re-used for another file) if it doesn't have one yet
+    """
+    entry = symbols['files'].get(name)
+    if entry is None:
+        ids = [x['id'] for x in symbols['files'].values()]
+        entry = symbols['files'][name] = {'id': max(ids, default=0) + 1}
+    return entry['id']
+
+
+def save_symbols(mesa_dir_print, symbols):
+    """
+    writes symbol table and the Fortran trace module to mesa_dir_print. The
+    module is only re-written if it has changed, so it isn't recompiled.
+    """
+    filename = os.path.join(mesa_dir_print, symbols_name)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(symbols, f)
+    os.replace(filename + '.tmp', filename)
+    save_trace_module(mesa_dir_print)
+
+
+def save_trace_module(mesa_dir_print):
+    """
+    writes the Fortran trace module to mesa_dir_print, unless the one there
+    is already up to date, so it isn't recompiled
+    """
+    filename = os.path.join(mesa_dir_print, trace_module_name)
+    try:
+        with open(filename, 'r') as f:
+            if f.read() == trace_module:
+                return
+    except OSError:
+        pass
+    with open(filename, 'w') as f:
+        f.write(trace_module)
+
+
+def read_symbols(symbols_file):
+    """
+    returns dictionary of routine ID -> (routine, file, line) from a symbol
+    table file, or from the one in symbols_file if it is a directory
+    """
+    if os.path.isdir(symbols_file):
+        symbols_file = os.path.join(symbols_file, symbols_name)
+    with open(symbols_file, 'r') as f:
+        symbols = json.load(f)
+    routines = {}
+    for name, entry in symbols['files'].items():
+        f_short = name.split('/')[-1]
+        for rid, routine, line in entry.get('routines', []):
+            routines[rid] = (routine, f_short, line)
+    return routines
+
+
+def symbol_lines(symbols_file):
+    """
+    returns dictionary of signed routine ID -> start/finsh line, made from
+    the symbol table in symbols_file
+    """
+    lines = {}
+    for rid, (routine, f_short, _) in read_symbols(symbols_file).items():
+        lines[rid] = ' '.join(['start --', routine, '--', f_short])
+        lines[-rid] = ' '.join(['finsh --', routine, '--', f_short])
+    return lines
+
+
+def compact_trace_reader(input_file, symbols_file):
+    """
+    Input:
+    - input_file: filename of a binary trace written by pfr_trace.f90, '-'
+      for stdin, or an open binary file object
+    - symbols_file: symbol table written by write_mesa_routines, or the
+      mesa_dir_print directory it is in
+
+    Returns: function which returns a new iterator over the start and finsh
+    lines of input_file every time it is called, the same as trace_reader
+
+    Purpose: decodes the routine IDs with the symbol table, so the compact
+    trace can go through the same steps as the terminal output. Each
+    distinct line is made once and shared, so decoding is a dictionary
+    look up per ID.
+    """
+    lines = symbol_lines(symbols_file)
+
+    def read_lines(trace):
+        rest = b''
+        for chunk in iter(lambda: trace.read(chunk_size), b''):
+            chunk = rest + chunk
+            n = len(chunk) - len(chunk) % 4
+            ids = array('i', chunk[:n])
+            rest = chunk[n:]
+            try:
+                yield from map(lines.__getitem__, ids)
+            except KeyError as e:
+                raise ValueError('routine ID {} is not in the symbol table, '
+                                 'which may be out of date'.format(e))
+
+    def read_path():
+        with open(input_file, 'rb') as trace:
+            yield from read_lines(trace)
+
+    if isinstance(input_file, (str, os.PathLike)) and input_file != '-':
+        return read_path
+
+    trace = sys.stdin.buffer if input_file == '-' else input_file
+    if trace.seekable():
+        start = trace.tell()
+
+        def read_seekable():
+            trace.seek(start)
+            yield from read_lines(trace)
+        return read_seekable
+
+    spool = tempfile.TemporaryFile()
+    for chunk in iter(lambda: trace.read(chunk_size), b''):
+        spool.write(chunk)
+
+    def read_spool():
+        spool.seek(0)
+        yield from read_lines(spool)
+    return read_spool
@@ -0,0 +1,176 @@
+"""
+Live version of the nesting in trace.py, for the output of a MESA run which
+is still going.
+
+follow_trace_blocks reads a log as it grows (like tail -f), or a pipe, and
+yields the start/finsh lines in blocks of whatever has been written so far.
+live_nest_events then tabs in each line as soon as it arrives, keeping only
+the open routines in memory, at most one call of each.
+
+nest_trace can look ahead, but the live output can't, so lines which don't
+pair up are tabbed in differently:
+- a start line is tabbed in once for every routine still open around it.
+  If one of them left through an early 'return', it is only found to be
+  unmatched when a routine below it finishes or it starts again, so lines
+  in between are tabbed in one step too far.
+- i_ignore can't depend on the number of times a routine occurs in the
+  whole log, so only the first i_ignore - 1 calls of each routine are
+  shown, along with their finish lines.
+"""
+import locale
+import os
+import select
+import sys
+import time
+
+from .trace import starting
+
+block_size = 1 << 16  # bytes read at a time
+
+
+def follow_trace_blocks(input_file, poll_interval=0.5, idle_timeout=None):
+    """
+    Input:
+    - input_file: filename of the MESA terminal output, which may still be
+      being written (or not exist yet), or '-' to read from stdin, e.g. a
+      pipe from ./rn
+    - poll_interval: seconds to wait before looking for more of the file
+    - idle_timeout: stop once the file hasn't grown for this many seconds.
+      If None, carry on until interrupted. A pipe is read until it is
+      closed.
+
+    Returns: generator over lists of the stripped start/finsh lines written
+    since the last list, one list for every block read. An empty list
+    means there is nothing more to read for now, and None means the file
+    is being read again from the start.
+
+    Purpose: reads the log as it is written, so it can be nested while MESA
+    is running. A line is only used once its newline has been written. If
+    the file gets shorter (e.g. MESA was started again), it is read again
+    from the start.
+    """
+    encoding = locale.getpreferredencoding(False)
+    rest = [b'']  # part of a line without its newline yet
+
+    def split_block(block):
+        lines = (rest[0] + block).split(b'\n')
+        rest[0] = lines.pop()
+        stripped = (x.decode(encoding, 'replace').strip() for x in lines)
+        return [x for x in stripped if x.startswith(starting)]
+
+    def last_line():
+        line = rest[0].decode(encoding, 'replace').strip()
+        rest[0] = b''
+        return [line] if line.startswith(starting) else []
+
+    def idle_for(since):
+        return idle_timeout is not None and \
+            time.monotonic() - since > idle_timeout
+
+    if input_file == '-':
+        fd = sys.stdin.buffer.fileno()
+        for block in iter(lambda: os.read(fd, block_size), b''):
+            lines = split_block(block)
+            if lines:
+                yield lines
+        lines = last_line()
+        if lines:
+            yield lines
+        return
+
+    last_read = time.monotonic()
+    while not os.path.exists(input_file):
+        if idle_for(last_read):
+            return
+        time.sleep(poll_interval)
+
+    with open(input_file, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if block:
+                last_read = time.monotonic()
+                lines = split_block(block)
+                if lines:
+                    yield lines
+                continue
+            if os.stat(input_file).st_size < f.tell():
+                # the file was truncated or replaced, start again
+                f.seek(0)
+                rest[0] = b''
+                yield None
+                continue
+            if idle_for(last_read):
+                break
+            yield []  # nothing new, so the output can be flushed
+            time.sleep(poll_interval)
+    lines = last_line()
+    if lines:
+        yield lines
+
+
+def input_ready(input_file):
+    """
+    returns True if more of a pipe from stdin can be read without waiting,
+    always False for a file
+    """
+    if input_file != '-':
+        return False
+    try:
+        ready, _, _ = select.select([sys.stdin.buffer], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return bool(ready)
+
+
+def new_live_state():
+    """
+    returns the state kept by live_nest_events between blocks: the open
+    routines in the order they started, each name -> shown, the number of
+    them which are shown, and the number of calls of each routine so far
+    """
+    return {'stack': {}, 'depth': 0, 'calls': {}}
+
+
+def live_nest_events(state, lines, i_ignore=None, files=[]):
+    """
+    Input:
+    - state: from new_live_state, updated with lines
+    - lines: the next stripped start/finsh lines of the log
+    - i_ignore: if not None, only the first i_ignore - 1 calls of each
+      routine are shown
+    - files: if not empty, only routines from files ending in one of these
+      are shown
+
+    Returns: generator over (number of tabs, line) for the lines shown
+
+    Purpose: pairs up the lines with a call stack, as in match_trace_lines,
+    and tabs each one in as soon as it arrives (see the top of this file).
+    Routines which aren't shown don't tab in the routines they call.
+    """
+    files = tuple(files)
+    stack, calls = state['stack'], state['calls']
+    for line in lines:
+        name = line[5:]
+        if line.startswith('start'):
+            n_calls = calls[name] = calls.get(name, 0) + 1
+            shown = ((i_ignore is None or n_calls < i_ignore) and
+                     (not files or line.endswith(files)))
+            if name in stack:
+                # the open call of the routine left through an early return
+                state['depth'] -= stack.pop(name)
+            stack[name] = shown
+            if shown:
+                yield state['depth'], line
+                state['depth'] += 1
+        elif name in stack:
+            # closes the open start, anything above it never finished
+            jname, shown = stack.popitem()
+            while jname != name:
+                state['depth'] -= shown
+                jname, shown = stack.popitem()
+            if shown:
+                state['depth'] -= 1
+                yield state['depth'], line
+        elif ((i_ignore is None or calls.get(name, 0) < i_ignore) and
+                (not files or line.endswith(files))):
+            yield state['depth'], line
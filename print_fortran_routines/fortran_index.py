@@ -0,0 +1,409 @@
+"""
+Single-pass indexer for the functions & subroutines in a Fortran file.
+
+index_fortran_lines goes through the file once and records where every
+routine starts, where its header (declarations) ends, where its 'contains'
+and end lines are, and which lines are inside interface blocks. The header
+is found with a quick line by line heuristic (correct_startline), which
+can go past executable statements, so where the specification part really
+ends is also found by reading the routine statement by statement
+(spec_end), for anything which must be declared.
+modify_fortran_file uses the index to work out all of the write(*,*)
+statements to insert, and then inserts them in one final merge.
+"""
+from bisect import bisect_left, bisect_right
+
+# types of function / subroutines to consider
+function_types = ('subroutine', 'integer function', 'logical function')
+
+# write(*,*) statements will be inserted after any lines beginning with
+# these at start of functions/subroutines
+fortran_types = ("real", "type", "use", "comment", "integer", "logical",
+                 "!", " ", "include", "9", "character", "implicit",
+                 "interface", "procedure", "optional", "double", "save",
+                 "equivalence", "select case", "complex", "data", "*", ">",
+                 "import", "class", "parameter")
+
+# OpenMP directives which can be in the header. Any other directive (e.g.
+# '!$omp parallel do') is executable, so the header ends before it.
+omp_header_directives = ('!$omp threadprivate', '!$omp declare')
+
+# statements which can be in the specification part of a routine, before
+# its first executable statement
+spec_keywords = ('use', 'import', 'implicit', 'integer', 'real',
+                 'double precision', 'doubleprecision', 'double complex',
+                 'doublecomplex', 'complex', 'logical', 'character', 'byte',
+                 'type', 'class', 'procedure', 'parameter', 'dimension',
+                 'allocatable', 'pointer', 'target', 'optional', 'intent',
+                 'save', 'external', 'intrinsic', 'data', 'common',
+                 'equivalence', 'namelist', 'include', 'public', 'private',
+                 'protected', 'volatile', 'asynchronous', 'value',
+                 'contiguous', 'bind', 'format', 'entry', 'generic',
+                 'abstract interface', 'interface', 'enum')
+
+# blocks in the specification part -> the statement which ends them
+spec_blocks = {'abstract interface': 'endinterface',
+               'interface': 'endinterface', 'type': 'endtype',
+               'enum': 'endenum'}
+
+# lines which were inserted by print_fortran_routines
+trace_line_types = ('write(*,*)', 'call pfr_trace(', 'call pfr_trace_time(',
+                    'call pfr_trace_thread(', 'call pfr_trace_time_thread(',
+                    'call pfr_write_thread(')
+
+
+def get_lastline(line, is_subroutine):
+    """
+    given first line, returns last line of fortran function/subroutines
+    """
+    if is_subroutine:
+        rname = line.split('(', 1)[0].split('!')[0].rstrip()
+        return 'end ' + rname
+    else:
+        f_endname = line.split(' function')[-1].split('!')[0]
+        f_endname = 'end function' + f_endname.split('(', 1)[0].rstrip()
+        return f_endname
+
+
+def correct_startline(file_contents, start_index, end_index, end_selects):
+    """
+    Input:
+    - file_contents: lines of the file, stripped & in lower case
+    - start_index, end_index: indices of first & last lines of routine
+    - end_selects: sorted indices of all 'end select' lines in the file
+
+    Returns: correct index to insert starting_text, or end_index if every
+    line of the routine is part of its header
+
+    Purpose: goes forward through the routine one line at a time and stops
+    at the first line which isn't part of the header. Skipped lines are
+    - lines beginning with anything in fortran_types, or blank lines
+    - the first line, and any line after a line containing '&' or '!'
+      (continuation lines)
+    - lines after a 'select case' line, as long as there is an
+      'end select' line on or after them in the routine
+    but the header always ends before an executable OpenMP directive, so
+    the statements aren't inserted inside a parallel region.
+    """
+    # last 'end select' in the routine, lines up to it can be inside a case
+    i = bisect_right(end_selects, end_index)
+    last_end_select = end_selects[i - 1] if i else -1
+
+    after_select = False  # seen a 'select case' line
+    continued = True  # previous line had '&' or '!' (or this is first line)
+    for j in range(start_index, end_index + 1):
+        line = file_contents[j]
+        incase = after_select and j <= last_end_select
+        if (line.startswith('!$omp') and
+                not line.startswith(omp_header_directives)):
+            return j
+        if not (continued or incase or line == '' or
+                line.startswith(fortran_types)):
+            return j
+        continued = '&' in line or '!' in line
+        if line.startswith('select case'):
+            after_select = True
+
+    return end_index
+
+
+def unquoted(line, chars):
+    """
+    returns generator over the indices of any of chars in line which
+    aren't in a string
+    """
+    quote = None
+    for i, char in enumerate(line):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in chars:
+            yield i
+
+
+def strip_comment(line):
+    """
+    returns line without its '!' comment, ignoring any '!' in a string
+    """
+    if '!' not in line:
+        return line
+    if '"' not in line and "'" not in line:
+        return line[:line.index('!')].rstrip()
+    for i in unquoted(line, '!'):
+        return line[:i].rstrip()
+    return line
+
+
+def split_statements(code):
+    """
+    returns list of the statements in code, which are separated by ';'
+    """
+    if ';' not in code:
+        return [code] if code else []
+    bounds = [-1] + list(unquoted(code, ';')) + [len(code)]
+    parts = [code[a + 1:b].strip() for a, b in zip(bounds[:-1], bounds[1:])]
+    return [part for part in parts if part]
+
+
+def read_statement(file_contents, j, end_index):
+    """
+    returns (statement starting at line j without comments and with its
+    '&' continuation lines joined, index of the line after it)
+    """
+    code = strip_comment(file_contents[j])
+    if file_contents[j].startswith('!$') and \
+            not file_contents[j].startswith('!$omp'):
+        code = strip_comment(file_contents[j][2:].strip())  # !$ sentinel
+    j += 1
+    while code.endswith('&') and j < end_index:
+        line = strip_comment(file_contents[j])
+        if line.startswith('&'):
+            line = line[1:]
+        code = code[:-1] + line
+        j += 1
+    return code, j
+
+
+def is_assignment(code):
+    """
+    returns True if statement code assigns to a variable, i.e. it has an
+    '=' or '=>' outside brackets and strings and no '::' before it
+    """
+    if '=' not in code:
+        return False
+    depth = 0
+    for i in unquoted(code, '()=:'):
+        char = code[i]
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth:
+            continue
+        elif char == ':' and code[i + 1:i + 2] == ':':
+            return False
+        elif (char == '=' and code[i - 1:i] not in '=/<>' and
+                code[i + 1:i + 2] != '='):
+            return True
+    return False
+
+
+def spec_statement(code):
+    """
+    returns False if statement code (lower case, without its label) is
+    executable, True if it is a specification statement, or the statement
+    which ends it (without spaces) if it begins a block such as an
+    interface block or derived type definition
+    """
+    if not code.startswith(spec_keywords):
+        return False
+    for keyword in spec_keywords:
+        if not code.startswith(keyword):
+            continue
+        rest = code[len(keyword):]
+        if rest[:1].isalnum() or rest[:1] == '_':
+            continue  # a longer name, e.g. real_part
+        if keyword != 'use' and is_assignment(code):
+            return False
+        if keyword == 'type' and rest.lstrip()[:1] == '(':
+            return True  # e.g. type (star_info), pointer :: s
+        return spec_blocks.get(keyword, True)
+    return False
+
+
+def spec_end(file_contents, start_index, end_index):
+    """
+    Input:
+    - file_contents: lines of the file, stripped & in lower case
+    - start_index, end_index: indices of first & last lines of routine
+
+    Returns: index of the line after the last statement of the routine's
+    specification part, or after its first statement if it has none
+
+    Purpose: declarations inserted into the routine must go before its
+    first executable statement, which correct_startline can go past.
+    Goes through the routine a statement at a time, joining '&'
+    continuation lines and skipping comments, blank lines, preprocessor
+    lines, interface blocks and derived type definitions, and stops at the
+    first executable statement or OpenMP directive, 'contains' or the end.
+    """
+    code, j = read_statement(file_contents, start_index, end_index)
+    last = j
+    block_end = None  # statement ending the block we are in
+    while j < end_index:
+        line = file_contents[j]
+        if line.startswith('!$omp'):
+            if not line.startswith(omp_header_directives):
+                break
+            while file_contents[j].endswith('&') and j + 1 < end_index:
+                j += 1
+            j += 1
+            last = j
+            continue
+        if line.startswith('#'):
+            j += 1
+            continue
+        code, j = read_statement(file_contents, j, end_index)
+        if code.split(' ', 1)[0].isdigit():
+            code = code.split(' ', 1)[-1].lstrip()  # label
+        if not code:
+            continue
+        if block_end is not None:
+            if code.replace(' ', '').startswith(block_end):
+                block_end = None
+                last = j
+            continue
+        kinds = [spec_statement(part) for part in split_statements(code)]
+        if not kinds:
+            continue
+        if not all(kinds):
+            break
+        if isinstance(kinds[-1], str):
+            block_end = kinds[-1]
+        else:
+            last = j
+    return last
+
+
+def index_fortran_lines(lines):
+    """
+    Input:
+    - lines: lines of a Fortran file, e.g. from readlines()
+
+    Returns: dictionary with
+    - 'lower': the lines stripped of white space and in lower case
+    - 'routines': list with a dictionary for each function/subroutine, in
+      the order they appear in the file, with
+        - 'first_line': stripped first line, e.g. 'subroutine foo(x, y)'
+        - 'last_line': line which ends the routine, e.g. 'end subroutine foo'
+        - 'start': index of the first line
+        - 'header_end': index of the first line after the declarations,
+          which is where the start write(*,*) statement goes
+        - 'spec_end': index of the line after the specification part (see
+          spec_end), which is where inserted declarations go
+        - 'contains': index of the routine's 'contains' line
+        - 'end': index of the last line
+        - 'in_interface': True if header_end is inside an interface block
+      Indices are None where the line was not found.
+    - 'interfaces': list of [start, end] indices of interface blocks
+    - 'trace_lines': lower case write(*,*) and call pfr_trace lines -> list
+      of their indices
+
+    Purpose: finds everything modify_fortran_file needs to know about the
+    routines in one pass over the file, rather than searching the whole
+    file again for every routine.
+    """
+    lower = [l.strip().lower() for l in lines]
+    in_interface = [False] * len(lines)
+
+    routines = []
+    interfaces = []
+    trace_lines = {}
+    end_selects = []
+    waiting_end = {}  # last line -> routines still waiting for it
+    waiting_end_subroutine = []  # subroutines waiting for 'end subroutine'
+    waiting_contains = []  # routines waiting for a 'contains' line
+    open_interface = None  # start of the interface block we are in
+
+    for i, (line, low) in enumerate(zip(lines, lower)):
+        in_interface[i] = open_interface is not None
+
+        # end, contains & write(*,*) lines of routines started further up
+        if low in waiting_end:
+            for routine in waiting_end.pop(low):
+                routine['end'] = i
+        if low == 'end subroutine':
+            for routine in waiting_end_subroutine:
+                routine['end_subroutine'] = i
+            waiting_end_subroutine = []
+        if low == 'contains':
+            for routine in waiting_contains:
+                routine['contains'] = i
+            waiting_contains = []
+        if low.startswith(trace_line_types):
+            trace_lines.setdefault(low, []).append(i)
+        if low.startswith('end select'):
+            end_selects.append(i)
+
+        # interface blocks
+        no_comment = low.split('!')[0].strip()
+        if no_comment in ('interface', 'abstract interface'):
+            if open_interface is None:
+                open_interface = i
+        elif no_comment == 'end interface' and open_interface is not None:
+            interfaces.append([open_interface, i])
+            open_interface = None
+
+        # first line of a new function/subroutine
+        first_line = line.strip()
+        if first_line.startswith(function_types):
+            is_subroutine = 'subroutine' in first_line
+            routine = {'first_line': first_line,
+                       'last_line': get_lastline(first_line, is_subroutine),
+                       'start': i, 'header_end': None, 'spec_end': None,
+                       'contains': None, 'end': None,
+                       'in_interface': False}
+            routines.append(routine)
+            waiting_end.setdefault(routine['last_line'].lower(),
+                                   []).append(routine)
+            waiting_contains.append(routine)
+            if is_subroutine:
+                routine['end_subroutine'] = None
+                waiting_end_subroutine.append(routine)
+
+    if open_interface is not None:
+        interfaces.append([open_interface, None])
+
+    for routine in routines:
+        # subroutines ending in a bare 'end subroutine'
+        end_subroutine = routine.pop('end_subroutine', None)
+        if routine['end'] is None and end_subroutine is not None:
+            routine['last_line'] = 'end subroutine'
+            routine['end'] = end_subroutine
+        if routine['end'] is None:
+            routine['contains'] = None
+            continue
+
+        if routine['contains'] is not None and \
+                routine['contains'] > routine['end']:
+            routine['contains'] = None
+        routine['header_end'] = correct_startline(lower, routine['start'],
+                                                  routine['end'], end_selects)
+        routine['spec_end'] = spec_end(lower, routine['start'],
+                                       routine['end'])
+        routine['in_interface'] = in_interface[routine['header_end']]
+
+    return {'lower': lower, 'routines': routines, 'interfaces': interfaces,
+            'trace_lines': trace_lines}
+
+
+def contains_line(index, line, start, end):
+    """
+    returns True if line (lower case & stripped) is one of the write(*,*)
+    or call pfr_trace lines between indices start and end inclusive
+    """
+    indices = index['trace_lines'].get(line.strip().lower(), [])
+    i = bisect_left(indices, start)
+    return i < len(indices) and indices[i] <= end
+
+
+def merge_insertions(lines, insertions):
+    """
+    Input:
+    - lines: original lines of the file
+    - insertions: dictionary of line index -> list of texts to insert before
+      lines[index] (or at the end of the file if index == len(lines))
+
+    Returns: new list of lines with all the insertions in it, built in a
+    single pass
+    """
+    merged = []
+    previous = 0
+    for index in sorted(insertions):
+        merged.extend(lines[previous:index])
+        merged.extend(insertions[index])
+        previous = index
+    merged.extend(lines[previous:])
+    return merged
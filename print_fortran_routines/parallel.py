@@ -0,0 +1,319 @@
+"""
+Parallel version of the count, match and nest passes in trace.py, for
+large logs on disk.
+
+The log is memory-mapped and split into chunks of bytes which end on line
+boundaries, and every pass runs on the chunks in worker processes. The
+chunks are stitched back together in this process using small summaries
+of each chunk, so the output is the same as nest_trace:
+
+- count: each chunk counts its distinct lines, and the counts are added up.
+- match: each chunk pairs up the start and finish lines it can decide on
+  its own (see match_chunk), and returns the lines it can't, which are
+  usually only the routines open at its start and end. These are paired up
+  here with the same call stack as match_trace_lines. A code byte for every
+  line of the chunk is kept in a temporary file: 0 for a matched finish
+  line, 1 for a matched start line, +2 if the line is unmatched.
+- nest: the number of tabs at the start of each chunk is the number of
+  matched start lines minus matched finish lines before it, a prefix sum
+  over counts of the code bytes. Each chunk then writes its tabbed lines to
+  a temporary file, which are joined in order.
+"""
+import locale
+import mmap
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .trace import (starting, separator, filter_trace_lines, new_trace_counts,
+                    trace_line_key, nest_matched_lines)
+
+block_size = 1 << 24  # bytes of the log decoded at a time by each worker
+min_chunk_size = 1 << 20  # don't split the log into chunks smaller than this
+unmatched_flags = bytes([0, 0, 1, 1]) + bytes(252)  # code byte -> unmatched
+
+
+def chunk_ranges(filename, n_chunks):
+    """
+    returns list of (start, end) byte offsets splitting filename into up to
+    n_chunks chunks, each ending just after a newline (or at the end)
+    """
+    size = os.path.getsize(filename)
+    if size == 0:
+        return []
+    n_chunks = max(1, min(n_chunks, size // min_chunk_size))
+    with open(filename, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        bounds = [0]
+        for i in range(1, n_chunks):
+            newline = mm.find(b'\n', max(bounds[-1], size * i // n_chunks))
+            if newline < 0:
+                break
+            if newline + 1 > bounds[-1]:
+                bounds.append(newline + 1)
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def chunk_args(input_file, ranges, encoding):
+    """
+    returns list of (filename, start, end, encoding) for each chunk
+    """
+    return [(input_file, start, end, encoding) for start, end in ranges]
+
+
+def read_chunk_lines(filename, start, end, encoding):
+    """
+    returns generator over the stripped start/finsh lines between byte
+    offsets start and end of filename, split the same way as reading the
+    file in text mode (newlines are '\\n', '\\r\\n' or '\\r')
+    """
+    with open(filename, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start
+        while pos < end:
+            stop = min(end, pos + block_size)
+            if stop < end:
+                newline = mm.rfind(b'\n', pos, stop)
+                if newline < 0:
+                    newline = mm.find(b'\n', stop, end)
+                stop = end if newline < 0 else newline + 1
+            text = mm[pos:stop].decode(encoding)
+            if '\r' in text:
+                text = text.replace('\r\n', '\n').replace('\r', '\n')
+            for line in text.split('\n'):
+                line = line.strip()
+                if line.startswith(starting):
+                    yield line
+            pos = stop
+
+
+def count_chunk(filename, start, end, encoding):
+    """
+    returns dictionary of line -> number of times it occurs in the chunk
+    """
+    counts = {}
+    for line in read_chunk_lines(filename, start, end, encoding):
+        counts[line] = counts.get(line, 0) + 1
+    return counts
+
+
+def match_chunk(filename, start, end, encoding, trace_counts, i_ignore,
+                files, codes_file):
+    """
+    Input:
+    - filename, start, end, encoding: the chunk of the log
+    - trace_counts, i_ignore, files: as in filter_trace_lines
+    - codes_file: file to write a code byte for each line kept in the chunk
+
+    Returns: (number of lines kept, list of (index, name, 'start', 'finsh'
+    or 'restart') of the lines which depend on the rest of the log)
+
+    Purpose: pairs up the lines of the chunk which don't depend on anything
+    before it. A finish line of a routine which might be open from an
+    earlier chunk might close that call, and so might leave every start
+    line open above it unmatched. So the open start lines are handed back
+    undecided with the finish line, and only lines after it are paired up
+    in the chunk. A start line of a routine which might be open from an
+    earlier chunk is handed back as a 'restart', which only closes that
+    call. After either, the routine can't be open from before until one
+    of its start lines is handed back again, so its lines are decided in
+    the chunk. A pair decided in the chunk only pushes and pops routines
+    above it, so it is paired up the same way whatever comes before the
+    chunk.
+    """
+    lines = filter_trace_lines(read_chunk_lines(filename, start, end,
+                                                encoding),
+                               trace_counts, i_ignore, files)
+    codes = bytearray()
+    residual = []
+    stack = {}  # routine name -> index of its open start since hand back
+    known = set()  # routines which aren't open from before the stack
+
+    def hand_back():
+        residual.extend((j, jname, 'start') for jname, j in stack.items())
+        known.difference_update(stack)
+        stack.clear()
+
+    for i, line in enumerate(lines):
+        name = line[5:]
+        if line.startswith('start'):
+            if name in stack:
+                # the open call of the routine left through an early return
+                codes[stack.pop(name)] = 3
+            elif name not in known:
+                residual.append((i, name, 'restart'))
+                known.add(name)
+            stack[name] = i
+            codes.append(1)
+        elif name in stack:
+            # closes the open start, anything above it never finished
+            jname, j = stack.popitem()
+            while jname != name:
+                codes[j] = 3
+                jname, j = stack.popitem()
+            codes.append(0)
+        elif name in known:
+            codes.append(2)
+        else:
+            hand_back()
+            residual.append((i, name, 'finsh'))
+            known.add(name)
+            codes.append(0)
+    hand_back()
+
+    with open(codes_file, 'wb') as f:
+        f.write(codes)
+    return len(codes), residual
+
+
+def nest_chunk(filename, start, end, encoding, trace_counts, i_ignore,
+               files, codes_file, depth, end_depth, output_file):
+    """
+    writes the tabbed lines of the chunk to output_file, given the code
+    bytes from match_chunk (with the unmatched lines marked), the number of
+    matched routines open at the start of the chunk and the tabs of the
+    next matched start line after the chunk
+    """
+    lines = filter_trace_lines(read_chunk_lines(filename, start, end,
+                                                encoding),
+                               trace_counts, i_ignore, files)
+    with open(codes_file, 'rb') as f:
+        unmatched = f.read().translate(unmatched_flags)
+    with open(output_file, 'w', encoding=encoding) as out:
+        out.writelines(n*separator + line + '\n' for n, line in
+                       nest_matched_lines(lines, unmatched, depth, end_depth))
+
+
+def parallel_count_trace_lines(input_file, workers=None, n_chunks=None):
+    """
+    returns trace counts of input_file (a filename) as count_trace_lines,
+    counting the chunks of the log in parallel
+    """
+    encoding = locale.getpreferredencoding(False)
+    n_workers = workers or os.cpu_count() or 1
+    ranges = chunk_ranges(input_file, n_chunks or 4 * n_workers)
+    trace_counts = new_trace_counts()
+    counts = trace_counts['counts']
+    if not ranges:
+        return trace_counts
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for chunk_counts in executor.map(
+                count_chunk, *zip(*chunk_args(input_file, ranges, encoding))):
+            for line, n in chunk_counts.items():
+                key = trace_line_key(trace_counts, line)
+                counts[key] = counts.get(key, 0) + n
+    return trace_counts
+
+
+def parallel_nest_trace(input_file, i_ignore=2, files=[], trace_counts=None,
+                        workers=None, n_chunks=None):
+    """
+    Input:
+    - input_file: filename of the MESA terminal output
+    - i_ignore, files, trace_counts: as in nest_trace
+    - workers: number of processes, None for one per CPU
+    - n_chunks: number of chunks to split the log into, 4 per process by
+      default
+
+    Returns: generator over blocks of the tabbed output, which joined
+    together are the same as the lines from nest_trace
+
+    Purpose: runs the passes of nest_trace on chunks of the log in
+    parallel, as described at the top of this file.
+    """
+    encoding = locale.getpreferredencoding(False)
+    n_workers = workers or os.cpu_count() or 1
+    if trace_counts is None and i_ignore is None:
+        trace_counts = new_trace_counts()
+    elif trace_counts is None:
+        trace_counts = parallel_count_trace_lines(input_file, n_workers,
+                                                  n_chunks)
+    ranges = chunk_ranges(input_file, n_chunks or 4 * n_workers)
+    if not ranges:
+        return
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            ProcessPoolExecutor(max_workers=n_workers) as executor:
+        n = len(ranges)
+        args = chunk_args(input_file, ranges, encoding)
+        codes_files = [os.path.join(tmp, 'codes{}'.format(k))
+                       for k in range(n)]
+        output_files = [os.path.join(tmp, 'output{}'.format(k))
+                        for k in range(n)]
+
+        # pair up lines in each chunk, then the lines left over in order
+        results = list(executor.map(
+            match_chunk, *zip(*args), [trace_counts]*n, [i_ignore]*n,
+            [files]*n, codes_files))
+        unmatched = [[] for k in range(n)]  # indices in each chunk
+        stack = {}  # routine name -> (chunk, index) of its open start line
+        for k, (n_lines, residual) in enumerate(results):
+            for i, name, event in residual:
+                if event != 'finsh':
+                    if name in stack:
+                        kj, j = stack.pop(name)
+                        unmatched[kj].append(j)
+                    if event == 'start':
+                        stack[name] = (k, i)
+                elif name in stack:
+                    jname, (kj, j) = stack.popitem()
+                    while jname != name:
+                        unmatched[kj].append(j)
+                        jname, (kj, j) = stack.popitem()
+                else:
+                    unmatched[k].append(i)
+        for kj, j in stack.values():
+            unmatched[kj].append(j)
+
+        # mark unmatched lines, and count matched start & finish lines
+        deltas = []  # change in number of open matched routines in chunk
+        firsts = []  # depth in chunk of first matched start line, or None
+        for k in range(n):
+            with open(codes_files[k], 'r+b') as f:
+                codes = bytearray(f.read())
+                for j in unmatched[k]:
+                    codes[j] |= 2
+                f.seek(0)
+                f.write(codes)
+            deltas.append(codes.count(1) - codes.count(0))
+            first = codes.find(1)
+            firsts.append(None if first < 0 else -codes.count(0, 0, first))
+        depths = [0]
+        for delta in deltas[:-1]:
+            depths.append(depths[-1] + delta)
+        end_depths = [0] * n
+        for k in range(n - 2, -1, -1):
+            if firsts[k + 1] is None:
+                end_depths[k] = end_depths[k + 1]
+            else:
+                end_depths[k] = depths[k + 1] + firsts[k + 1]
+
+        # write the chunks, then join them in order
+        futures = [executor.submit(nest_chunk, *args[k], trace_counts,
+                                   i_ignore, files, codes_files[k],
+                                   depths[k], end_depths[k], output_files[k])
+                   for k in range(n)]
+        for k in range(n):
+            futures[k].result()
+            with open(output_files[k], 'r', encoding=encoding) as f:
+                yield from iter(lambda: f.read(block_size), '')
+            os.remove(output_files[k])
+
+
+def parallel_nest_trace_events(input_file, i_ignore=2, files=[],
+                               trace_counts=None, workers=None,
+                               n_chunks=None):
+    """
+    returns generator over (number of tabs, line) as nest_trace_events,
+    from parallel_nest_trace
+    """
+    rest = ''
+    for block in parallel_nest_trace(input_file, i_ignore, files,
+                                     trace_counts, workers, n_chunks):
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            stripped = line.lstrip('\t')
+            yield (len(line) - len(stripped)) // len(separator), stripped
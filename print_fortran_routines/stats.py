@@ -0,0 +1,87 @@
+"""
+Optional run statistics for write_mesa_routines, modify_fortran_file and
+modify_mesa_terminal_output.
+
+Statistics are plain dictionaries (so they can be saved with json.dump),
+which always have 'stages': dictionary of stage name -> wall time in
+seconds. Each entry point adds its own counts, see their docstrings. A
+hook, if given, is called with (stage name, seconds) every time a stage
+finishes, e.g. to log the progress of long runs.
+"""
+import time
+from contextlib import contextmanager
+
+
+def new_stats(stats):
+    """
+    Input:
+    - stats: the stats argument of an entry point. False or None for no
+      statistics, True to collect them, or a function to collect them and
+      call it as the hook.
+
+    Returns: (new statistics dictionary or None, hook or None)
+    """
+    if not stats:
+        return None, None
+    return {'stages': {}}, (stats if callable(stats) else None)
+
+
+def add_stage_time(stats, stage, seconds, hook=None):
+    """
+    adds seconds to the time of stage in stats, and calls the hook
+    """
+    stats['stages'][stage] = stats['stages'].get(stage, 0.0) + seconds
+    if hook is not None:
+        hook(stage, seconds)
+
+
+@contextmanager
+def timed_stage(stats, stage, hook=None):
+    """
+    context manager which adds the wall time of the with block to stage
+    in stats. Does nothing if stats is None.
+    """
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(stats, stage, time.perf_counter() - start, hook)
+
+
+def timed_iter(iterable, stats, stage, hook=None):
+    """
+    returns generator over iterable which adds the time spent making each
+    item to stage in stats, for steps which are generators. The hook is
+    called once, when iterable is used up. Returns iterable itself if
+    stats is None.
+    """
+    if stats is None:
+        return iterable
+
+    def timed():
+        seconds = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                yield item
+        finally:
+            add_stage_time(stats, stage, seconds, hook)
+    return timed()
+
+
+def add_counts(total, counts):
+    """
+    adds the numbers in dictionary counts to those in total
+    """
+    for key, n in counts.items():
+        total[key] = total.get(key, 0) + n
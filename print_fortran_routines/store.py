@@ -0,0 +1,421 @@
+"""
+Indexed store of the calls in a MESA log, for answering many questions
+about the same run without reading the log again.
+
+write_trace_store reads the log twice: once to pair up the start and
+finish lines (match_trace_lines) and once to write one row for each call,
+in the order the calls started. Each column is a binary file of integers
+in the store directory:
+
+- routine: ID of the routine, an index into the names in store.json
+- depth: number of matched routines open around the call. For calls which
+  finished this is the tabs of the nested output. A start line which never
+  finished is tabbed in like the next matched start line in the nested
+  output (see nest_matched_lines), which can differ, but here it is placed
+  under the calls open around it, like the other calls.
+- parent: row of the innermost matched routine open around the call, or
+  -1 at the top level
+- end: one past the last row of the calls made inside this one, so the
+  calls under row i are the rows i to end[i] - 1
+- enter, exit: position in the log (counting start/finsh lines from 0) of
+  the start and finish lines. exit is -1 if the call never finished (see
+  nest_trace_lines), in which case it has no calls under it.
+- by_routine: the rows sorted by routine, with the rows of routine r from
+  offsets[r] to offsets[r + 1] - 1 (offsets are in store.json)
+
+open_trace_store memory-maps the columns rather than reading them, so
+opening a store takes about the same time however long the run was, and
+only the parts used by a query are read from disk. Positions in the log
+stand in for time: the calls started between two positions are a range of
+rows, found by bisection.
+
+Finish lines which don't match any open start line aren't calls, so they
+aren't stored, only counted.
+"""
+import bisect
+import json
+import mmap
+import os
+import tempfile
+from array import array
+
+from .trace import match_trace_lines, read_status_file, separator
+
+store_version = 1
+meta_name = 'store.json'
+# column -> array typecode, 'i' for 4 byte and 'q' for 8 byte integers
+columns = {'routine': 'i', 'depth': 'i', 'parent': 'q', 'end': 'q',
+           'enter': 'q', 'exit': 'q'}
+chunk_size = 1 << 16  # items of a column kept before writing them
+
+
+def new_column(path, typecode):
+    """
+    returns a column to be written to path (a dictionary with the open
+    file, the items not written yet and the number of items written)
+    """
+    return {'file': open(path, 'w+b'), 'chunk': array(typecode),
+            'offset': 0, 'typecode': typecode}
+
+
+def append_column(column, value):
+    """
+    adds value to the end of column, writing the items out once there are
+    chunk_size of them
+    """
+    column['chunk'].append(value)
+    if len(column['chunk']) >= chunk_size:
+        column['file'].write(column['chunk'].tobytes())
+        column['offset'] += len(column['chunk'])
+        column['chunk'] = array(column['typecode'])
+
+
+def set_column(column, i, value):
+    """
+    sets item i of column to value, in place in the file if it has
+    already been written out
+    """
+    if i >= column['offset']:
+        column['chunk'][i - column['offset']] = value
+        return
+    f = column['file']
+    f.seek(i * column['chunk'].itemsize)
+    f.write(array(column['typecode'], [value]).tobytes())
+    f.seek(0, os.SEEK_END)
+
+
+def close_column(column):
+    """
+    writes out the rest of column and closes its file
+    """
+    column['file'].write(column['chunk'].tobytes())
+    column['file'].close()
+
+
+def map_column(path, typecode):
+    """
+    returns the column in path as a read-only memoryview of integers,
+    memory-mapped rather than read
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(array(typecode)).toreadonly()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)
+
+
+def build_trace_store(read_lines, store_dir, source=None):
+    """
+    Input:
+    - read_lines: function returning a new iterator over the stripped
+      start/finsh lines each time it is called, e.g. from trace_reader
+    - store_dir: directory to write the store to, made if needed. Any store
+      already in it is replaced.
+    - source: size and modification time of the log from
+      trace_source_stamp, saved so the store can be reused
+
+    Returns: None
+
+    Purpose: writes the columns described at the top of this file, with
+    only the open calls and distinct routines in memory. Rows whose
+    end and exit are only known once the call finishes are corrected in
+    place. Files are written under temporary names and moved into place,
+    with store.json last, so a store which is open (and memory-mapped)
+    isn't changed and a half-written store is never opened.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    names = []  # routine ID -> ' -- routine -- file' part of the line
+    ids = {}  # name -> routine ID
+    n_routine = []  # routine ID -> number of calls
+    stack = []  # rows of the open matched calls
+    n_calls = n_unmatched_start = n_unmatched_finish = 0
+
+    tmp = {name: os.path.join(store_dir, name + '.tmp')
+           for name in list(columns) + ['by_routine']}
+    with tempfile.TemporaryFile() as status_file:
+        n_lines = match_trace_lines(read_lines(), status_file)
+        cols = {name: new_column(tmp[name], typecode) for
+                name, typecode in columns.items()}
+        try:
+            for pos, (line, flag) in enumerate(zip(
+                    read_lines(), read_status_file(status_file))):
+                if not line.startswith('start'):
+                    if flag:
+                        n_unmatched_finish += 1
+                    else:
+                        row = stack.pop()
+                        set_column(cols['end'], row, n_calls)
+                        set_column(cols['exit'], row, pos)
+                    continue
+
+                name = line[5:]
+                rid = ids.get(name)
+                if rid is None:
+                    rid = ids[name] = len(names)
+                    names.append(name)
+                    n_routine.append(0)
+                n_routine[rid] += 1
+                append_column(cols['routine'], rid)
+                append_column(cols['depth'], len(stack))
+                append_column(cols['parent'], stack[-1] if stack else -1)
+                append_column(cols['enter'], pos)
+                append_column(cols['exit'], -1)
+                # end of an open call is set when it finishes
+                append_column(cols['end'], n_calls + 1)
+                if flag:
+                    n_unmatched_start += 1
+                else:
+                    stack.append(n_calls)
+                n_calls += 1
+        finally:
+            for column in cols.values():
+                close_column(column)
+
+    offsets = [0]
+    for n in n_routine:
+        offsets.append(offsets[-1] + n)
+    write_routine_index(tmp['by_routine'],
+                        map_column(tmp['routine'], columns['routine']),
+                        offsets)
+
+    meta_file = os.path.join(store_dir, meta_name)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    for name, path in tmp.items():
+        os.replace(path, os.path.join(store_dir, name))
+    meta = {'version': store_version, 'source': source, 'names': names,
+            'offsets': offsets, 'n_calls': n_calls, 'n_lines': n_lines,
+            'unmatched_start': n_unmatched_start,
+            'unmatched_finish': n_unmatched_finish}
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_file + '.tmp', meta_file)
+
+
+def write_routine_index(path, routine, offsets):
+    """
+    writes the rows of the routine column sorted by routine (keeping the
+    rows of each routine in order) to path, with a counting sort into a
+    memory-mapped file
+    """
+    n_calls = len(routine)
+    with open(path, 'w+b') as f:
+        if n_calls == 0:
+            return
+        f.truncate(8 * n_calls)
+        mapped = mmap.mmap(f.fileno(), 0)
+        index = memoryview(mapped).cast('q')
+        next_row = offsets[:-1]  # routine ID -> where its next row goes
+        for row, rid in enumerate(routine):
+            index[next_row[rid]] = row
+            next_row[rid] += 1
+        index.release()
+        mapped.close()
+
+
+def load_store_meta(store_dir):
+    """
+    returns the contents of store.json in store_dir, or None if there
+    isn't a store of this version there
+    """
+    try:
+        with open(os.path.join(store_dir, meta_name), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != store_version:
+        return None
+    return meta
+
+
+def open_trace_store(store_dir):
+    """
+    Input:
+    - store_dir: directory written by write_trace_store
+
+    Returns: store dictionary with
+    - 'names': list of routine ID -> routine, e.g.
+      'subroutine foo -- foo.f90'
+    - 'ids': dictionary of routine -> routine ID
+    - 'n_calls', 'n_lines': number of calls and start/finsh lines in the
+      log
+    - 'unmatched_start', 'unmatched_finish': number of start lines which
+      never finished and finish lines which didn't match a start line
+    - 'source': size and modification time of the log, if it was a file
+    - 'routine', 'depth', 'parent', 'end', 'enter', 'exit', 'by_routine':
+      the columns (see the top of this file), as sequences of integers
+    - 'offsets': list of where the rows of each routine start in
+      'by_routine', with one more at the end
+
+    Purpose: opens a store without reading its columns, which are
+    memory-mapped.
+    """
+    meta = load_store_meta(store_dir)
+    if meta is None:
+        raise ValueError('no trace store in {}'.format(store_dir))
+    store = {key: meta[key] for key in ('n_calls', 'n_lines', 'source',
+                                        'offsets', 'unmatched_start',
+                                        'unmatched_finish')}
+    store['names'] = [name[4:] for name in meta['names']]
+    store['ids'] = {name: i for i, name in enumerate(store['names'])}
+    for name, typecode in columns.items():
+        store[name] = map_column(os.path.join(store_dir, name), typecode)
+    store['by_routine'] = map_column(os.path.join(store_dir, 'by_routine'),
+                                     'q')
+    return store
+
+
+def find_routines(store, text):
+    """
+    returns the IDs of the routines whose name, e.g.
+    'subroutine foo -- foo.f90', contains text
+    """
+    return [i for i, name in enumerate(store['names']) if text in name]
+
+
+def routine_calls(store, routine):
+    """
+    returns the rows of the calls to routine (an ID, or a name as in
+    store['names']), in the order they were made
+    """
+    if isinstance(routine, str):
+        routine = store['ids'][routine]
+    offsets = store['offsets']
+    return store['by_routine'][offsets[routine]:offsets[routine + 1]]
+
+
+def call_name(store, row):
+    """
+    returns the routine called in row, e.g. 'subroutine foo -- foo.f90'
+    """
+    return store['names'][store['routine'][row]]
+
+
+def call_subtree(store, row):
+    """
+    returns range of the rows of the call in row and all the calls made
+    inside it, in the order they were made
+    """
+    return range(row, store['end'][row])
+
+
+def call_ancestors(store, row):
+    """
+    returns list of the rows of the calls open around the call in row,
+    outermost first
+    """
+    parent = store['parent']
+    rows = []
+    row = parent[row]
+    while row >= 0:
+        rows.append(row)
+        row = parent[row]
+    rows.reverse()
+    return rows
+
+
+def calls_in_range(store, start, stop):
+    """
+    Input:
+    - store: from open_trace_store
+    - start, stop: positions in the log, counting start/finsh lines from 0
+
+    Returns: list of the rows of the calls which were running at any point
+    from start up to (not including) stop: the calls still open at start,
+    outermost first, followed by the calls made from start to stop
+
+    Purpose: the calls open at start are the last call made before start
+    and the calls around it, if they hadn't finished, so only those are
+    looked at, along with a bisection for each end of the range. Calls
+    which never finished only count as running at their start line.
+    """
+    enter, exit_ = store['enter'], store['exit']
+    first = bisect.bisect_left(enter, start)
+    last = bisect.bisect_left(enter, stop, lo=first)
+    rows = []
+    if first > 0:
+        before = first - 1
+        rows = [row for row in call_ancestors(store, before) + [before]
+                if exit_[row] >= start]
+    return rows + list(range(first, last))
+
+
+def routine_counts(store, rows):
+    """
+    returns dictionary of routine -> number of calls to it in rows (e.g.
+    from call_subtree), most called first
+    """
+    routine = store['routine']
+    counts = {}
+    for row in rows:
+        rid = routine[row]
+        counts[rid] = counts.get(rid, 0) + 1
+    names = store['names']
+    return {names[rid]: n for rid, n in
+            sorted(counts.items(), key=lambda x: (-x[1], x[0]))}
+
+
+def diverging_calls(store, row, other_store, other_row):
+    """
+    Input:
+    - store, row: a call, e.g. the fifth timestep of a run
+    - other_store, other_row: the call to compare with, which can be in
+      the store of another run (or the same store)
+
+    Returns: (row, other row) of the first calls under the two calls which
+    are to different routines, or at different depths under them. If one
+    call has more calls under it than the other, the row of the first
+    extra call is paired with None. Returns None if the two have the same
+    calls.
+
+    Purpose: finds where two call paths diverged, e.g. where a run took a
+    different branch than a previous run, comparing routines by name.
+    """
+    names = store['names']
+    other_ids = other_store['ids']
+    same_id = [other_ids.get(name, -1) for name in names]
+    routine, depth = store['routine'], store['depth']
+    other_routine, other_depth = other_store['routine'], other_store['depth']
+    shift = depth[row] - other_depth[other_row]
+    rows = call_subtree(store, row)
+    other_rows = call_subtree(other_store, other_row)
+    for i, j in zip(rows, other_rows):
+        if (same_id[routine[i]] != other_routine[j]
+                or depth[i] - other_depth[j] != shift):
+            return i, j
+    if len(rows) > len(other_rows):
+        return rows[len(other_rows)], None
+    if len(other_rows) > len(rows):
+        return None, other_rows[len(rows)]
+    return None
+
+
+def store_trace_lines(store, rows):
+    """
+    returns generator over tabbed start and finsh lines, as in the nested
+    output, for rows (e.g. from call_subtree) in increasing order. Tabs
+    are counted from the first row, and finish lines are written for the
+    calls in rows which finished. Start lines which never finished are
+    tabbed in by their depth, so can differ from the nested output.
+    """
+    routine, depth, end, exit_ = (store['routine'], store['depth'],
+                                  store['end'], store['exit'])
+    names = ['start -- ' + name for name in store['names']]
+    finish_names = ['finsh -- ' + name for name in store['names']]
+    open_rows = []  # matched calls whose finish line isn't written yet
+    top = None
+    for row in rows:
+        if top is None:
+            top = depth[row]
+        while open_rows and end[open_rows[-1]] <= row:
+            done = open_rows.pop()
+            yield '{}{}\n'.format((depth[done] - top)*separator,
+                                  finish_names[routine[done]])
+        yield '{}{}\n'.format((depth[row] - top)*separator,
+                              names[routine[row]])
+        if exit_[row] >= 0:
+            open_rows.append(row)
+    while open_rows:
+        done = open_rows.pop()
+        yield '{}{}\n'.format((depth[done] - top)*separator,
+                              finish_names[routine[done]])
@@ -0,0 +1,145 @@
+"""
+Tracing MESA runs which use more than one OpenMP thread.
+
+The start and finish lines of routines running at the same time on
+different threads are interleaved in the log, so pairing them up with a
+single call stack nests them inside each other. With threads=True every
+event also records omp_get_thread_num(), through routines in pfr_trace.f90
+which use a critical section so threads don't write over each other (see
+compact.py):
+
+- insert_format='write': call pfr_write_thread('start -- routine -- file'),
+  which writes the line followed by ' -- thread 3'
+- insert_format='id': call pfr_trace_thread(id), which writes (thread, ID)
+  pairs to pfr_thread.bin
+- insert_format='time': call pfr_trace_time_thread(id), which writes
+  (thread, ID, count) to pfr_time_thread.bin, read by profile_mesa_trace
+
+thread_trace_lines reads the events back as (thread, line), and
+spool_thread_lines splits them into a temporary log for each thread, which
+then goes through the usual steps with its own call stack. Lines without
+a thread (e.g. from files instrumented without threads) count as thread 0.
+omp_get_thread_num() is the number within the innermost parallel region,
+so with nested parallel regions threads of different teams share numbers.
+"""
+import os
+import sys
+import tempfile
+from array import array
+
+from .compact import symbol_lines
+from .trace import trace_reader
+
+thread_tag = ' -- thread '  # between a line and its thread number
+chunk_size = 1 << 16  # bytes of (thread, ID) pairs read at a time
+
+
+def get_thread_write_texts(routine, f_short):
+    """
+    returns first and last call pfr_write_thread statements for routine,
+    e.g. 'subroutine do_something', in file f_short
+    """
+    return tuple("      call pfr_write_thread('{} -- {} -- {}')\n".format(
+        start, routine, f_short) for start in ('start', 'finsh'))
+
+
+def split_thread_line(line):
+    """
+    returns (thread, line without its thread) of a stripped start/finsh
+    line written by pfr_write_thread, or (0, line) if it has no thread
+    """
+    head, tag, thread = line.rpartition(thread_tag)
+    if tag and thread.isdigit():
+        return int(thread), head
+    return 0, line
+
+
+def thread_trace_lines(input_file, symbols_file=None):
+    """
+    Input:
+    - input_file: output text file from a mesa run instrumented with
+      threads=True, '-' for stdin, or an open file object. With
+      symbols_file, pfr_thread.bin from a run with insert_format='id'.
+    - symbols_file: symbol table used to decode a binary trace, as for
+      modify_mesa_terminal_output
+
+    Returns: generator over (thread, stripped start/finsh line), in the
+    order they were written
+    """
+    if symbols_file is None:
+        for line in trace_reader(input_file)():
+            yield split_thread_line(line)
+        return
+
+    lines = symbol_lines(symbols_file)
+
+    def read_pairs(trace):
+        rest = b''
+        for chunk in iter(lambda: trace.read(chunk_size), b''):
+            chunk = rest + chunk
+            n = len(chunk) - len(chunk) % 8
+            pairs = array('i', chunk[:n])
+            rest = chunk[n:]
+            for thread, rid in zip(pairs[::2], pairs[1::2]):
+                line = lines.get(rid)
+                if line is None:
+                    raise ValueError('routine ID {} is not in the symbol '
+                                     'table, which may be out of '
+                                     'date'.format(rid))
+                yield thread, line
+
+    if isinstance(input_file, (str, os.PathLike)) and input_file != '-':
+        with open(input_file, 'rb') as trace:
+            yield from read_pairs(trace)
+        return
+    yield from read_pairs(sys.stdin.buffer if input_file == '-'
+                          else input_file)
+
+
+def spool_thread_lines(events):
+    """
+    Input:
+    - events: iterable of (thread, line) from thread_trace_lines
+
+    Returns: (dictionary of thread -> temporary text file of its lines,
+    rewound, activity), where activity is a dictionary of routine, e.g.
+    'subroutine foo -- foo.f90' -> dictionary of thread -> number of calls
+
+    Purpose: a single pass over the log which splits it by thread, so each
+    thread's lines can be nested with their own call stack. Only the
+    distinct routines are kept in memory. The caller closes the files.
+    """
+    spools = {}
+    activity = {}
+    try:
+        for thread, line in events:
+            spool = spools.get(thread)
+            if spool is None:
+                spool = spools[thread] = tempfile.TemporaryFile('w+')
+            spool.write(line + '\n')
+            if line.startswith('start'):
+                calls = activity.setdefault(line[9:], {})
+                calls[thread] = calls.get(thread, 0) + 1
+    except BaseException:
+        for spool in spools.values():
+            spool.close()
+        raise
+    for spool in spools.values():
+        spool.seek(0)
+    return spools, activity
+
+
+def thread_activity_lines(activity):
+    """
+    returns generator over the lines of a table of the number of calls of
+    each routine on each thread, from spool_thread_lines, most called
+    routines first
+    """
+    threads = sorted({t for calls in activity.values() for t in calls})
+    yield ''.join(['{:>10}  '.format('thread {}'.format(t)) for t in threads]
+                  + ['{:>10}  routine\n'.format('total')])
+    totals = {name: sum(calls.values()) for name, calls in activity.items()}
+    for name in sorted(activity, key=lambda x: (-totals[x], x)):
+        calls = activity[name]
+        yield ''.join(['{:>10}  '.format(calls.get(t, 0)) for t in threads]
+                      + ['{:>10}  {}\n'.format(totals[name], name)])
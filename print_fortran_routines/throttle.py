@@ -0,0 +1,102 @@
+"""
+Runtime throttling of the statements inserted into each routine.
+
+With throttle set, modify_fortran_file also declares a save variable at
+the end of the declarations of every routine it instruments, which is
+updated each time the routine is called, and the start and finish
+statements are only run for some of the calls. Routines which are called
+millions of times then cost a couple of integer operations per call
+rather than a formatted write, so long runs can be traced. The throttle is
+one of:
+
+- ('first', n): trace the first n calls of each routine, then stop
+- ('every', n): trace calls 1, n + 1, 2n + 1, ... of each routine
+- ('sample', rate): trace a fraction rate (0 < rate <= 1) of the calls of
+  each routine, picked with a small random number generator kept in the
+  routine (a 32 bit xorshift, so it doesn't touch the state of
+  random_number and runs are reproducible)
+
+Recursive routines aren't instrumented (see function_types), so a routine
+can't be called again before it finishes, and its finish statement sees
+the same value of the save variable as its start statement did. Calls
+which aren't traced are counted as part of the routine which called them
+by profile_mesa_trace.
+
+With threads=True the save variable is also made threadprivate, so each
+OpenMP thread counts its own calls (e.g. ('first', n) traces the first n
+calls on each thread) and a call's start and finish statements always
+agree. The directive starts in column 1, so it works in fixed and free
+form files, and is a comment when compiled without OpenMP.
+"""
+throttle_modes = ('first', 'every', 'sample')
+
+
+def check_throttle(throttle):
+    """
+    raises ValueError if throttle isn't None or a valid (mode, value)
+    """
+    if throttle is None:
+        return
+    try:
+        mode, value = throttle
+    except (TypeError, ValueError):
+        raise ValueError('throttle must be None or (mode, value)')
+    if mode not in throttle_modes:
+        raise ValueError('throttle mode must be one of {}'.format(
+            throttle_modes))
+    if mode == 'sample' and not 0 < value <= 1:
+        raise ValueError('sample rate must be between 0 and 1')
+    if mode != 'sample' and (int(value) != value or value < 1):
+        raise ValueError('number of calls must be a positive integer')
+
+
+def throttle_texts(start_text, finish_text, throttle, seed=1,
+                   threads=False):
+    """
+    Input:
+    - start_text, finish_text: statements inserted at the start and end of
+      a routine
+    - throttle: (mode, value) as described at the top of this file, or None
+    - seed: starting state of the random number generator for 'sample', a
+      positive integer below 2**31, e.g. the position of the routine
+    - threads: if True, the save variable is threadprivate
+
+    Returns: (declaration, start text, finish text), where the declaration
+    declares the save variable and goes at the end of the routine's
+    specification part (see spec_end), and the start and finish texts
+    update it and only run the statements on the calls which are traced.
+    The declaration is '' if throttle is None.
+    """
+    if throttle is None:
+        return '', start_text, finish_text
+    mode, value = throttle
+    variable = 'pfr_sample' if mode == 'sample' else 'pfr_calls'
+    if mode == 'first':
+        n = int(value)
+        header = ['      integer, save :: pfr_calls = 0\n',
+                  '      if (pfr_calls <= {0}) pfr_calls = pfr_calls + 1\n'
+                  .format(n)]
+        condition = 'pfr_calls <= {}'.format(n)
+    elif mode == 'every':
+        header = ['      integer, save :: pfr_calls = 0\n',
+                  '      pfr_calls = mod(pfr_calls, {}) + 1\n'.format(
+                      int(value))]
+        condition = 'pfr_calls == 1'
+    else:
+        # xorshift of a 32 bit state, which is never 0. Shifting it right
+        # by 1 gives a number from 0 to 2**31 - 1.
+        header = ['      integer(selected_int_kind(9)), save :: '
+                  'pfr_sample = {}\n'.format(seed)]
+        for shift in (13, -17, 5):
+            header.append('      pfr_sample = ieor(pfr_sample, '
+                          'ishft(pfr_sample, {}))\n'.format(shift))
+        condition = 'ishft(pfr_sample, -1) <= {}'.format(
+            int(round(value * 2**31)) - 1)
+    declaration = header.pop(0)
+    if threads:
+        declaration += '!$omp threadprivate({})\n'.format(variable)
+
+    if_text = '      if ({}) then\n'.format(condition)
+    return (declaration,
+            ''.join(header + [if_text, start_text, '      end if\n']),
+            ''.join([if_text, finish_text, '      end if\n']))
@@ -0,0 +1,231 @@
+"""
+Profiles of MESA runs instrumented with insert_format='time'.
+
+Each routine calls pfr_trace_time(id) when it starts and pfr_trace_time(-id)
+when it finishes, which records the ID along with the system_clock count
+(see compact.py). profile_time_trace goes through these once with a call
+stack and adds up, for every routine, the number of calls and the
+inclusive time (including the routines it calls) and exclusive time (not
+including them). It also adds up the exclusive time of every distinct call
+stack, which can be written as collapsed stacks for flame graph tools,
+e.g. flamegraph.pl or speedscope.
+
+Start and finish events are paired up as in nest_trace_lines. A routine
+left through an early 'return' never records its finish, so it is counted
+as 'unmatched' and its time is counted as part of the routine that called
+it. Recursive routines aren't instrumented (see function_types), so a
+routine which starts again while it is still open must also have left
+through an early return, and is closed then rather than nesting the new
+call inside it.
+
+A trace from pfr_trace_time_thread (threads=True, see threads.py) also has
+the OpenMP thread of every event. Each thread then has its own call stack,
+so the time of a routine is only counted in the routines which called it
+on the same thread, and the times are also added up for each thread.
+"""
+import os
+import sys
+from array import array
+
+from .compact import read_symbols
+
+chunk_size = 1 << 16  # events read at a time
+
+
+def read_time_trace(trace):
+    """
+    Input:
+    - trace: binary file object of a trace written by pfr_trace_time or
+      pfr_trace_time_thread
+
+    Returns: (clock count rate, generator over (thread, signed routine ID,
+    count)). The thread is always 0 for pfr_trace_time.
+    """
+    header = array('q', trace.read(16))
+    if len(header) != 2 or header[0] not in (0, 1):
+        raise ValueError('not a trace written by pfr_trace_time')
+    threads = header[0] == 1  # events are (thread, ID, count)
+    size = 24 if threads else 16
+
+    def read_events():
+        rest = b''
+        for chunk in iter(lambda: trace.read(size * chunk_size), b''):
+            chunk = rest + chunk
+            n = len(chunk) - len(chunk) % size
+            events = array('q', chunk[:n])
+            rest = chunk[n:]
+            if threads:
+                yield from zip(events[::3], events[1::3], events[2::3])
+            else:
+                for rid, count in zip(events[::2], events[1::2]):
+                    yield 0, rid, count
+
+    return header[1], read_events()
+
+
+def profile_time_trace(input_file, symbols_file):
+    """
+    Input:
+    - input_file: filename of a trace written by pfr_trace_time (e.g.
+      pfr_time.bin) or pfr_trace_time_thread (pfr_time_thread.bin), '-'
+      for stdin, or an open binary file object
+    - symbols_file: symbol table written by write_mesa_routines, or the
+      mesa_dir_print directory it is in
+
+    Returns: dictionary with
+    - 'routines': dictionary of routine, e.g. 'subroutine foo -- foo.f90' ->
+      {'calls', 'inclusive', 'exclusive', 'unmatched'}, with times in
+      seconds, added up over all threads
+    - 'threads': dictionary of thread -> the same for each thread (only
+      thread 0 for a trace without threads)
+    - 'stacks': dictionary of call stack (tuple of routines, outermost
+      first) -> exclusive time in seconds, added up over all threads
+    - 'total': seconds between the first and last events
+
+    Purpose: a single pass over the trace. Memory use depends on the number
+    of routines, distinct call stacks, threads and the call depth, not on
+    the length of the trace.
+    """
+    symbols = read_symbols(symbols_file)
+
+    def profile(trace):
+        rate, events = read_time_trace(trace)
+        threads = {}  # thread -> its totals, call stack and open routines
+        stacks = {}  # tuple of routine IDs -> exclusive counts
+        first = last = None
+        current = None  # thread of the totals and stack below
+
+        def close_unmatched(rid):
+            # routines above the open call of rid never finished, so their
+            # time is counted as part of the routine below them
+            while stack[-1][0] != rid:
+                frame = stack.pop()
+                open_ids[frame[0]] -= 1
+                unmatched[frame[0]] = unmatched.get(frame[0], 0) + 1
+                stack[-1][2] += frame[2]
+
+        for thread, rid, count in events:
+            if first is None:
+                first = count
+            last = count
+            if thread != current:
+                current = thread
+                if thread not in threads:
+                    # [routine ID, start count, counts in children, path]
+                    # for each open routine, and routine ID -> 1 if it is
+                    # open in the stack, else 0
+                    threads[thread] = ({}, {}, {}, {}, [], {})
+                calls, inclusive, exclusive, unmatched, stack, open_ids = \
+                    threads[thread]
+            if rid > 0:
+                if open_ids.get(rid):
+                    # the open call of rid left through an early return
+                    close_unmatched(rid)
+                    frame = stack.pop()
+                    open_ids[rid] -= 1
+                    unmatched[rid] = unmatched.get(rid, 0) + 1
+                    if stack:
+                        stack[-1][2] += frame[2]
+                path = stack[-1][3] + (rid,) if stack else (rid,)
+                stack.append([rid, count, 0, path])
+                open_ids[rid] = open_ids.get(rid, 0) + 1
+                continue
+
+            rid = -rid
+            if not open_ids.get(rid):
+                unmatched[rid] = unmatched.get(rid, 0) + 1
+                continue
+            close_unmatched(rid)
+
+            frame = stack.pop()
+            open_ids[rid] -= 1
+            duration = count - frame[1]
+            calls[rid] = calls.get(rid, 0) + 1
+            inclusive[rid] = inclusive.get(rid, 0) + duration
+            exclusive[rid] = exclusive.get(rid, 0) + duration - frame[2]
+            stacks[frame[3]] = stacks.get(frame[3], 0) + duration - frame[2]
+            if stack:
+                stack[-1][2] += duration
+
+        def name(rid):
+            routine, f_short, line = symbols.get(rid, ('id {}'.format(rid),
+                                                       'unknown', 0))
+            return ' -- '.join([routine, f_short])
+
+        def add_totals(routines, calls, inclusive, exclusive, unmatched):
+            for rid in set(calls) | set(unmatched):
+                totals = routines.setdefault(name(rid), {
+                    'calls': 0, 'inclusive': 0.0, 'exclusive': 0.0,
+                    'unmatched': 0})
+                totals['calls'] += calls.get(rid, 0)
+                totals['inclusive'] += inclusive.get(rid, 0) / rate
+                totals['exclusive'] += exclusive.get(rid, 0) / rate
+                totals['unmatched'] += unmatched.get(rid, 0)
+
+        routines = {}
+        thread_routines = {}
+        for thread in sorted(threads):
+            calls, inclusive, exclusive, unmatched, stack, open_ids = \
+                threads[thread]
+            # routines which were still open at the end never finished
+            for frame in stack:
+                unmatched[frame[0]] = unmatched.get(frame[0], 0) + 1
+            add_totals(routines, calls, inclusive, exclusive, unmatched)
+            add_totals(thread_routines.setdefault(thread, {}), calls,
+                       inclusive, exclusive, unmatched)
+
+        named_stacks = {}
+        for path, counts in stacks.items():
+            path = tuple(name(rid) for rid in path)
+            named_stacks[path] = named_stacks.get(path, 0) + counts / rate
+
+        total = 0.0 if first is None else (last - first) / rate
+        return {'routines': routines, 'threads': thread_routines,
+                'stacks': named_stacks, 'total': total}
+
+    if isinstance(input_file, (str, os.PathLike)) and input_file != '-':
+        with open(input_file, 'rb') as trace:
+            return profile(trace)
+    return profile(sys.stdin.buffer if input_file == '-' else input_file)
+
+
+def profile_report_lines(profile, sort='exclusive'):
+    """
+    returns generator over the lines of a table of the routines in profile,
+    sorted by sort ('exclusive', 'inclusive', 'calls' or 'unmatched'), most
+    first. If there is more than one thread, a table for each thread
+    follows.
+    """
+    yield 'total time: {:.6f} s\n'.format(profile['total'])
+    yield from routine_table_lines(profile['routines'], sort)
+    threads = profile.get('threads', {})
+    if len(threads) > 1:
+        for thread in sorted(threads):
+            yield '\nthread {}\n'.format(thread)
+            yield from routine_table_lines(threads[thread], sort)
+
+
+def routine_table_lines(routines, sort):
+    """
+    returns generator over the lines of a table of the totals of each
+    routine, as in profile['routines'], sorted by sort
+    """
+    yield '{:>10}  {:>14}  {:>14}  {:>9}  {}\n'.format(
+        'calls', 'inclusive (s)', 'exclusive (s)', 'unmatched', 'routine')
+    for name in sorted(routines, key=lambda x: (-routines[x][sort], x)):
+        totals = routines[name]
+        yield '{:>10}  {:>14.6f}  {:>14.6f}  {:>9}  {}\n'.format(
+            totals['calls'], totals['inclusive'], totals['exclusive'],
+            totals['unmatched'], name)
+
+
+def collapsed_stack_lines(profile):
+    """
+    returns generator over the call stacks in profile in the collapsed
+    format read by flame graph tools: routines separated by ';' followed by
+    the exclusive time in microseconds
+    """
+    for path in sorted(profile['stacks']):
+        microseconds = int(round(profile['stacks'][path] * 1e6))
+        if microseconds > 0:
+            yield '{} {}\n'.format(';'.join(path), microseconds)
@@ -0,0 +1,568 @@
+"""
+Streaming helpers for post-processing the terminal output of a MESA run
+with write(*,*) statements inserted by print_fortran_routines.
+
+Every step is a generator (read -> filter -> nest -> write), so the log is
+never held in memory. The log is read more than once: one pass to count
+how often each line occurs, one pass to pair up start and finish lines and
+one pass to write the tabbed output. The counts can be saved to a json
+sidecar file so the counting pass is skipped next time.
+"""
+import io
+import json
+import os
+import sys
+import tempfile
+from array import array
+
+separator = '\t\t'  # how much to tab in by
+starting = ('start', 'finsh')  # consider only lines beginning with
+chunk_size = 1 << 16  # bytes read from / written to status files at a time
+pending_limit = 1 << 16  # unmatched lines held in memory while nesting
+
+
+def trace_reader(input_file):
+    """
+    Input:
+    - input_file: filename of the MESA terminal output, '-' for stdin, or an
+      open file object
+
+    Returns: function which returns a new iterator over the stripped start
+    and finsh lines of input_file every time it is called
+
+    Purpose: lets the log be read several times without keeping it in
+    memory. Filenames are re-opened and seekable file objects are rewound
+    for every pass. Pipes such as stdin can only be read once, so their
+    start and finsh lines are copied to a temporary file on the first pass.
+    """
+    def read_lines(trace):
+        for line in trace:
+            line = line.strip()
+            if line.startswith(starting):
+                yield line
+
+    def read_path():
+        with open(input_file, 'r') as trace:
+            yield from read_lines(trace)
+
+    if isinstance(input_file, (str, os.PathLike)) and input_file != '-':
+        return read_path
+
+    trace = sys.stdin if input_file == '-' else input_file
+    if trace.seekable():
+        start = trace.tell()
+
+        def read_seekable():
+            trace.seek(start)
+            yield from read_lines(trace)
+        return read_seekable
+
+    spool = tempfile.TemporaryFile('w+')
+    for line in read_lines(trace):
+        spool.write(line + '\n')
+
+    def read_spool():
+        spool.seek(0)
+        yield from read_lines(spool)
+    return read_spool
+
+
+def split_trace_line(line):
+    """
+    returns (is start line, routine part, file part) of a start/finsh line,
+    e.g. (True, ' -- subroutine foo', ' -- foo.f90'). The two parts add up
+    to line[5:], so no information is lost.
+    """
+    rest = line[5:]
+    i = rest.rfind(' -- ')
+    if i < 0:
+        return line.startswith('start'), rest, ''
+    return line.startswith('start'), rest[:i], rest[i:]
+
+
+def new_trace_counts():
+    """
+    returns empty trace counts: the routine and file parts of the lines
+    interned to integer IDs, and the number of times each
+    (routine ID, file ID, is start line) key occurs. 'keys' caches the key
+    of each distinct line so lines only need to be split once.
+    """
+    return {'routines': {}, 'files': {}, 'counts': {}, 'keys': {}}
+
+
+def trace_line_key(trace_counts, line):
+    """
+    returns the (routine ID, file ID, is start line) key of line, giving new
+    IDs to routine and file parts which have not been seen before
+    """
+    key = trace_counts['keys'].get(line)
+    if key is not None:
+        return key
+
+    is_start, routine, file = split_trace_line(line)
+    routines, files = trace_counts['routines'], trace_counts['files']
+    rid = routines.get(routine)
+    if rid is None:
+        rid = routines[routine] = len(routines)
+    fid = files.get(file)
+    if fid is None:
+        fid = files[file] = len(files)
+    key = trace_counts['keys'][line] = (rid, fid, is_start)
+    return key
+
+
+def count_trace_lines(lines):
+    """
+    returns trace counts (see new_trace_counts) for the lines. Only the
+    distinct routine and file names are kept in memory, not the lines.
+    """
+    trace_counts = new_trace_counts()
+    counts = trace_counts['counts']
+    for line in lines:
+        key = trace_line_key(trace_counts, line)
+        counts[key] = counts.get(key, 0) + 1
+    return trace_counts
+
+
+def trace_source_stamp(input_file):
+    """
+    returns size and modification time of input_file, or None if it is not
+    a file on disk. Used to check that saved counts are up to date.
+    """
+    if not isinstance(input_file, (str, os.PathLike)) or input_file == '-':
+        return None
+    stat = os.stat(input_file)
+    return {'path': os.path.abspath(input_file), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def save_trace_counts(trace_counts, counts_file, input_file):
+    """
+    writes trace counts to counts_file as json, along with the size and
+    modification time of input_file
+    """
+    def by_id(ids):
+        names = [None] * len(ids)
+        for name, i in ids.items():
+            names[i] = name
+        return names
+
+    sidecar = {'version': 1,
+               'source': trace_source_stamp(input_file),
+               'routines': by_id(trace_counts['routines']),
+               'files': by_id(trace_counts['files']),
+               'counts': [[rid, fid, int(is_start), n] for
+                          (rid, fid, is_start), n in
+                          trace_counts['counts'].items()]}
+    with open(counts_file, 'w') as f:
+        json.dump(sidecar, f)
+
+
+def load_trace_counts(counts_file, input_file):
+    """
+    returns trace counts saved by save_trace_counts, or None if counts_file
+    does not exist or was made from a different version of input_file
+    """
+    try:
+        with open(counts_file, 'r') as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    source = trace_source_stamp(input_file)
+    if (sidecar.get('version') != 1 or source is None
+            or sidecar['source'] != source):
+        return None
+
+    trace_counts = new_trace_counts()
+    trace_counts['routines'] = {r: i for i, r in
+                                enumerate(sidecar['routines'])}
+    trace_counts['files'] = {f: i for i, f in enumerate(sidecar['files'])}
+    trace_counts['counts'] = {(rid, fid, bool(is_start)): n for
+                              rid, fid, is_start, n in sidecar['counts']}
+    return trace_counts
+
+
+def filter_trace_lines(lines, trace_counts, i_ignore=2, files=[]):
+    """
+    Input:
+    - lines: iterable of stripped start/finsh lines
+    - trace_counts: counts for the whole log from count_trace_lines
+    - i_ignore: lines which occur i_ignore times or more are dropped, unless
+      i_ignore is None
+    - files: if not empty, only lines ending in one of these are kept
+
+    Returns: generator over the lines which are kept
+
+    Purpose: second pass over the log. Whether to keep a line is worked out
+    once per distinct (routine, file) key and looked up after that.
+    """
+    files = tuple(files)
+    counts = trace_counts['counts']
+    if i_ignore is None:
+        i_ignore = float('inf')
+    keep = {}  # key -> whether lines with this key are kept
+    for line in lines:
+        key = trace_line_key(trace_counts, line)
+        kept = keep.get(key)
+        if kept is None:
+            kept = keep[key] = (counts.get(key, 0) < i_ignore and
+                                (not files or line.endswith(files)))
+        if kept:
+            yield line
+
+
+def spool_trace_ids(lines, spool):
+    """
+    Input:
+    - lines: iterable of stripped start/finsh lines
+    - spool: empty binary file, to which the ID of each line is written as
+      a 4 byte integer
+
+    Returns: (list of the distinct lines, where the index is the ID, list of
+    the number of times each distinct line occurs)
+
+    Purpose: a single pass over the log, after which it can be read again
+    from spool as small integer IDs, e.g. for several views of the same log
+    (see view_trace_lines). Only the distinct lines are kept in memory.
+    """
+    ids = {}  # distinct line -> ID
+    distinct = []
+    counts = []
+    chunk = array('i')
+    for line in lines:
+        lid = ids.get(line)
+        if lid is None:
+            lid = ids[line] = len(distinct)
+            distinct.append(line)
+            counts.append(0)
+        counts[lid] += 1
+        chunk.append(lid)
+        if len(chunk) >= chunk_size:
+            spool.write(chunk.tobytes())
+            chunk = array('i')
+    spool.write(chunk.tobytes())
+    return distinct, counts
+
+
+def keep_trace_ids(distinct, counts, i_ignore=2, files=[]):
+    """
+    returns bytearray with 1 for each distinct line from spool_trace_ids
+    which is kept with i_ignore and files, as in filter_trace_lines
+    """
+    files = tuple(files)
+    if i_ignore is None:
+        i_ignore = float('inf')
+    return bytearray(n < i_ignore and (not files or line.endswith(files))
+                     for line, n in zip(distinct, counts))
+
+
+def view_trace_lines(spool, distinct, keep):
+    """
+    Input:
+    - spool, distinct: IDs and distinct lines from spool_trace_ids
+    - keep: 1 for each distinct line which is kept, from keep_trace_ids
+
+    Returns: function which returns a new iterator over the kept lines
+    every time it is called, like trace_reader
+
+    Purpose: reads the log back from the IDs. Whether a line is kept is
+    looked up by its ID, so no lines are split or hashed again.
+    """
+    kept = [line if k else None for line, k in zip(distinct, keep)]
+
+    def read_lines():
+        spool.seek(0)
+        for chunk in iter(lambda: spool.read(4 * chunk_size), b''):
+            yield from filter(None, map(kept.__getitem__, array('i', chunk)))
+    return read_lines
+
+
+def match_trace_lines(lines, status_file):
+    """
+    Input:
+    - lines: iterable of stripped start/finsh lines
+    - status_file: empty binary file. One byte is written to it for each
+      line, which is 1 if the line is unmatched and 0 otherwise
+
+    Returns: number of lines
+
+    Purpose: pairs up start and finish lines with a call stack. See
+    nest_trace_lines for how unmatched lines are defined. Only the open
+    start lines are kept in memory, at most one for each routine. A start
+    line is only known to be unmatched once the routine around it finishes
+    or it starts again, so if its byte has already been written out it is
+    corrected in place.
+    """
+    chunk = bytearray()
+    offset = 0  # number of status bytes already written to status_file
+    stack = {}  # routine name -> index of its open start line, in order
+
+    def set_unmatched(i):
+        if i >= offset:
+            chunk[i - offset] = 1
+        else:
+            status_file.seek(i)
+            status_file.write(b'\x01')
+            status_file.seek(offset)
+
+    n_lines = 0
+    for i, line in enumerate(lines):
+        n_lines += 1
+        name = line[5:]
+        if line.startswith('start'):
+            if name in stack:
+                # the open call of the routine left through an early return
+                set_unmatched(stack.pop(name))
+            stack[name] = i
+            chunk.append(0)
+        elif name in stack:
+            # closes the open start, anything above it never finished
+            jname, j = stack.popitem()
+            while jname != name:
+                set_unmatched(j)
+                jname, j = stack.popitem()
+            chunk.append(0)
+        else:
+            chunk.append(1)
+
+        if len(chunk) >= chunk_size:
+            status_file.write(chunk)
+            offset += len(chunk)
+            chunk = bytearray()
+
+    status_file.write(chunk)
+    offset += len(chunk)
+
+    # start lines that are still open at the end of the log never finished
+    for j in stack.values():
+        set_unmatched(j)
+    return n_lines
+
+
+def read_status_file(status_file):
+    """
+    returns generator over the bytes written by match_trace_lines
+    """
+    status_file.seek(0)
+    for chunk in iter(lambda: status_file.read(chunk_size), b''):
+        yield from chunk
+
+
+def nest_matched_lines(lines, unmatched, depth=0, end_depth=0):
+    """
+    Input:
+    - lines: iterable of stripped start/finsh lines
+    - unmatched: iterable with 1 for each unmatched line and 0 otherwise,
+      as written by match_trace_lines
+    - depth: number of matched routines open before the first line
+    - end_depth: tabs for unmatched lines after the last matched start line
+
+    Returns: generator over (number of tabs, line)
+
+    Purpose: works out how far each line should be tabbed in, with only the
+    current depth in memory. Unmatched lines take their tabs from the next
+    matched start line, so they are held back until it arrives. After
+    pending_limit of them they are held in a temporary file instead.
+    """
+    pending = []  # (tabs or None, line) held back until next matched start
+    spool = None  # temporary file of further held back lines
+
+    def hold(tabs, line):
+        nonlocal spool
+        if not pending or len(pending) < pending_limit:
+            pending.append((tabs, line))
+            return
+        if spool is None:
+            spool = tempfile.TemporaryFile('w+')
+        spool.write('{}\t{}\n'.format('' if tabs is None else tabs, line))
+
+    def release(depth):
+        for tabs, line in pending:
+            yield (depth if tabs is None else tabs), line
+        pending.clear()
+        if spool is not None and spool.tell():
+            spool.seek(0)
+            for held in spool:
+                tabs, line = held[:-1].split('\t', 1)
+                yield (int(tabs) if tabs else depth), line
+            spool.seek(0)
+            spool.truncate()
+
+    try:
+        for line, flag in zip(lines, unmatched):
+            if flag:
+                hold(None, line)
+            elif line.startswith('start'):
+                if pending:
+                    yield from release(depth)
+                yield depth, line
+                depth += 1
+            else:
+                depth -= 1
+                if pending:
+                    hold(depth, line)
+                else:
+                    yield depth, line
+        yield from release(end_depth)
+    finally:
+        if spool is not None:
+            spool.close()
+
+
+def nest_trace_lines(lines):
+    """
+    Input:
+    - lines: list of stripped 'start -- ...' and 'finsh -- ...' lines, in the
+      order in which they were printed by MESA
+
+    Returns: list with the number of tabs for each line in lines
+
+    Purpose: pairs up each start line with its finish line using a call
+    stack and works out how far each line should be tabbed in. Runs in
+    linear time in the number of lines.
+
+    Policy for lines that do not pair up cleanly:
+    - a finish line closes the open start line of the same routine. Any
+      start lines still open above it never finished (e.g. the routine left
+      through an early 'return') and count as unmatched.
+    - a finish line with no open start line of the same routine is unmatched.
+    - recursive routines aren't instrumented (see function_types), so a
+      start line of a routine which is already open means the open call
+      left through an early 'return', and its start line is unmatched. The
+      start lines open above it stay open, as they may have been called
+      after it returned. So at most one call of each routine is open,
+      which bounds the memory used.
+    - a matched start line is tabbed in once for every matched routine that
+      is still open around it, and its finish line gets the same tabs.
+    - unmatched lines get the same tabs as the next matched start line, or
+      no tabs if there is none.
+
+    This differs from the original version, which paired each start line
+    with the next finish line of the same routine. After an early return
+    that version nested everything up to the routine's next finish inside
+    it, e.g. start a, start b, finsh b, start a, finsh a tabbed b in under
+    the first a, whereas here nothing is tabbed in. When every call
+    finishes the tabs are the same.
+    """
+    status_file = io.BytesIO()
+    match_trace_lines(lines, status_file)
+    unmatched = status_file.getvalue()
+    return [n for n, line in nest_matched_lines(lines, unmatched)]
+
+
+def nest_trace_events(read_lines, i_ignore=2, files=[], trace_counts=None):
+    """
+    Input:
+    - read_lines: function returning a new iterator over the stripped
+      start/finsh lines each time it is called, e.g. from trace_reader
+    - i_ignore, files: as in modify_mesa_terminal_output
+    - trace_counts: counts for the whole log from count_trace_lines. If None
+      they are counted first, which takes an extra pass over the log (but
+      not if i_ignore is None, as then they aren't needed)
+
+    Returns: generator over (number of tabs, line)
+
+    Purpose: streams the log through the count, filter, match and nest
+    steps. Memory use depends on the number of distinct lines, not on the
+    length of the log.
+    """
+    if trace_counts is None and i_ignore is None:
+        trace_counts = new_trace_counts()
+    elif trace_counts is None:
+        trace_counts = count_trace_lines(read_lines())
+
+    def read_kept():
+        return filter_trace_lines(read_lines(), trace_counts, i_ignore, files)
+    yield from nest_kept_events(read_kept)
+
+
+def nest_kept_events(read_lines):
+    """
+    returns generator over (number of tabs, line) for the lines from
+    read_lines, which are already filtered: the match and nest steps of
+    nest_trace_events
+    """
+    with tempfile.TemporaryFile() as status_file:
+        match_trace_lines(read_lines(), status_file)
+        yield from nest_matched_lines(read_lines(),
+                                      read_status_file(status_file))
+
+
+def nest_trace(read_lines, i_ignore=2, files=[], trace_counts=None):
+    """
+    returns generator over the tabbed output lines of the log, with the
+    same inputs as nest_trace_events
+    """
+    return tabbed_trace_lines(nest_trace_events(read_lines, i_ignore, files,
+                                                trace_counts))
+
+
+def tabbed_trace_lines(events):
+    """
+    returns generator over the output lines for (number of tabs, line)
+    events, e.g. from nest_trace_events
+    """
+    for n, line in events:
+        yield n*separator + line + '\n'
+
+
+def aggregate_trace_events(events):
+    """
+    Input:
+    - events: iterable of (number of tabs, line) from nest_trace_events
+
+    Returns: call tree as nested lists [number of calls, children], where
+    children is a dictionary of routine -> node, in the order they were
+    first called. The root node is the routines called at the top level.
+
+    Purpose: merges every call with the same call path (the routines it
+    was called from) into one node, counting the calls. Repeated subtrees,
+    e.g. solver iterations, become a single subtree, so memory depends on
+    the number of distinct call paths rather than the number of calls.
+    Only start lines are counted. Unmatched start lines are calls with no
+    children, at the depth they were tabbed to.
+    """
+    root = [0, {}]
+    path = [root]  # nodes of the routines open at each depth
+    for n, line in events:
+        add_trace_event(path, n, line)
+    return root
+
+
+def add_trace_event(path, n, line):
+    """
+    adds a (number of tabs, line) event to a call tree from
+    aggregate_trace_events, where path is the list of nodes of the
+    routines open at each depth, starting with the root
+    """
+    if not line.startswith('start'):
+        return
+    # depth can only be one more than the open routines
+    n = min(n, len(path) - 1)
+    del path[n + 1:]
+    children = path[n][1]
+    node = children.get(line[9:])
+    if node is None:
+        node = children[line[9:]] = [0, {}]
+    node[0] += 1
+    path.append(node)
+
+
+def call_tree_lines(root):
+    """
+    returns generator over the lines of a call tree from
+    aggregate_trace_events, one line per call path, tabbed in like the
+    nested output and followed by the number of calls, e.g.
+    '\t\tsubroutine foo -- foo.f90 (x12)'
+    """
+    stack = [(0, iter(root[1].items()))]  # depth, children left to write
+    while stack:
+        depth, children = stack[-1]
+        for name, node in children:
+            yield '{}{} (x{})\n'.format(depth*separator, name, node[0])
+            if node[1]:
+                stack.append((depth + 1, iter(node[1].items())))
+            break
+        else:
+            stack.pop()
@@ -12,6 +12,11 @@ setup(
     long_description_content_type="text/markdown",
     url="https://github.com/onfarrell/sampleproject",
     packages=['print_fortran_routines'],
+    entry_points={
+        'console_scripts': [
+            'pfr-follow=print_fortran_routines.cli:follow_main',
+        ],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,197 @@
+"""
+Tests for the cache of instrumented files, and for instrumenting, resetting
+and planning a small MESA tree.
+"""
+import os
+import shutil
+
+import pytest
+
+import print_fortran_routines as pfr
+from print_fortran_routines import cache
+
+# file within a MESA directory -> its routines
+mesa_files = {'star/private/evolve.f90': ['do_evolve', 'take_step'],
+              'star/private/micro.f90': ['set_micro'],
+              'star/job/run_star.f': ['run_star'],
+              'eos/public/eos_lib.f90': ['eos_get', 'eos_shutdown'],
+              'net/public/net_lib.f90': ['net_get'],
+              'include/standard_run_star_extras.inc': ['extras_check']}
+
+
+def fortran_text(name, routines):
+    """
+    returns text of a free form module with one subroutine per routine
+    """
+    return ''.join(['module m_{}\n'.format(name), '   contains\n'] +
+                   ['   subroutine {0}(x)\n'
+                    '      real, intent(inout) :: x\n'
+                    '      x = x + 1\n'
+                    '   end subroutine {0}\n'.format(r) for r in routines] +
+                   ['end module m_{}\n'.format(name)])
+
+
+@pytest.fixture
+def mesa_tree(tmp_path):
+    """
+    returns (mesa_dir, mesa_dir_print) of a small MESA installation and a
+    copy of it to instrument
+    """
+    mesa_dir = str(tmp_path / 'mesa')
+    for name, routines in mesa_files.items():
+        path = os.path.join(mesa_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(fortran_text(os.path.basename(name).split('.')[0],
+                                 routines))
+    mesa_dir_print = str(tmp_path / 'mesa_print')
+    shutil.copytree(mesa_dir, mesa_dir_print)
+    return mesa_dir, mesa_dir_print
+
+
+def tree_files(mesa_dir):
+    """
+    returns dictionary of each file in mesa_dir, e.g. 'star/job/run_star.f',
+    -> its text, leaving out the manifest
+    """
+    texts = {}
+    for root, dirs, files in os.walk(mesa_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if name != cache.manifest_name:
+                with open(path) as f:
+                    texts[os.path.relpath(path, mesa_dir)] = f.read()
+    return texts
+
+
+def selection(mesa_dir, names):
+    """
+    returns list of the paths of files names within mesa_dir
+    """
+    return [mesa_dir + '/' + name for name in names]
+
+
+def test_key_depends_on_settings(tmp_path, monkeypatch):
+    source = tmp_path / 'foo.f90'
+    source.write_text('subroutine foo\nend subroutine foo\n')
+    key = cache.cache_key(str(source), '0.0.1', [], 'write')
+    assert key == cache.cache_key(str(source), '0.0.1', [], 'write')
+    assert key != cache.cache_key(str(source), '0.0.1', [], 'id')
+    assert key != cache.cache_key(str(source), '0.0.1', ['subroutine foo'],
+                                  'write')
+    monkeypatch.setattr(cache, 'instrument_version',
+                        cache.instrument_version + 1)
+    assert key != cache.cache_key(str(source), '0.0.1', [], 'write')
+
+
+def test_key_of_missing_file(tmp_path):
+    assert cache.cache_key(str(tmp_path / 'foo.f90'), '0.0.1', [],
+                           'write') is None
+
+
+def test_workers_match_serial(mesa_tree, tmp_path):
+    mesa_dir, mesa_dir_print = mesa_tree
+    other_print = str(tmp_path / 'other_print')
+    shutil.copytree(mesa_dir_print, other_print)
+    files = selection(mesa_dir, mesa_files)
+    serial = pfr.write_mesa_routines(mesa_dir, mesa_dir_print, files=files,
+                                     insert_format='id')
+    summary = pfr.write_mesa_routines(mesa_dir, other_print, files=files,
+                                      insert_format='id', workers=2)
+    for key in ('changed', 'unchanged', 'reset'):
+        assert summary[key] == [x.replace(mesa_dir_print, other_print)
+                                for x in serial[key]]
+    assert summary['errors'] == serial['errors'] == {}
+    assert summary['modules'] == serial['modules']
+    assert len(serial['changed']) == len(mesa_files)
+    assert tree_files(other_print) == tree_files(mesa_dir_print)
+
+
+def test_reset_only_instrumented_files(mesa_tree):
+    mesa_dir, mesa_dir_print = mesa_tree
+    original = tree_files(mesa_dir)
+    first = ['star/private/evolve.f90', 'eos/public/eos_lib.f90']
+    pfr.write_mesa_routines(mesa_dir, mesa_dir_print,
+                            files=selection(mesa_dir, first))
+    micro = os.path.join(mesa_dir_print, 'star/private/micro.f90')
+    with open(micro, 'a') as f:
+        f.write('! a change of our own\n')
+
+    # the files instrumented last time go back to the originals, and the
+    # file which wasn't instrumented is left alone
+    second = ['net/public/net_lib.f90']
+    summary = pfr.write_mesa_routines(mesa_dir, mesa_dir_print,
+                                      files=selection(mesa_dir, second))
+    assert sorted(summary['reset']) == sorted(selection(mesa_dir_print,
+                                                        first))
+    assert summary['changed'] == selection(mesa_dir_print, second)
+    assert summary['modules'] == ['eos', 'net', 'star']
+    texts = tree_files(mesa_dir_print)
+    for name in first:
+        assert texts[name] == original[name]
+    assert texts[second[0]] != original[second[0]]
+    assert texts['star/private/micro.f90'].endswith('of our own\n')
+
+    # reset files aren't copied again, so they aren't recompiled
+    evolve = os.path.join(mesa_dir_print, first[0])
+    mtime = os.stat(evolve).st_mtime_ns
+    summary = pfr.write_mesa_routines(mesa_dir, mesa_dir_print,
+                                      files=selection(mesa_dir, second))
+    assert summary['reset'] == summary['changed'] == []
+    assert summary['modules'] == []
+    assert os.stat(evolve).st_mtime_ns == mtime
+
+    # a full reset compares every file with the original
+    summary = pfr.write_mesa_routines(mesa_dir, mesa_dir_print,
+                                      files=selection(mesa_dir, second),
+                                      reset='full')
+    assert summary['reset'] == [micro]
+    assert tree_files(mesa_dir_print)['star/private/micro.f90'] == \
+        original['star/private/micro.f90']
+
+
+def test_plan_matches_changes(mesa_tree):
+    mesa_dir, mesa_dir_print = mesa_tree
+    pfr.write_mesa_routines(mesa_dir, mesa_dir_print, files=selection(
+        mesa_dir, ['star/private/evolve.f90', 'star/job/run_star.f']))
+    files = selection(mesa_dir, ['star/job/run_star.f',
+                                 'eos/public/eos_lib.f90',
+                                 'include/standard_run_star_extras.inc'])
+    before = tree_files(mesa_dir_print)
+    with open(os.path.join(mesa_dir_print, cache.manifest_name)) as f:
+        manifest = f.read()
+    plan = pfr.plan_mesa_routines(mesa_dir, mesa_dir_print, files=files)
+
+    # nothing is written, reset or recorded
+    assert tree_files(mesa_dir_print) == before
+    with open(os.path.join(mesa_dir_print, cache.manifest_name)) as f:
+        assert f.read() == manifest
+    assert plan['modules'] == ['eos', 'star', 'work']
+
+    summary = pfr.write_mesa_routines(mesa_dir, mesa_dir_print, files=files)
+    for key in ('changed', 'reset', 'modules'):
+        assert sorted(plan[key]) == sorted(summary[key])
+    after = tree_files(mesa_dir_print)
+    assert sorted(plan['changed'] + plan['reset']) == sorted(
+        mesa_dir_print + '/' + name for name in after
+        if after[name] != before[name])
+
+    # once it is done there is nothing left to do
+    plan = pfr.plan_mesa_routines(mesa_dir, mesa_dir_print, files=files)
+    assert plan['changed'] == plan['reset'] == plan['modules'] == []
+
+
+def test_plan_from_previous_files(mesa_tree):
+    mesa_dir, mesa_dir_print = mesa_tree
+    previous = selection(mesa_dir, ['net/public/net_lib.f90'])
+    pfr.write_mesa_routines(mesa_dir, mesa_dir_print, files=previous)
+    os.remove(os.path.join(mesa_dir_print, cache.manifest_name))
+    with open(os.path.join(mesa_dir_print, 'star/private/micro.f90'),
+              'a') as f:
+        f.write('! a change of our own\n')
+    # without the manifest every file would be compared, but the previous
+    # selection says which files to reset
+    plan = pfr.plan_mesa_routines(mesa_dir, mesa_dir_print, files=[],
+                                  previous_files=previous)
+    assert plan['reset'] == [mesa_dir_print + '/net/public/net_lib.f90']
+    assert plan['modules'] == ['net']
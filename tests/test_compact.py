@@ -0,0 +1,143 @@
+"""
+Tests that routine IDs written to a compact trace decode to the routines
+they were inserted into.
+"""
+import io
+import os
+import re
+import shutil
+from array import array
+
+import pytest
+
+import print_fortran_routines as pfr
+from print_fortran_routines import compact
+
+module_text = """\
+module {0}
+   contains
+{1}end module {0}
+"""
+
+routine_text = """\
+   subroutine {0}(x)
+      real, intent(inout) :: x
+      x = x + 1
+   end subroutine {0}
+"""
+
+
+def write_module(path, routines):
+    """
+    writes a module with one subroutine per name in routines to path
+    """
+    path.write_text(module_text.format(
+        path.stem, ''.join(routine_text.format(r) for r in routines)))
+
+
+def inserted_ids(lines):
+    """
+    returns dictionary of routine name -> (start ID, finish ID) of the
+    call pfr_trace statements inserted into it, from instrumented lines
+    """
+    ids = {}
+    for line in lines:
+        routine = re.match(r'\s*subroutine (\w+)', line)
+        if routine:
+            name = routine.group(1)
+        call = re.match(r'\s*call pfr_trace\((-?\d+)\)', line)
+        if call:
+            ids[name] = ids.get(name, ()) + (int(call.group(1)),)
+    return ids
+
+
+def test_routine_ids():
+    assert compact.routine_id(1, 1) == compact.max_routines + 1
+    assert compact.routine_id(3, 9999) == 3*compact.max_routines + 9999
+    with pytest.raises(ValueError):
+        compact.routine_id(3, compact.max_routines)
+
+
+def test_trace_decodes_to_routines(tmp_path):
+    mesa_dir = tmp_path / 'mesa'
+    (mesa_dir / 'star').mkdir(parents=True)
+    (mesa_dir / 'eos').mkdir()
+    routines = {'star/evolve.f90': ['do_evolve', 'take_step', 'set_vars'],
+                'eos/eos_lib.f90': ['eos_get']}
+    for name, names in routines.items():
+        write_module(mesa_dir / name, names)
+    mesa_dir_print = tmp_path / 'mesa_print'
+    shutil.copytree(str(mesa_dir), str(mesa_dir_print))
+    summary = pfr.write_mesa_routines(
+        str(mesa_dir), str(mesa_dir_print), insert_format='id',
+        files=[str(mesa_dir / name) for name in routines], reset=False)
+    assert summary['errors'] == {}
+
+    # the IDs inserted into each routine, and the lines they decode to
+    ids = {}
+    lines = {}
+    for name in routines:
+        with open(str(mesa_dir_print / name)) as f:
+            inserted = inserted_ids(f)
+        assert sorted(inserted) == sorted(routines[name])
+        for routine, (start, finish) in inserted.items():
+            assert finish == -start
+            ids[routine] = start
+            lines[routine] = ' -- subroutine {} -- {}'.format(
+                routine, os.path.basename(name))
+    assert len(set(ids.values())) == len(ids)
+
+    trace = array('i', [ids['do_evolve'], ids['take_step'],
+                        ids['eos_get'], -ids['eos_get'], -ids['take_step'],
+                        ids['set_vars'], -ids['set_vars'],
+                        -ids['do_evolve']])
+    expected = ['start' + lines['do_evolve'], 'start' + lines['take_step'],
+                'start' + lines['eos_get'], 'finsh' + lines['eos_get'],
+                'finsh' + lines['take_step'], 'start' + lines['set_vars'],
+                'finsh' + lines['set_vars'], 'finsh' + lines['do_evolve']]
+    trace_file = tmp_path / 'pfr_trace.bin'
+    trace_file.write_bytes(trace.tobytes())
+    for symbols_file in (str(mesa_dir_print), str(
+            mesa_dir_print / compact.symbols_name)):
+        read_lines = compact.compact_trace_reader(str(trace_file),
+                                                  symbols_file)
+        assert list(read_lines()) == expected
+        assert list(read_lines()) == expected
+    read_lines = compact.compact_trace_reader(io.BytesIO(trace.tobytes()),
+                                              str(mesa_dir_print))
+    assert list(read_lines()) == expected
+
+    # and the symbol table has the lines of the routines in the original
+    for rid, (routine, f_short, line) in compact.read_symbols(
+            str(mesa_dir_print)).items():
+        name, = [x for x in routines if x.endswith(f_short)]
+        with open(str(mesa_dir / name)) as f:
+            assert f.readlines()[line - 1].strip().startswith(routine)
+        assert ids[routine.split()[1]] == rid
+
+    trace_file.write_bytes(array('i', [ids['eos_get'] + 1]).tobytes())
+    with pytest.raises(ValueError):
+        list(compact.compact_trace_reader(str(trace_file),
+                                          str(mesa_dir_print))())
+
+
+def test_too_many_routines(tmp_path):
+    source = tmp_path / 'big.f90'
+    write_module(source, ['r{}'.format(i) for i in
+                          range(compact.max_routines)])
+    with pytest.raises(ValueError):
+        pfr.modify_fortran_file(str(source), str(tmp_path / 'out.f90'),
+                                insert_format='id', file_id=1, symbols=[])
+    # an instrumented MESA tree reports the file and leaves it alone
+    mesa_dir = tmp_path / 'mesa'
+    (mesa_dir / 'star').mkdir(parents=True)
+    (mesa_dir / 'star' / 'big.f90').write_text(source.read_text())
+    mesa_dir_print = tmp_path / 'mesa_print'
+    shutil.copytree(str(mesa_dir), str(mesa_dir_print))
+    summary = pfr.write_mesa_routines(
+        str(mesa_dir), str(mesa_dir_print), insert_format='id',
+        files=[str(mesa_dir / 'star' / 'big.f90')], reset=False)
+    assert list(summary['errors']) == [str(mesa_dir / 'star' / 'big.f90')]
+    assert summary['changed'] == []
+    assert (mesa_dir_print / 'star' / 'big.f90').read_text() == \
+        source.read_text()
@@ -0,0 +1,85 @@
+"""
+Tests for the live nesting used by pfr-follow.
+"""
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+from print_fortran_routines import cli
+from print_fortran_routines.follow import live_nest_events, new_live_state
+from print_fortran_routines.trace import nest_trace_lines
+
+from test_trace import random_calls
+
+
+def live_tabs(blocks):
+    """
+    returns list of the number of tabs of each line in blocks of lines
+    """
+    state = new_live_state()
+    return [n for block in blocks
+            for n, line in live_nest_events(state, block)]
+
+
+def test_matches_batch_when_every_call_finishes():
+    rng = random.Random(2)
+    for _ in range(20):
+        lines = random_calls(rng)
+        blocks = [lines[i:i + 7] for i in range(0, len(lines), 7)]
+        assert live_tabs(blocks) == nest_trace_lines(lines)
+
+
+def test_restart_closes_earlier_call():
+    lines = ['start -- a', 'start -- b', 'start -- a', 'finsh -- a',
+             'finsh -- b']
+    assert live_tabs([lines]) == [0, 1, 1, 1, 0]
+
+
+def test_early_returns_keep_one_open_call():
+    state = new_live_state()
+    tabs = [n for n, line in live_nest_events(state, ['start -- f'] * 1000)]
+    assert tabs == [0] * 1000
+    assert state['stack'] == {' -- f': True}
+
+
+def test_closed_pipe(tmp_path):
+    # pfr-follow piped into head, which stops reading after one line
+    log = tmp_path / 'output.txt'
+    log.write_text('start -- a\nfinsh -- a\n' * 100000)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    follow = subprocess.Popen(
+        [sys.executable, '-m', 'print_fortran_routines.cli', str(log),
+         '--idle-timeout', '0.1', '--interval', '0'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=root)
+    assert follow.stdout.readline() == b'start -- a\n'
+    follow.stdout.close()
+    assert follow.wait(timeout=60) == 1
+    assert follow.stderr.read() == b''
+    follow.stderr.close()
+
+
+def test_closed_pipe_keeps_stderr(tmp_path, monkeypatch):
+    def closed_pipe(*args, **kwargs):
+        raise BrokenPipeError
+
+    monkeypatch.setattr(cli, 'follow_mesa_terminal_output', closed_pipe)
+    with open(str(tmp_path / 'stdout.txt'), 'w') as stdout, \
+            open(str(tmp_path / 'stderr.txt'), 'w') as stderr:
+        saved = os.dup(stdout.fileno())
+        monkeypatch.setattr(sys, 'stdout', stdout)
+        monkeypatch.setattr(sys, 'stderr', stderr)
+        try:
+            with pytest.raises(SystemExit) as exit_info:
+                cli.follow_main(['output.txt'])
+            # later output goes nowhere, and errors can still be reported
+            stdout.write('more output\n')
+            stdout.flush()
+        finally:
+            os.dup2(saved, stdout.fileno())
+            os.close(saved)
+        assert not stderr.closed
+    assert exit_info.value.code == 1
+    assert (tmp_path / 'stdout.txt').read_text() == ''
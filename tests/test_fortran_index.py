@@ -0,0 +1,227 @@
+"""
+Tests pinning where the start of a routine and its declarations end.
+"""
+from print_fortran_routines.fortran_index import (correct_startline,
+                                                  index_fortran_lines,
+                                                  spec_end)
+
+
+def startline(lines):
+    """
+    returns correct_startline for lines, which are one whole routine
+    """
+    lower = [l.strip().lower() for l in lines]
+    end_selects = [i for i, l in enumerate(lower) if l == 'end select']
+    return correct_startline(lower, 0, len(lower) - 1, end_selects)
+
+
+def specline(lines):
+    """
+    returns spec_end for lines, which are one whole routine
+    """
+    lower = [l.strip().lower() for l in lines]
+    return spec_end(lower, 0, len(lower) - 1)
+
+
+def test_declarations():
+    assert startline(['subroutine foo(x)',
+                      '   real, intent(in) :: x',
+                      '   integer :: i',
+                      '   i = 1',
+                      'end subroutine foo']) == 3
+
+
+def test_fortran_types_prefixes():
+    assert startline(['integer function foo(x)',
+                      'use bar, only: baz',
+                      'implicit none',
+                      'double precision, intent(in) :: x',
+                      'character (len=8) :: c',
+                      'logical :: l',
+                      'type (star_info), pointer :: s',
+                      'complex :: z',
+                      'procedure(baz), pointer :: p',
+                      'include "formats"',
+                      'save',
+                      'call baz(x)',
+                      'end function foo']) == 11
+
+
+def test_prefix_match_includes_assignments():
+    # only the start of the line is looked at, so an assignment to a
+    # variable whose name starts with a type is taken as a declaration
+    assert startline(['subroutine foo(x)',
+                      'real :: x',
+                      'real_part = x',
+                      'x = 1',
+                      'end subroutine foo']) == 3
+
+
+def test_continuation():
+    assert startline(['subroutine foo(x, &',
+                      '      y)',
+                      'real, intent(in) :: x, &',
+                      '   y',
+                      'x = 1',
+                      'end subroutine foo']) == 4
+
+
+def test_comments():
+    assert startline(['subroutine foo(x)',
+                      '! what foo does',
+                      '',
+                      'real :: x',
+                      'x = 1',
+                      'end subroutine foo']) == 4
+
+
+def test_line_after_comment_is_skipped():
+    # a line containing '!' is taken to continue, so the line after a
+    # trailing comment is skipped even when it is executable
+    assert startline(['subroutine foo(x)',
+                      'real, intent(inout) :: x ! the input value',
+                      'x = x + 1',
+                      'x = 2*x',
+                      'end subroutine foo']) == 3
+
+
+def test_select_case():
+    # lines up to the last 'end select' of the routine can be inside a case
+    assert startline(['subroutine foo(k)',
+                      'integer :: k',
+                      'select case (k)',
+                      'case (1)',
+                      '   k = 2',
+                      'end select',
+                      'k = 3',
+                      'end subroutine foo']) == 6
+
+
+def test_select_case_without_end_select():
+    assert startline(['subroutine foo(k)',
+                      'integer :: k',
+                      'select case (k)',
+                      'k = 3',
+                      'end subroutine foo']) == 3
+
+
+def test_omp_directives():
+    assert startline(['subroutine foo(x)',
+                      'real, save :: x',
+                      '!$omp threadprivate(x)',
+                      '!$omp parallel do',
+                      'end subroutine foo']) == 3
+
+
+def test_all_header():
+    assert startline(['subroutine foo(x)',
+                      'real :: x',
+                      'end subroutine foo']) == 2
+
+
+def test_spec_end_at_first_executable_statement():
+    assert specline(['subroutine foo(x)',
+                     'real, intent(inout) :: x ! the input value',
+                     'x = x + 1',
+                     'x = 2*x',
+                     'end subroutine foo']) == 2
+
+
+def test_spec_end_after_last_declaration():
+    # comments after the declarations are left after inserted ones
+    assert specline(['subroutine foo(x, &',
+                     '   y)',
+                     '! comment',
+                     'use bar, only: a => b',
+                     'implicit none',
+                     'real, intent(in) :: x, & ! the inputs',
+                     '   y',
+                     '',
+                     '#define DEBUG 1',
+                     '100 format(a)',
+                     '! what happens next',
+                     'call baz(x, y)',
+                     'end subroutine foo']) == 10
+
+
+def test_spec_end_without_declarations():
+    assert specline(['subroutine foo(x, &',
+                     '   y)',
+                     'call baz(x, y)',
+                     'end subroutine foo']) == 2
+
+
+def test_spec_end_skips_blocks():
+    assert specline(['subroutine foo()',
+                     'interface',
+                     '   subroutine bar(x)',
+                     '      real :: x',
+                     '   end subroutine bar',
+                     'end interface',
+                     'type, extends(base) :: pair',
+                     '   integer :: a = 1',
+                     'end type pair',
+                     'type(pair) :: p',
+                     'p%a = 2',
+                     'end subroutine foo']) == 10
+
+
+def test_spec_end_assignments():
+    # statements starting with a keyword which are assignments
+    for line in ['real_part = 1', 'type = 2', 'data(1) = 3', 'save = 4',
+                 'pointer => target']:
+        assert specline(['subroutine foo()', 'real :: x', line,
+                         'end subroutine foo']) == 2
+    assert specline(['subroutine foo()', 'real :: x = 1.0, y(3) = 2',
+                     "character(len=3) :: s = 'a;b' ! x = 1",
+                     'end subroutine foo']) == 3
+
+
+def test_spec_end_select_case():
+    assert specline(['subroutine foo(k)',
+                     'integer :: k',
+                     'select case (k)',
+                     'case (1)',
+                     '   k = 2',
+                     'end select',
+                     'end subroutine foo']) == 2
+
+
+def test_spec_end_statements_on_one_line():
+    assert specline(['subroutine foo()',
+                     'real :: x; real :: y',
+                     'real :: z; z = 1',
+                     'end subroutine foo']) == 2
+
+
+def test_spec_end_omp_directives():
+    assert specline(['subroutine foo()',
+                     'real, save :: x',
+                     '!$omp threadprivate(x)',
+                     '!$ use omp_lib',
+                     '!$omp parallel',
+                     '!$omp end parallel',
+                     'end subroutine foo']) == 4
+
+
+def test_spec_end_contains():
+    assert specline(['subroutine foo()',
+                     'real :: x',
+                     'contains',
+                     'subroutine bar()',
+                     'real :: y',
+                     'end subroutine bar',
+                     'end subroutine foo']) == 2
+
+
+def test_header_end_in_file():
+    lines = ['module m\n',
+             'contains\n',
+             'subroutine foo(x)\n',
+             '   real :: x\n',
+             '   x = 1\n',
+             'end subroutine foo\n',
+             'end module m\n']
+    routine, = index_fortran_lines(lines)['routines']
+    assert (routine['start'], routine['header_end'], routine['spec_end'],
+            routine['end']) == (2, 4, 4, 5)
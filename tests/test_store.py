@@ -0,0 +1,149 @@
+"""
+Tests of the trace store against the nested output and brute force
+queries.
+"""
+import os
+import random
+
+import print_fortran_routines as pfr
+from print_fortran_routines import store as trace_store
+from print_fortran_routines.trace import nest_trace_lines, separator
+
+from test_trace import early_return_lines, random_calls, write_log
+
+
+def make_store(tmp_path, lines, name='store'):
+    """
+    returns store of the log with lines, written in tmp_path
+    """
+    log = tmp_path / (name + '.txt')
+    write_log(log, lines)
+    return pfr.write_trace_store(str(log), str(tmp_path / name))
+
+
+def test_store_matches_nested_output(tmp_path):
+    rng = random.Random(7)
+    for k in range(10):
+        lines = random_calls(rng)
+        store = make_store(tmp_path, lines, 'store{}'.format(k))
+        expected = [n*separator + line + '\n' for n, line in
+                    zip(nest_trace_lines(lines), lines)]
+        assert list(pfr.store_trace_lines(
+            store, range(store['n_calls']))) == expected
+        assert store['n_lines'] == len(lines)
+        assert store['unmatched_start'] == store['unmatched_finish'] == 0
+
+
+def test_columns_with_early_returns(tmp_path):
+    rng = random.Random(8)
+    for k in range(10):
+        lines = early_return_lines(rng, 300)
+        store = make_store(tmp_path, lines, 'store{}'.format(k))
+        tabs = nest_trace_lines(lines)
+        starts = [i for i, line in enumerate(lines) if line[:5] == 'start']
+        assert list(store['enter']) == starts
+        unmatched = 0
+        for row, pos in enumerate(starts):
+            assert pfr.call_name(store, row) == lines[pos][9:]
+            exit_ = store['exit'][row]
+            ancestors = pfr.call_ancestors(store, row)
+            # the calls open around it, which finish after it
+            assert store['depth'][row] == len(ancestors)
+            assert all(store['exit'][a] > pos for a in ancestors)
+            if exit_ < 0:
+                unmatched += 1
+                assert list(pfr.call_subtree(store, row)) == [row]
+                continue
+            assert store['depth'][row] == tabs[pos] == tabs[exit_]
+            assert lines[exit_] == 'finsh' + lines[pos][5:]
+            # the calls under it are the ones which start before it ends
+            assert list(pfr.call_subtree(store, row)) == [
+                r for r, p in enumerate(starts) if pos <= p < exit_]
+        assert store['unmatched_start'] == unmatched
+        assert store['unmatched_finish'] == sum(
+            line[:5] == 'finsh' for line in lines) - (len(starts) -
+                                                      unmatched)
+
+
+def test_calls_in_range(tmp_path):
+    rng = random.Random(9)
+    lines = early_return_lines(rng, 400)
+    store = make_store(tmp_path, lines)
+    enter, exit_ = store['enter'], store['exit']
+
+    def running(row, start, stop):
+        if exit_[row] < 0:
+            return start <= enter[row] < stop
+        return enter[row] < stop and exit_[row] >= start
+
+    for _ in range(300):
+        start = rng.randrange(len(lines) + 1)
+        stop = rng.randrange(start, len(lines) + 2)
+        assert pfr.calls_in_range(store, start, stop) == [
+            row for row in range(store['n_calls'])
+            if running(row, start, stop)]
+
+
+def test_routine_queries(tmp_path):
+    routines = {'a': 'subroutine a -- a.f90', 'b': 'subroutine b -- b.f90',
+                'c': 'function c -- b.f90'}
+    lines = [('start -- ' if x.isupper() else 'finsh -- ') +
+             routines[x.lower()] for x in 'ABbBCcbaBb']
+    store = make_store(tmp_path, lines)
+    b = 'subroutine b -- b.f90'
+    assert [store['names'][i] for i in pfr.find_routines(store, 'b.f90')] \
+        == [b, 'function c -- b.f90']
+    assert list(pfr.routine_calls(store, b)) == [1, 2, 4]
+    assert list(pfr.routine_calls(store, store['ids'][b])) == [1, 2, 4]
+    assert pfr.routine_counts(store, pfr.call_subtree(store, 0)) == {
+        b: 2, 'subroutine a -- a.f90': 1, 'function c -- b.f90': 1}
+    tab = separator
+    assert list(pfr.store_trace_lines(store, pfr.call_subtree(store, 2))) \
+        == ['start -- ' + b + '\n', tab + 'start -- function c -- b.f90\n',
+            tab + 'finsh -- function c -- b.f90\n', 'finsh -- ' + b + '\n']
+
+
+def test_diverging_calls(tmp_path):
+    rng = random.Random(10)
+    lines = random_calls(rng, n_calls=100)
+    store = make_store(tmp_path, lines)
+    # each call matches itself, in the same store or a copy of the run
+    copy = make_store(tmp_path, lines, 'copy')
+    for row in range(store['n_calls']):
+        assert pfr.diverging_calls(store, row, copy, row) is None
+
+    # another run which calls a different routine
+    starts = [i for i, line in enumerate(lines) if line[:5] == 'start']
+    row = len(starts) // 2
+    name = lines[starts[row]][9:]
+    other = [line[:9] + 'subroutine other' if line[9:] == name and
+             starts[row] <= i <= lines.index('finsh -- ' + name, starts[row])
+             else line for i, line in enumerate(lines)]
+    other_store = make_store(tmp_path, other, 'other')
+    top = [r for r in range(store['n_calls']) if store['depth'][r] == 0
+           and r <= row < store['end'][r]][0]
+    assert pfr.diverging_calls(store, top, other_store, top) == (row, row)
+
+    # and a run with an extra call at the end of the first top level call
+    end = store['end'][0]
+    extra = lines[:lines.index('finsh' + lines[0][5:])] + [
+        'start -- subroutine extra', 'finsh -- subroutine extra'] + \
+        lines[lines.index('finsh' + lines[0][5:]):]
+    extra_store = make_store(tmp_path, extra, 'extra')
+    assert pfr.diverging_calls(store, 0, extra_store, 0) == (None, end)
+    assert pfr.diverging_calls(extra_store, 0, store, 0) == (end, None)
+
+
+def test_store_is_reused(tmp_path):
+    log = tmp_path / 'output.txt'
+    write_log(log, random_calls(random.Random(11)))
+    store_dir = str(tmp_path / 'output.pfr')
+    pfr.write_trace_store(str(log), store_dir)
+    meta_file = os.path.join(store_dir, trace_store.meta_name)
+    mtime = os.stat(meta_file).st_mtime_ns
+    pfr.write_trace_store(str(log), store_dir)
+    assert os.stat(meta_file).st_mtime_ns == mtime
+    stat = os.stat(str(log))
+    os.utime(str(log), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    pfr.write_trace_store(str(log), store_dir)
+    assert os.stat(meta_file).st_mtime_ns != mtime
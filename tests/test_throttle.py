@@ -0,0 +1,148 @@
+"""
+Tests that throttled files compile and trace the right calls, with
+gfortran if it is installed.
+"""
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import print_fortran_routines as pfr
+from print_fortran_routines.compact import save_trace_module
+from print_fortran_routines.threads import split_thread_line
+
+module_text = """\
+module pfr_example
+   implicit none
+   contains
+
+   subroutine add_one(x)
+      real, intent(inout) :: x ! the input value
+      x = x + 1
+      x = 2*x
+   end subroutine add_one
+
+   subroutine pick(k)
+      integer, intent(inout) :: k
+      select case (k)
+      case (1)
+         k = 2
+      case default
+         k = k + 1
+      end select
+      k = k + 1
+   end subroutine pick
+
+   integer function twice(n)
+      integer, intent(in) :: n
+      type pair
+         integer :: a, b
+      end type pair
+      type(pair) :: p
+      p%a = n
+      twice = 2*p%a
+   end function twice
+
+   subroutine split_decl(x, &
+         y)
+      real, intent(in) :: x, & ! the inputs
+         y
+      real :: z; z = x + y
+      if (z > 0) z = 0
+   end subroutine split_decl
+
+   subroutine omp_loop(a)
+      real, intent(inout) :: a(:)
+      integer :: i
+      !$omp parallel do
+      do i = 1, size(a)
+         a(i) = a(i) + 1
+      end do
+      !$omp end parallel do
+   end subroutine omp_loop
+end module pfr_example
+"""
+
+main_text = """\
+program main
+   use pfr_example
+   implicit none
+   real :: x, a(4)
+   integer :: i, k, n
+   do i = 1, 6
+      x = 1
+      call add_one(x)
+      k = 1
+      call pick(k)
+      n = twice(i)
+      call split_decl(x, x)
+      a = 0
+      call omp_loop(a)
+   end do
+end program main
+"""
+
+routines = ['subroutine add_one', 'subroutine pick', 'integer function twice',
+            'subroutine split_decl', 'subroutine omp_loop']
+
+gfortran = pytest.mark.skipif(shutil.which('gfortran') is None,
+                              reason='gfortran is not installed')
+
+
+def instrument(tmp_path, throttle, threads):
+    """
+    returns the lines of the example module instrumented in tmp_path
+    """
+    source = tmp_path / 'example.f90'
+    source.write_text(module_text)
+    output = str(tmp_path / 'example_print.f90')
+    pfr.modify_fortran_file(str(source), output, throttle=throttle,
+                            threads=threads)
+    with open(output) as f:
+        return f.readlines()
+
+
+def test_declaration_before_executable_statements(tmp_path):
+    lines = [l.strip() for l in instrument(tmp_path, ('first', 2), True)]
+    i = lines.index('real, intent(inout) :: x ! the input value')
+    assert lines[i + 1:i + 4] == ['integer, save :: pfr_calls = 0',
+                                  '!$omp threadprivate(pfr_calls)',
+                                  'x = x + 1']
+    # the start statement stays after the line following the comment
+    assert lines[i + 4] == 'if (pfr_calls <= 2) pfr_calls = pfr_calls + 1'
+    i = lines.index('integer, intent(inout) :: k')
+    assert lines[i + 1] == 'integer, save :: pfr_calls = 0'
+    # and goes after the declarations which follow a type definition
+    i = lines.index('type(pair) :: p')
+    assert lines[i + 1:i + 4] == ['integer, save :: pfr_calls = 0',
+                                  '!$omp threadprivate(pfr_calls)',
+                                  'if (pfr_calls <= 2) pfr_calls = '
+                                  'pfr_calls + 1']
+
+
+@gfortran
+@pytest.mark.parametrize('threads', [False, True])
+@pytest.mark.parametrize('throttle, n_traced', [
+    (None, 6), (('first', 2), 2), (('every', 4), 2), (('sample', 1), 6),
+    (('sample', 0.5), None)])
+def test_compiles_and_traces(tmp_path, throttle, n_traced, threads):
+    instrument(tmp_path, throttle, threads)
+    (tmp_path / 'main.f90').write_text(main_text)
+    save_trace_module(str(tmp_path))
+    subprocess.run(['gfortran', '-fopenmp', 'pfr_trace.f90',
+                    'example_print.f90', 'main.f90', '-o', 'main'],
+                   cwd=str(tmp_path), check=True)
+    run = subprocess.run(['./main'], cwd=str(tmp_path), check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True,
+                         env=dict(os.environ, OMP_NUM_THREADS='2'))
+    lines = [split_thread_line(l.strip())[1] for l in
+             run.stdout.splitlines()]
+    for routine in routines:
+        name = ' -- {} -- example.f90'.format(routine)
+        n_start = lines.count('start' + name)
+        assert n_start == lines.count('finsh' + name)
+        if n_traced is None:
+            assert 0 < n_start <= 6
+        else:
+            assert n_start == n_traced
@@ -0,0 +1,128 @@
+"""
+Tests for adding up the calls and times of routines from a timed trace.
+"""
+import io
+import json
+from array import array
+
+import print_fortran_routines as pfr
+from print_fortran_routines.timing import (profile_time_trace,
+                                           collapsed_stack_lines)
+
+ids = {'a': 10001, 'b': 10002, 'c': 10003}
+
+
+def name(routine):
+    """
+    returns name of routine in a profile, e.g. 'subroutine a -- a.f90'
+    """
+    return 'subroutine {} -- a.f90'.format(routine)
+
+
+def path(*routines):
+    """
+    returns call stack of routines in a profile
+    """
+    return tuple(map(name, routines))
+
+
+def write_symbols(tmp_path):
+    """
+    writes the symbol table of the routines in ids and returns its name
+    """
+    symbols = {'version': 1, 'files': {'star/a.f90': {'id': 1, 'routines': [
+        [rid, 'subroutine ' + r, 4*i + 1] for i, (r, rid) in
+        enumerate(sorted(ids.items()))]}}}
+    symbols_file = tmp_path / 'pfr_symbols.json'
+    symbols_file.write_text(json.dumps(symbols))
+    return str(symbols_file)
+
+
+def time_trace(events, threads=False):
+    """
+    returns bytes of a trace from pfr_trace_time with a count rate of 1 per
+    second, from events (routine, count), where routine is e.g. 'a' when it
+    starts and '-a' when it finishes. With threads, events are (thread,
+    routine, count), as from pfr_trace_time_thread.
+    """
+    values = [1, 1] if threads else [0, 1]
+    for event in events:
+        *thread, routine, count = event
+        rid = -ids[routine[1:]] if routine[0] == '-' else ids[routine]
+        values += thread + [rid, count]
+    return array('q', values).tobytes()
+
+
+def totals(calls, inclusive, exclusive, unmatched=0):
+    """
+    returns totals of a routine in a profile, with times in seconds
+    """
+    return {'calls': calls, 'inclusive': inclusive, 'exclusive': exclusive,
+            'unmatched': unmatched}
+
+
+def test_nested_calls(tmp_path):
+    trace = tmp_path / 'pfr_time.bin'
+    trace.write_bytes(time_trace([('a', 0), ('b', 10), ('c', 20), ('-c', 30),
+                                  ('-b', 50), ('c', 60), ('-c', 65),
+                                  ('-a', 100)]))
+    profile = profile_time_trace(str(trace), write_symbols(tmp_path))
+    assert profile['total'] == 100
+    assert profile['routines'] == {name('a'): totals(1, 100, 55),
+                                   name('b'): totals(1, 40, 30),
+                                   name('c'): totals(2, 15, 15)}
+    assert profile['threads'] == {0: profile['routines']}
+    assert profile['stacks'] == {path('a'): 55, path('a', 'b'): 30,
+                                 path('a', 'b', 'c'): 10,
+                                 path('a', 'c'): 5}
+    assert list(collapsed_stack_lines(profile)) == [
+        ';'.join(path('a')) + ' 55000000\n',
+        ';'.join(path('a', 'b')) + ' 30000000\n',
+        ';'.join(path('a', 'b', 'c')) + ' 10000000\n',
+        ';'.join(path('a', 'c')) + ' 5000000\n']
+
+
+def test_early_returns(tmp_path):
+    # c and the first b return early, so their time is part of a's. b then
+    # starts again, which closes its open call and the one above it.
+    events = [('a', 0), ('b', 10), ('c', 15), ('b', 20), ('-b', 30),
+              ('-a', 40),
+              # a finish with no start, and a routine still open at the end
+              ('-c', 45), ('b', 50)]
+    profile = profile_time_trace(io.BytesIO(time_trace(events)),
+                                 write_symbols(tmp_path))
+    assert profile['total'] == 50
+    assert profile['routines'] == {name('a'): totals(1, 40, 30),
+                                   name('b'): totals(1, 10, 10, 2),
+                                   name('c'): totals(0, 0, 0, 2)}
+    assert profile['stacks'] == {path('a'): 30, path('a', 'b'): 10}
+
+
+def test_unmatched_time_in_caller(tmp_path):
+    # the time of b's children is added to a when b never finishes
+    events = [('a', 0), ('b', 10), ('c', 12), ('-c', 18), ('-a', 40)]
+    profile = profile_time_trace(io.BytesIO(time_trace(events)),
+                                 write_symbols(tmp_path))
+    assert profile['routines'] == {name('a'): totals(1, 40, 34),
+                                   name('b'): totals(0, 0, 0, 1),
+                                   name('c'): totals(1, 6, 6)}
+    assert profile['stacks'] == {path('a'): 34, path('a', 'b', 'c'): 6}
+
+
+def test_threads(tmp_path):
+    # b and the second a run on thread 1 while the first a is open on
+    # thread 0, so they aren't counted as called by it
+    events = [(0, 'a', 0), (1, 'b', 10), (1, 'a', 20), (0, 'c', 25),
+              (1, '-a', 30), (0, '-c', 35), (1, '-b', 40), (0, '-a', 100)]
+    trace = tmp_path / 'pfr_time_thread.bin'
+    trace.write_bytes(time_trace(events, threads=True))
+    profile = pfr.profile_mesa_trace(str(trace), write_symbols(tmp_path))
+    assert profile['total'] == 100
+    assert profile['threads'] == {
+        0: {name('a'): totals(1, 100, 90), name('c'): totals(1, 10, 10)},
+        1: {name('a'): totals(1, 10, 10), name('b'): totals(1, 30, 20)}}
+    assert profile['routines'] == {name('a'): totals(2, 110, 100),
+                                   name('b'): totals(1, 30, 20),
+                                   name('c'): totals(1, 10, 10)}
+    assert profile['stacks'] == {path('a'): 90, path('a', 'c'): 10,
+                                 path('b'): 20, path('b', 'a'): 10}
@@ -0,0 +1,345 @@
+"""
+Regression tests for pairing up and tabbing in MESA terminal output.
+"""
+import io
+import os
+import random
+
+import pytest
+
+import print_fortran_routines as pfr
+from print_fortran_routines import parallel, trace
+from print_fortran_routines.trace import nest_trace_lines
+
+example_dir = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'pfr_mesa_example')
+
+
+def baseline_tabs(lines):
+    """
+    returns the number of tabs for each line in lines as worked out by the
+    original quadratic version of modify_mesa_terminal_output, which pairs
+    each start line with the next finish line of the same routine
+    """
+    finish_names = ['finsh' + x[5:] if x[:5] == 'start' else False
+                    for x in lines]
+    indexlist = []
+    for i, name in enumerate(finish_names):
+        if lines[i][:5] == 'start' and name in lines[i:]:
+            indexlist.append(i + lines[i:].index(name))
+        else:
+            indexlist.append(-9)
+    tabs = [0] * len(lines)
+    for i, val in enumerate(indexlist):
+        if val != -9:
+            tabs[i] = sum(x > val for x in indexlist[:i])
+    for i, val in reversed(list(enumerate(indexlist))):
+        if val == -9:
+            tabs[i] = tabs[i + 1] if i + 1 < len(lines) else 0
+    for i, val in enumerate(indexlist):
+        if val != -9:
+            tabs[val] = tabs[i]
+    return tabs
+
+
+def random_calls(rng, n_routines=6, n_calls=200, max_depth=8):
+    """
+    returns list of start/finsh lines for a random call tree in which every
+    call finishes and no routine calls itself
+    """
+    lines = []
+    open_names = []
+
+    def call(depth):
+        routine = rng.choice([r for r in range(n_routines)
+                              if r not in open_names])
+        open_names.append(routine)
+        name = 'subroutine r{} -- f.f90'.format(routine)
+        lines.append('start -- ' + name)
+        while len(lines) < n_calls and depth < max_depth \
+                and len(open_names) < n_routines and rng.random() < 0.6:
+            call(depth + 1)
+        lines.append('finsh -- ' + name)
+        open_names.pop()
+
+    while len(lines) < n_calls:
+        call(0)
+    return lines
+
+
+@pytest.mark.parametrize('size', ['short', 'medium', 'long'])
+def test_example_fixtures(size):
+    # the tabbed example logs come back exactly from their stripped lines
+    with open(os.path.join(example_dir,
+                           'routines_{}.txt'.format(size))) as f:
+        expected = f.read()
+    stripped = '\n'.join(line.strip() for line in expected.splitlines())
+    out = io.StringIO()
+    pfr.modify_mesa_terminal_output(io.StringIO(stripped + '\n'), out,
+                                    i_ignore=None)
+    assert out.getvalue() == expected
+
+
+def test_matches_baseline_when_every_call_finishes():
+    rng = random.Random(4)
+    for _ in range(50):
+        lines = random_calls(rng)
+        assert nest_trace_lines(lines) == baseline_tabs(lines)
+
+
+def test_early_return_does_not_nest_later_calls():
+    # a returned early, so b is not inside it. The baseline paired the
+    # first start of a with the later finish and tabbed b in under it.
+    lines = ['start -- a', 'start -- b', 'finsh -- b', 'start -- a',
+             'finsh -- a']
+    assert baseline_tabs(lines) == [0, 1, 1, 0, 0]
+    assert nest_trace_lines(lines) == [0, 0, 0, 0, 0]
+
+
+def test_early_return_inside_caller():
+    lines = ['start -- a', 'start -- b', 'start -- c', 'finsh -- c',
+             'finsh -- a']
+    assert nest_trace_lines(lines) == [0, 1, 1, 1, 0]
+
+
+def test_unmatched_finish():
+    lines = ['finsh -- x', 'start -- a', 'finsh -- a']
+    assert nest_trace_lines(lines) == [0, 0, 0]
+
+
+def test_restart_closes_earlier_call():
+    # recursive routines aren't instrumented, so the first a returned
+    # early, and b may have been called after it
+    lines = ['start -- a', 'start -- b', 'start -- a', 'finsh -- a',
+             'finsh -- b']
+    assert nest_trace_lines(lines) == [0, 0, 1, 1, 0]
+
+
+def early_return_lines(rng, n_lines):
+    """
+    returns list of n_lines random start/finsh lines in which some calls
+    leave through an early return and some finish lines are stray
+    """
+    lines = []
+    stack = []
+    while len(lines) < n_lines:
+        x = rng.random()
+        if x < 0.45:
+            stack.append('r{}'.format(rng.randrange(6)))
+            lines.append('start -- ' + stack[-1])
+        elif stack:
+            name = stack.pop()
+            if rng.random() < 0.8:
+                lines.append('finsh -- ' + name)
+        elif x > 0.95:
+            lines.append('finsh -- r{}'.format(rng.randrange(6)))
+    return lines
+
+
+def test_held_lines_spill_to_file(monkeypatch):
+    rng = random.Random(3)
+    logs = [early_return_lines(rng, 100) for _ in range(100)]
+    expected = [nest_trace_lines(lines) for lines in logs]
+    monkeypatch.setattr(trace, 'pending_limit', 2)
+    assert [nest_trace_lines(lines) for lines in logs] == expected
+
+
+def test_parallel_matches_serial(tmp_path, monkeypatch):
+    monkeypatch.setattr(parallel, 'min_chunk_size', 1)
+    rng = random.Random(1)
+    for k in range(20):
+        lines = early_return_lines(rng, 80)
+        expected = ''.join(n*trace.separator + line + '\n' for n, line in
+                           zip(nest_trace_lines(lines), lines))
+        log = tmp_path / 'log{}.txt'.format(k)
+        log.write_text('\n'.join(lines) + '\n')
+        for n_chunks in (2, 7, 20):
+            assert ''.join(parallel.parallel_nest_trace(
+                str(log), i_ignore=None, workers=2,
+                n_chunks=n_chunks)) == expected
+
+
+def write_log(path, lines):
+    """
+    writes lines to path as a log of a MESA run, with other output
+    """
+    path.write_text(''.join(' ' + line + '\n' for line in lines) +
+                    'other output\n')
+
+
+def same_counts(a, b):
+    """
+    returns whether trace counts a and b hold the same counts
+    """
+    return all(a[k] == b[k] for k in ('routines', 'files', 'counts'))
+
+
+def test_counts_file_is_reused(tmp_path, monkeypatch):
+    log = tmp_path / 'output.txt'
+    counts_file = str(tmp_path / 'counts.json')
+    write_log(log, random_calls(random.Random(2)))
+    settings = [(2, []), (5, []), (20, ['r1 -- f.f90']), (2, ['g.f90'])]
+    expected = []
+    for i_ignore, files in settings:
+        out = io.StringIO()
+        pfr.modify_mesa_terminal_output(str(log), out, i_ignore=i_ignore,
+                                        files=files)
+        expected.append(out.getvalue())
+    pfr.modify_mesa_terminal_output(str(log), io.StringIO(),
+                                    counts_file=counts_file)
+    assert os.path.exists(counts_file)
+
+    def recount(lines):
+        raise AssertionError('counted the log again')
+
+    # later runs with other settings load the counts instead
+    monkeypatch.setattr(pfr, 'count_trace_lines', recount)
+    for (i_ignore, files), text in zip(settings, expected):
+        out = io.StringIO()
+        pfr.modify_mesa_terminal_output(str(log), out, i_ignore=i_ignore,
+                                        files=files, counts_file=counts_file)
+        assert out.getvalue() == text
+
+
+def test_counts_file_follows_input_file(tmp_path):
+    log = tmp_path / 'output.txt'
+    counts_file = str(tmp_path / 'counts.json')
+    lines = ['start -- a', 'finsh -- a'] * 3
+    write_log(log, lines)
+    counts = trace.count_trace_lines(lines)
+    trace.save_trace_counts(counts, counts_file, str(log))
+    assert same_counts(trace.load_trace_counts(counts_file, str(log)),
+                       counts)
+    # touching the log, or changing it, makes the counts out of date
+    stat = os.stat(str(log))
+    os.utime(str(log), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert trace.load_trace_counts(counts_file, str(log)) is None
+    trace.save_trace_counts(counts, counts_file, str(log))
+    write_log(log, lines + ['start -- b', 'finsh -- b'])
+    os.utime(str(log), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert trace.load_trace_counts(counts_file, str(log)) is None
+    # so the next run counts the log again and saves the new counts
+    out = tmp_path / 'out.txt'
+    pfr.modify_mesa_terminal_output(str(log), str(out), i_ignore=3,
+                                    counts_file=counts_file)
+    assert out.read_text() == 'start -- b\nfinsh -- b\n'
+    assert same_counts(trace.load_trace_counts(counts_file, str(log)),
+                       trace.count_trace_lines(lines + ['start -- b',
+                                                        'finsh -- b']))
+
+
+def call_tree(lines):
+    """
+    returns the lines of the call tree of lines, as written with aggregate
+    """
+    events = zip(nest_trace_lines(lines), lines)
+    return list(trace.call_tree_lines(trace.aggregate_trace_events(events)))
+
+
+def test_call_tree_merges_calls():
+    # calls with the same call path are merged, in the order first called
+    lines = ['start -- a', 'start -- b', 'start -- c', 'finsh -- c',
+             'finsh -- b', 'start -- b', 'start -- c', 'finsh -- c',
+             'finsh -- b', 'start -- d', 'finsh -- d', 'finsh -- a',
+             'start -- a', 'start -- b', 'finsh -- b', 'start -- c',
+             'finsh -- c', 'finsh -- a', 'start -- c', 'finsh -- c']
+    tab = trace.separator
+    assert call_tree(lines) == ['a (x2)\n', tab + 'b (x3)\n',
+                                2*tab + 'c (x2)\n', tab + 'd (x1)\n',
+                                tab + 'c (x1)\n', 'c (x1)\n']
+
+
+def test_call_tree_unmatched_starts():
+    # b returned early, so it is a call with no children at the depth it
+    # was tabbed to, and c is called by a rather than b
+    lines = ['start -- a', 'start -- b', 'start -- c', 'finsh -- c',
+             'finsh -- a', 'start -- b', 'start -- b', 'finsh -- b']
+    tab = trace.separator
+    assert call_tree(lines) == ['a (x1)\n', tab + 'b (x1)\n',
+                                tab + 'c (x1)\n', 'b (x2)\n']
+    # a line can't be deeper than one more than the routines open
+    root = trace.aggregate_trace_events([(0, 'start -- a'),
+                                         (3, 'start -- b'),
+                                         (5, 'finsh -- b')])
+    assert root == [0, {'a': [1, {'b': [1, {}]}]}]
+
+
+def test_aggregate_keeps_frequent_routines(tmp_path):
+    lines = (['start -- a', 'start -- b', 'finsh -- b', 'start -- b',
+              'finsh -- b', 'start -- b', 'finsh -- b', 'finsh -- a'] +
+             ['start -- c', 'finsh -- c'] * 4)
+    log = tmp_path / 'output.txt'
+    write_log(log, lines)
+    tab = trace.separator
+    tree = ['a (x1)\n', tab + 'b (x3)\n', 'c (x4)\n']
+    out = io.StringIO()
+    pfr.modify_mesa_terminal_output(str(log), out, aggregate=True)
+    assert out.getvalue() == ''.join(tree)
+    # unless i_ignore is given
+    out = io.StringIO()
+    pfr.modify_mesa_terminal_output(str(log), out, i_ignore=2,
+                                    aggregate=True)
+    assert out.getvalue() == 'a (x1)\n'
+    out = io.StringIO()
+    pfr.modify_mesa_terminal_output(str(log), out)
+    assert out.getvalue() == 'start -- a\nfinsh -- a\n'
+
+    out = tmp_path / 'tree.txt'
+    pfr.modify_mesa_terminal_views(str(log), [
+        {'output_file': str(out), 'aggregate': True}])
+    assert out.read_text() == ''.join(tree)
+    out = io.StringIO()
+    pfr.modify_mesa_thread_output(str(log), out, aggregate=True)
+    assert out.getvalue() == ''.join(['== thread 0 ==\n'] + tree)
+
+
+def test_parallel_counts_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(parallel, 'min_chunk_size', 1)
+    log = tmp_path / 'output.txt'
+    counts_file = str(tmp_path / 'counts.json')
+    lines = random_calls(random.Random(5))
+    write_log(log, lines)
+    out = io.StringIO()
+    pfr.modify_mesa_terminal_output(str(log), out, counts_file=counts_file,
+                                    workers=2)
+    assert same_counts(trace.load_trace_counts(counts_file, str(log)),
+                       trace.count_trace_lines(lines))
+
+    def recount(*args):
+        raise AssertionError('counted the log again')
+
+    monkeypatch.setattr(pfr, 'count_trace_lines', recount)
+    monkeypatch.setattr(pfr, 'parallel_count_trace_lines', recount)
+    for workers in (1, 2):
+        out = io.StringIO()
+        pfr.modify_mesa_terminal_output(str(log), out, i_ignore=10,
+                                        counts_file=counts_file,
+                                        workers=workers)
+        assert out.getvalue() == ''.join(trace.nest_trace(
+            lambda: iter(lines), i_ignore=10))
+
+
+def test_views_match_separate_runs(tmp_path):
+    rng = random.Random(6)
+    lines = [line + ' -- f{}.f90'.format(int(line[-1]) % 2) for line in
+             early_return_lines(rng, 400)]
+    log = tmp_path / 'output.txt'
+    write_log(log, lines)
+    settings = [{}, {'i_ignore': None}, {'i_ignore': 35},
+                {'i_ignore': None, 'files': ['f1.f90']},
+                {'i_ignore': 45, 'files': ['f0.f90']}, {'aggregate': True},
+                {'aggregate': True, 'i_ignore': 40},
+                {'aggregate': True, 'files': ['f0.f90']},
+                {'aggregate': True, 'i_ignore': 34, 'files': ['f1.f90']}]
+    views = [dict(setting, output_file=str(tmp_path / 'view{}.txt'.format(k)))
+             for k, setting in enumerate(settings)]
+    pfr.modify_mesa_terminal_views(str(log), views)
+    outputs = set()
+    for view, setting in zip(views, settings):
+        expected = io.StringIO()
+        pfr.modify_mesa_terminal_output(str(log), expected, **setting)
+        with open(view['output_file']) as f:
+            assert f.read() == expected.getvalue()
+        outputs.add(expected.getvalue())
+    # the views are different from each other
+    assert len(outputs) == len(settings)